@@ -95,7 +95,7 @@ class DiagGaussianActor(nn.Module):
 class CategoricalActor(nn.Module):
     """torch.distributions implementation of a categorical policy for discrete environments."""
     def __init__(self, obs_space, obs_dim, action_dim, policy, hidden_dim, hidden_depth,
-                 log_std_bounds, mode=0):
+                 log_std_bounds, mode=0, obs_scale=1.0):
         super().__init__()
         self.obs_space = obs_space
         self.policy = policy
@@ -104,7 +104,7 @@ class CategoricalActor(nn.Module):
         
         #print(obs_space.shape[0]) # Needs reshape to 3,7,7
         if policy =='CNN':
-            self.cnn, self.flatten = utils.cnn(obs_space, obs_dim[2], mode=mode)
+            self.cnn, self.flatten = utils.cnn(obs_space, obs_dim[2], mode=mode, obs_scale=obs_scale)
             obs_dim = self.flatten
             
         self.trunk = utils.mlp(obs_dim, hidden_dim, action_dim, hidden_depth)
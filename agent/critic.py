@@ -7,14 +7,14 @@ from torch import nn
 
 class DoubleQCritic(nn.Module):
     """Critic network, employes double Q-learning."""
-    def __init__(self, obs_space, obs_dim, action_dim, action_type, policy, hidden_dim, hidden_depth, mode = 0):
+    def __init__(self, obs_space, obs_dim, action_dim, action_type, policy, hidden_dim, hidden_depth, mode = 0, obs_scale=1.0):
         super().__init__()
         self.policy = policy
         self.action_type = action_type
 
         # If obs is image-like use feature extraction
         if self.policy =='CNN':
-            self.cnn, self.flatten = utils.cnn(obs_space, obs_dim[2], mode = mode)
+            self.cnn, self.flatten = utils.cnn(obs_space, obs_dim[2], mode = mode, obs_scale = obs_scale)
             obs_dim = self.flatten
 
         if self.action_type == 'Cont':
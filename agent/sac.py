@@ -3,6 +3,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import math
+import copy
+from collections import deque
 import lib.utils as utils
 import hydra
 
@@ -10,9 +12,13 @@ from agent import Agent
 from agent.critic import DoubleQCritic
 from agent.actor import DiagGaussianActor, CategoricalActor
 from stable_baselines3.common.distributions import CategoricalDistribution
+from lib.inference import prepare_checked
 
 def compute_state_entropy(obs, full_obs, k, action_type):
     batch_size = 100
+    if action_type != 'Cont' and obs.shape[-1] != full_obs.shape[-1]:
+        # stacked observations are compared on their newest frame
+        obs = obs[..., -full_obs.shape[-1]:]
     with torch.no_grad():
         dists = []
         for idx in range(len(full_obs) // batch_size + 1):
@@ -39,7 +45,7 @@ class SACAgent(Agent):
                  actor_lr, actor_betas, actor_update_frequency, critic_lr,
                  critic_betas, critic_tau, critic_target_update_frequency,
                  batch_size, policy, learnable_temperature, mode=0,
-                 normalize_state_entropy=True):
+                 normalize_state_entropy=True, obs_scale=1.0):
         super().__init__()
 
         self.obs_space = obs_space
@@ -66,6 +72,7 @@ class SACAgent(Agent):
         self.policy = policy
         self.action_type = self.actor_cfg.action_type
         self.mode = mode
+        self.obs_scale = obs_scale  # pixels arrive as uint8 and are divided by obs_scale inside the CNNs
 
         #self.critic = hydra.utils.instantiate(critic_cfg, _convert_="all").to(self.device)
         self.critic = self.create_critic()
@@ -98,6 +105,13 @@ class SACAgent(Agent):
             lr=alpha_lr,
             betas=alpha_betas)
         
+        # act() through an int8 / traced copy of the actor trunk, see prepare_inference
+        self.inference_mode = 'none'
+        self.inference_actor = None
+        self.act_input = None
+        self.act_calls = 0
+        self.act_history = deque(maxlen=256)
+        
         # change mode
         self.train()
         # self.actor.train()
@@ -112,7 +126,8 @@ class SACAgent(Agent):
             policy= self.critic_cfg.policy,
             hidden_dim= self.critic_cfg.hidden_dim,
             hidden_depth= self.critic_cfg.hidden_depth,
-            mode= self.mode).to(self.device)
+            mode= self.mode,
+            obs_scale= self.obs_scale).to(self.device)
         return critic
     
     def create_actor(self):
@@ -134,7 +149,8 @@ class SACAgent(Agent):
                 hidden_dim = self.actor_cfg.hidden_dim, 
                 hidden_depth = self.actor_cfg.hidden_depth,
                 log_std_bounds = self.actor_cfg.log_std_bounds,
-                mode= self.mode).to(self.device)
+                mode= self.mode,
+                obs_scale= self.obs_scale).to(self.device)
             self.categorical = CategoricalDistribution(self.actor_cfg.action_dim)
         return actor
     
@@ -161,6 +177,7 @@ class SACAgent(Agent):
         # reset actor
         #self.actor = hydra.utils.instantiate(self.actor_cfg).to(self.device)
         self.actor = self.create_actor()
+        self.act_calls = 0  # the inference copy follows the new actor from the next act
         self.actor_optimizer = torch.optim.Adam(
             self.actor.parameters(),
             lr=self.actor_lr,
@@ -175,10 +192,50 @@ class SACAgent(Agent):
     def alpha(self):
         return self.log_alpha.exp()
 
+    def prepare_inference(self, mode='none', refresh=1000, tol=0.01):
+        # CPU collection: act() uses a copy of the actor with an inference ready trunk ('jit' or 'int8'),
+        # rebuilt from the float32 actor being trained every refresh calls, so the acting policy lags the
+        # trained one by up to refresh calls
+        self.inference_mode = mode if self.device.type == 'cpu' else 'none'
+        self.inference_refresh = refresh
+        self.inference_tol = tol
+        self.inference_actor = None
+        self.act_calls = 0
+        self.act_history.clear()
+
+    def refresh_inference_actor(self):
+        # the int8 trunk is calibrated and checked on the trunk inputs of the latest act observations,
+        # with too few of them yet it stays float32 until the next refresh
+        actor = copy.deepcopy(self.actor).cpu().eval()
+        mode = self.inference_mode if len(self.act_history) >= 32 else 'jit'
+        inputs = torch.as_tensor(np.stack(self.act_history), dtype=torch.float32)
+        with torch.no_grad():
+            if getattr(actor, 'policy', None) == 'CNN':
+                inputs = actor.cnn(inputs.permute(0, 3, 1, 2))
+        actor.trunk = prepare_checked(actor.trunk, mode, inputs, self.inference_tol, name='actor')
+        self.inference_actor = actor
+
     def act(self, obs, sample=False, determ=False):
-        obs = torch.FloatTensor(obs).to(self.device)
-        obs = obs.unsqueeze(0)
-        dist = self.actor.forward(obs)
+        if self.inference_mode != 'none':
+            # only the observations of the calls just before a refresh are kept
+            due = self.act_calls % self.inference_refresh
+            if due == 0 or due > self.inference_refresh - self.act_history.maxlen:
+                self.act_history.append(np.array(obs, copy=True))
+            if due == 0:
+                self.refresh_inference_actor()
+            self.act_calls += 1
+            # fixed shape input, written in place
+            obs = torch.as_tensor(obs, dtype=torch.float32)
+            if self.act_input is None or self.act_input.shape[1:] != obs.shape:
+                self.act_input = torch.empty((1, *obs.shape))
+            self.act_input[0] = obs
+            with torch.no_grad():
+                dist = self.inference_actor.forward(self.act_input)
+        else:
+            # uint8 frames are sent as they are and scaled by the CNN
+            obs = torch.as_tensor(obs, device=self.device)
+            obs = obs.unsqueeze(0) if obs.dtype == torch.uint8 else obs.float().unsqueeze(0)
+            dist = self.actor.forward(obs)
         if self.action_type == 'Cont':
             # Action is a vector of float numbers
             action = dist.sample() if sample else dist.mean         
@@ -336,7 +336,7 @@ class Xplain:
 
         clips1=[]
         for i, clip1 in enumerate(frames1):
-            filename = f'TESTclip1_{i}.mp4'
+            filename = f'TEST{clipname}_clip1_{i}.mp4'
             with open(p / filename, 'wb') as file1:
                 imageio.mimsave(p / filename, clip1, fps=fps, **kargs)
             clips1.append(VideoFileClip(str(p / filename)).margin(10).resize((scale, scale)))
@@ -345,7 +345,7 @@ class Xplain:
         if xflag:
             xclips1=[]
             for i, xclip1 in enumerate(xframes1):
-                filename = f'TESTxclip1_{i}.mp4'
+                filename = f'TEST{clipname}_xclip1_{i}.mp4'
                 with open(p / filename, 'wb') as file1:
                     imageio.mimsave(p / filename, xclip1, fps=xfps)
                 xclips1.append(VideoFileClip(str(p / filename)).margin(10).resize((scale, scale)))
@@ -354,7 +354,7 @@ class Xplain:
 
         clips2=[]
         for i, clip2 in enumerate(frames2):
-            filename = f'TESTclip2_{i}.mp4'
+            filename = f'TEST{clipname}_clip2_{i}.mp4'
             with open(p / filename, 'wb') as file2:
                 imageio.mimsave(p / filename, clip2, fps=fps, **kargs)
             clips2.append(VideoFileClip(str(p / filename)).margin(10).resize((scale, scale)))
@@ -363,7 +363,7 @@ class Xplain:
         if xflag:
             xclips2=[]
             for i, xclip2 in enumerate(xframes2):
-                filename = f'TESTxclip2_{i}.mp4'
+                filename = f'TEST{clipname}_xclip2_{i}.mp4'
                 with open(p / filename, 'wb') as file2:
                     imageio.mimsave(p / filename, xclip2, fps=xfps)
                 xclips2.append(VideoFileClip(str(p / filename)).margin(10).resize((scale, scale)))
@@ -387,15 +387,15 @@ class Xplain:
 
         [i.close() for i in clips1]
         [i.close() for i in clips2]
-        i=[os.remove(p / f'TESTclip1_{i}.mp4') for i, clip in enumerate(frames1)]
-        i=[os.remove(p / f'TESTclip2_{i}.mp4') for i, clip in enumerate(frames2)]
+        i=[os.remove(p / f'TEST{clipname}_clip1_{i}.mp4') for i, clip in enumerate(frames1)]
+        i=[os.remove(p / f'TEST{clipname}_clip2_{i}.mp4') for i, clip in enumerate(frames2)]
         
         start_time = time.time()
         if xflag:
             [i.close() for i in xclips2]
             [i.close() for i in xclips1]
-            i=[os.remove(p / f'TESTxclip1_{i}.mp4') for i, clip in enumerate(xframes1)]
-            i=[os.remove(p / f'TESTxclip2_{i}.mp4') for i, clip in enumerate(xframes2)]
+            i=[os.remove(p / f'TEST{clipname}_xclip1_{i}.mp4') for i, clip in enumerate(xframes1)]
+            i=[os.remove(p / f'TEST{clipname}_xclip2_{i}.mp4') for i, clip in enumerate(xframes2)]
         elapsed_time = time.time() - start_time
         time_sum += elapsed_time
         return time_sum
@@ -445,7 +445,7 @@ class ReplayDataset(Dataset):
         def __init__(self, replay_buffer):
             self.idx = replay_buffer.capacity if replay_buffer.full else replay_buffer.idx
 
-            self.states = np.copy(replay_buffer.obses[:self.idx])
+            self.states = np.copy(replay_buffer.observations(slice(0, self.idx)))
             self.actions = np.copy(replay_buffer.actions[:self.idx])
     
         def __len__(self):
@@ -0,0 +1,50 @@
+import copy
+import torch
+import torch.nn as nn
+
+def wide_ensemble(ensemble):
+    # the stacked reward ensemble as plain nn.Linear layers: the first layer concatenates the members,
+    # the next ones are block diagonal, so a row goes through every member with one matmul per layer.
+    # The output has one column per member.
+    layers, first = [], True
+    with torch.no_grad():
+        for module in ensemble:
+            if not hasattr(module, 'ensemble_size'):
+                layers.append(copy.deepcopy(module))
+                continue
+            weight = module.weight.detach().cpu()
+            weight = weight.reshape(-1, weight.shape[-1]) if first else torch.block_diag(*weight)
+            linear = nn.Linear(weight.shape[1], weight.shape[0])
+            linear.weight.copy_(weight)
+            linear.bias.copy_(module.bias.detach().cpu().reshape(-1))
+            layers.append(linear)
+            first = False
+    return nn.Sequential(*layers).cpu()
+
+def prepare_module(module, mode, example):
+    # eval copy of module for low latency CPU inference:
+    #  - 'int8': nn.Linear layers dynamically quantized to int8, then traced
+    #  - 'jit': float32, traced
+    # traces are frozen and optimized, which fuses Linear+activation where the backend supports it
+    module = copy.deepcopy(module).cpu().eval()
+    if mode == 'none':
+        return module
+    if mode == 'int8':
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+def max_abs_error(reference, candidate, inputs):
+    with torch.no_grad():
+        return (reference(inputs) - candidate(inputs)).abs().max().item()
+
+def prepare_checked(module, mode, inputs, tol, name='model'):
+    # prepare_module, checked against the float model on inputs: an int8 copy off by more than tol falls back to float32.
+    # module is the float32 reference as it is, pass a CPU module (it is put in eval mode)
+    prepared = prepare_module(module, mode, inputs[:1])
+    error = max_abs_error(module.eval(), prepared, inputs)
+    if mode == 'int8' and error > tol:
+        print(f'int8 {name} is off by {error:.4f} (> {tol}), using float32 instead')
+        prepared = prepare_module(module, 'jit', inputs[:1])
+    return prepared
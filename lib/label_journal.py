@@ -0,0 +1,66 @@
+import os
+import time
+import queue
+import pickle
+import threading
+
+class LabelJournal(object):
+    """Append-only file of preference label records, written by a background thread with batched fsync."""
+    _CLOSE = object()
+
+    def __init__(self, path, fsync_every=32, fsync_interval=1.0):
+        self.path = str(path)
+        self.fsync_every = fsync_every          # records written between two fsync
+        self.fsync_interval = fsync_interval    # seconds before pending records are synced anyway
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        # never blocks the caller, the record is pickled and written by the writer thread
+        self.queue.put(record)
+
+    def close(self):
+        # write and sync everything appended so far
+        if self.thread is None:
+            return
+        self.queue.put(self._CLOSE)
+        self.thread.join()
+        self.thread = None
+
+    def _work(self):
+        pending, last_sync = 0, time.time()
+        with open(self.path, 'ab') as f:
+            while True:
+                try:
+                    record = self.queue.get(timeout=self.fsync_interval)
+                except queue.Empty:
+                    record = None
+                if record is self._CLOSE:
+                    break
+                if record is not None:
+                    pickle.dump(record, f, protocol=4)
+                    pending += 1
+                if pending > 0 and (pending >= self.fsync_every or time.time() - last_sync >= self.fsync_interval):
+                    f.flush()
+                    os.fsync(f.fileno())
+                    pending, last_sync = 0, time.time()
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def read(path):
+        # records in write order, a record cut by a crash ends the journal
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, AttributeError):
+                    print(f'Label journal {path} ends with a partial record, it is ignored')
+                    break
+        return records
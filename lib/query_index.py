@@ -0,0 +1,51 @@
+import numpy as np
+
+class QueryIndex(object):
+    """Hashed sets of the segment pairs already sent to the labeler, by reference and by quantized signature."""
+    def __init__(self, quantum=0.0):
+        self.quantum = quantum      # grid size of the signatures, 0 disables the near-duplicate filter
+        self.pairs = set()
+        self.signatures = set()
+
+    def pair_keys(self, refs_1, refs_2):
+        # (trajectory, offset) of both segments, the order of the two segments does not matter
+        a, b = refs_1[:, :2], refs_2[:, :2]
+        swap = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1]))
+        first = np.where(swap[:, None], b, a)
+        second = np.where(swap[:, None], a, b)
+        return [tuple(key) for key in np.concatenate([first, second], axis=1).tolist()]
+
+    def signature_keys(self, sig_1, sig_2):
+        q_1 = np.floor(sig_1 / self.quantum).astype(np.int64)
+        q_2 = np.floor(sig_2 / self.quantum).astype(np.int64)
+        keys = []
+        for x, y in zip(q_1, q_2):
+            x, y = x.tobytes(), y.tobytes()
+            keys.append(x + y if x <= y else y + x)
+        return keys
+
+    def new_mask(self, refs_1, refs_2, sig_1=None, sig_2=None):
+        # True for pairs never queried before and not repeated earlier in the same batch
+        keys = self.pair_keys(refs_1, refs_2)
+        sig_keys = self.signature_keys(sig_1, sig_2) if sig_1 is not None else [None] * len(keys)
+        mask = np.zeros(len(keys), dtype=bool)
+        seen, seen_sig = set(), set()
+        for i, (key, sig_key) in enumerate(zip(keys, sig_keys)):
+            if key in self.pairs or key in seen:
+                continue
+            if sig_key is not None and (sig_key in self.signatures or sig_key in seen_sig):
+                continue
+            mask[i] = True
+            seen.add(key)
+            seen_sig.add(sig_key)
+        return mask
+
+    def add(self, refs_1, refs_2):
+        self.pairs.update(self.pair_keys(refs_1, refs_2))
+
+    def add_signatures(self, sig_1, sig_2):
+        self.signatures.update(self.signature_keys(sig_1, sig_2))
+
+    def discard_episodes(self, first_ep):
+        # forget the pairs with a segment of an episode from first_ep on, those ids are issued again
+        self.pairs = {key for key in self.pairs if key[0] < first_ep and key[2] < first_ep}
@@ -0,0 +1,70 @@
+import copy
+import queue
+import threading
+
+def snapshot_ui(ui_module):
+    # copy of the clip renderer explaining with a frozen copy of the actor
+    ui = copy.copy(ui_module)
+    ui.agent = copy.copy(ui_module.agent)
+    ui.agent.actor = copy.deepcopy(ui_module.agent.actor)
+    return ui
+
+class QueryPrefetcher(object):
+    """Selects and renders the next feedback rounds in a background thread, from weight snapshots."""
+    def __init__(self, reward_model, feed_type, depth=1):
+        self.reward_model = reward_model
+        self.feed_type = feed_type
+        self.rounds = queue.Queue(maxsize=depth)    # (queries, clipname) ready to be labeled
+        self.thread = None
+        self.error = None
+        self.num_rounds = 0
+
+    @property
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        # snapshot the reward model and the actor now and prepare rounds until the queue is full,
+        # called from the main thread after every reward update
+        if self.busy or self.rounds.full():
+            return
+        self._join()
+        snapshot = self.reward_model.shadow_copy()
+        if snapshot.ui_module is not None:
+            snapshot.ui_module = snapshot_ui(snapshot.ui_module)
+        self.thread = threading.Thread(target=self._work, args=(snapshot,), daemon=True)
+        self.thread.start()
+
+    def _work(self, snapshot):
+        try:
+            while not self.rounds.full():
+                self.num_rounds += 1
+                clipname = f'Round{self.num_rounds}PairClip'
+                queries = snapshot.select_queries(self.feed_type)
+                if snapshot.needs_clips() and len(queries[0]) > 0:
+                    sa_t_1, sa_t_2, _, _, snaps_1, snaps_2, _, _ = queries
+                    snapshot.render_queries(sa_t_1, sa_t_2, snaps_1, snaps_2, clipname)
+                self.rounds.put((queries, clipname))
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        # the oldest prepared round, prepared now (and waited for) when none is ready
+        if self.rounds.empty():
+            self.start()
+            self._join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return self.rounds.get_nowait()
+
+    def clear(self):
+        # drop the prepared rounds, e.g. when the queries they hold are outdated
+        self._join()
+        while not self.rounds.empty():
+            self.rounds.get_nowait()
+
+    def _join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -1,145 +1,606 @@
 import numpy as np
 import torch
+import time
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+import queue
 import lib.utils as utils
+import gymnasium as gym
 from gymnasium.spaces import utils as gym_utils
 
 class ReplayBuffer(object):
     """Buffer to store environment transitions."""
-    def __init__(self, obs_space, obs_shape, action_shape, action_type, capacity, device, window=1):
+    def __init__(self, obs_space, obs_shape, action_shape, action_type, capacity, device, window=1, relabel_batch_size=10000, obs_dtype=np.float32,
+                 storage_dir=None):
         self.capacity = capacity
         self.device = device
+        self.relabel_batch_size = int(relabel_batch_size)
         self.obs_space=obs_space
 
-        # the proprioceptive obs is stored as float32, pixels obs as uint8
+        # storage_dir: the arrays are .npy files mapped in memory, the OS pages them in and out.
+        # every buffer gets a new subdirectory, removed by close or at exit; snapshots are flushed copies of its files
+        self.storage_dir = None
+        self.array_keys = []
+        if storage_dir:
+            os.makedirs(storage_dir, exist_ok=True)
+            self.storage_dir = tempfile.mkdtemp(prefix='replay_buffer_', dir=os.path.abspath(storage_dir))
+            atexit.register(shutil.rmtree, self.storage_dir, ignore_errors=True)
+
+        # the proprioceptive obs is stored as float32, pixels obs as uint8 in pixel_uint8 mode
+        # (sampled batches go to the device as uint8, the CNNs normalize them)
         #obs_dtype = np.float32 if len(obs_shape) == 1 else np.uint8
-        obs_dtype = np.float32
         act_dtype = np.float32 if action_type == 'Cont' else np.uint8
 
-        self.obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.next_obses = np.empty((capacity, *obs_shape), dtype=obs_dtype)
-        self.actions = np.empty((capacity, *action_shape), dtype=act_dtype)
-        self.rewards = np.empty((capacity, 1), dtype=np.float32)
-        self.not_dones = np.empty((capacity, 1), dtype=np.float32)
-        self.not_dones_no_max = np.empty((capacity, 1), dtype=np.float32)
+        self.allocate_obs(obs_shape, obs_dtype)
+        self.allocate('actions', (capacity, *action_shape), act_dtype)
+        self.allocate('rewards', (capacity, 1), np.float32)
+        self.allocate('not_dones', (capacity, 1), np.float32)
+        self.allocate('not_dones_no_max', (capacity, 1), np.float32)
         self.window = window
+        
+        # model_version of the reward model that predicted each row's reward, -1 if unknown
+        self.allocate('reward_versions', (capacity,), np.int64)[:] = -1
+        self.predictor = None   # reward model used to relabel stale rows when they are sampled
+        self.sweep_idx = 0
 
         self.idx = 0
         self.last_save = 0
         self.full = False
+        # held while rows are written or relabeled, and while batches are gathered by a BatchPrefetcher
+        self.lock = threading.RLock()
+
+    def allocate(self, name, shape, dtype):
+        # a RAM array, or with storage_dir a memory mapped .npy file of it
+        if self.storage_dir is None:
+            array = np.empty(shape, dtype=dtype)
+        else:
+            path = os.path.join(self.storage_dir, f'{name}.npy')
+            array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        self.array_keys.append(name)
+        setattr(self, name, array)
+        return array
+
+    def allocate_obs(self, obs_shape, obs_dtype):
+        self.allocate('obses', (self.capacity, *obs_shape), obs_dtype)
+        self.allocate('next_obses', (self.capacity, *obs_shape), obs_dtype)
 
     def __len__(self):
         return self.capacity if self.full else self.idx
 
+    def observations(self, idxs, next_obs=False):
+        # the observations of rows idxs as the agent sees them
+        return self.next_obses[idxs] if next_obs else self.obses[idxs]
+
+    def reward_obs(self, idxs):
+        # the observations of rows idxs as the reward model sees them
+        return self.obses[idxs]
+
+    def full_observations(self):
+        # every stored observation, for the state entropy estimate
+        return self.obses if self.full else self.obses[: self.idx]
+
+    def sample_idxs(self, batch_size):
+        return np.random.randint(0, len(self), size=batch_size)
+
+    def valid(self, idxs):
+        # rows whose observations are still stored, all of them here
+        return np.ones(len(idxs), dtype=bool)
+
     def add(self, obs, action, reward, next_obs, done, done_no_max):
-        np.copyto(self.obses[self.idx], obs)
-        np.copyto(self.actions[self.idx], action)
-        np.copyto(self.rewards[self.idx], reward)
-        np.copyto(self.next_obses[self.idx], next_obs)
-        np.copyto(self.not_dones[self.idx], not done)
-        np.copyto(self.not_dones_no_max[self.idx], not done_no_max)
+        with self.lock:
+            np.copyto(self.obses[self.idx], obs)
+            np.copyto(self.actions[self.idx], action)
+            np.copyto(self.rewards[self.idx], reward)
+            np.copyto(self.next_obses[self.idx], next_obs)
+            np.copyto(self.not_dones[self.idx], not done)
+            np.copyto(self.not_dones_no_max[self.idx], not done_no_max)
+            self.reward_versions[self.idx] = self.current_version()
 
-        self.idx = (self.idx + 1) % self.capacity
-        self.full = self.full or self.idx == 0
+            self.idx = (self.idx + 1) % self.capacity
+            self.full = self.full or self.idx == 0
     
     def add_batch(self, obs, action, reward, next_obs, done, done_no_max):
         
-        next_index = self.idx + self.window
-        if next_index >= self.capacity:
-            self.full = True
-            maximum_index = self.capacity - self.idx
-            np.copyto(self.obses[self.idx:self.capacity], obs[:maximum_index])
-            np.copyto(self.actions[self.idx:self.capacity], action[:maximum_index])
-            np.copyto(self.rewards[self.idx:self.capacity], reward[:maximum_index])
-            np.copyto(self.next_obses[self.idx:self.capacity], next_obs[:maximum_index])
-            np.copyto(self.not_dones[self.idx:self.capacity], done[:maximum_index] <= 0)
-            np.copyto(self.not_dones_no_max[self.idx:self.capacity], done_no_max[:maximum_index] <= 0)
-            remain = self.window - (maximum_index)
-            if remain > 0:
-                np.copyto(self.obses[0:remain], obs[maximum_index:])
-                np.copyto(self.actions[0:remain], action[maximum_index:])
-                np.copyto(self.rewards[0:remain], reward[maximum_index:])
-                np.copyto(self.next_obses[0:remain], next_obs[maximum_index:])
-                np.copyto(self.not_dones[0:remain], done[maximum_index:] <= 0)
-                np.copyto(self.not_dones_no_max[0:remain], done_no_max[maximum_index:] <= 0)
-            self.idx = remain
-        else:
-            np.copyto(self.obses[self.idx:next_index], obs)
-            np.copyto(self.actions[self.idx:next_index], action)
-            np.copyto(self.rewards[self.idx:next_index], reward)
-            np.copyto(self.next_obses[self.idx:next_index], next_obs)
-            np.copyto(self.not_dones[self.idx:next_index], done <= 0)
-            np.copyto(self.not_dones_no_max[self.idx:next_index], done_no_max <= 0)
-            self.idx = next_index
+        with self.lock:
+            next_index = self.idx + self.window
+            self.reward_versions[(self.idx + np.arange(self.window)) % self.capacity] = self.current_version()
+            if next_index >= self.capacity:
+                self.full = True
+                maximum_index = self.capacity - self.idx
+                np.copyto(self.obses[self.idx:self.capacity], obs[:maximum_index])
+                np.copyto(self.actions[self.idx:self.capacity], action[:maximum_index])
+                np.copyto(self.rewards[self.idx:self.capacity], reward[:maximum_index])
+                np.copyto(self.next_obses[self.idx:self.capacity], next_obs[:maximum_index])
+                np.copyto(self.not_dones[self.idx:self.capacity], done[:maximum_index] <= 0)
+                np.copyto(self.not_dones_no_max[self.idx:self.capacity], done_no_max[:maximum_index] <= 0)
+                remain = self.window - (maximum_index)
+                if remain > 0:
+                    np.copyto(self.obses[0:remain], obs[maximum_index:])
+                    np.copyto(self.actions[0:remain], action[maximum_index:])
+                    np.copyto(self.rewards[0:remain], reward[maximum_index:])
+                    np.copyto(self.next_obses[0:remain], next_obs[maximum_index:])
+                    np.copyto(self.not_dones[0:remain], done[maximum_index:] <= 0)
+                    np.copyto(self.not_dones_no_max[0:remain], done_no_max[maximum_index:] <= 0)
+                self.idx = remain
+            else:
+                np.copyto(self.obses[self.idx:next_index], obs)
+                np.copyto(self.actions[self.idx:next_index], action)
+                np.copyto(self.rewards[self.idx:next_index], reward)
+                np.copyto(self.next_obses[self.idx:next_index], next_obs)
+                np.copyto(self.not_dones[self.idx:next_index], done <= 0)
+                np.copyto(self.not_dones_no_max[self.idx:next_index], done_no_max <= 0)
+                self.idx = next_index
         
+    def current_version(self):
+        return self.predictor.model_version if self.predictor is not None else -1
+
+    def predict_rewards(self, predictor, obses, actions):
+        obs_flat = utils.flatten_batch(self.obs_space, obses)
+        inputs = np.concatenate([obs_flat, actions], axis=-1)
+        return utils.to_np(predictor.r_hat_batch(inputs))
+
     def relabel_with_predictor(self, predictor):
-        batch_size = 200
-        total_iter = int(self.idx/batch_size)
+        # the whole valid part of the ring, in large chunks flattened with a single reshape
+        num_rows = len(self)
+        start_time = time.time()
+        with self.lock:
+            for start in range(0, num_rows, self.relabel_batch_size):
+                end = min(start + self.relabel_batch_size, num_rows)
+                # rows whose frames were overwritten are never sampled again and are left as they are
+                rows = slice(start, end)
+                valid = self.valid(np.arange(start, end))
+                if not valid.all():
+                    rows = start + np.flatnonzero(valid)
+                self.rewards[rows] = self.predict_rewards(predictor, self.reward_obs(rows), self.actions[rows])
+                self.reward_versions[rows] = predictor.model_version
         
-        if self.idx > batch_size*total_iter:
-            total_iter += 1
-            
-        for index in range(total_iter):
-            last_index = (index+1)*batch_size
-            if (index+1)*batch_size > self.idx:
-                last_index = self.idx
-                
-            obses = self.obses[index*batch_size:last_index]
-            actions = self.actions[index*batch_size:last_index]
-
-            obs_flat = np.array([gym_utils.flatten(self.obs_space, i) for i in obses])
-            
-            inputs = np.concatenate([obs_flat, actions], axis=-1)
-            
-            pred_reward = predictor.r_hat_batch(inputs)
-            self.rewards[index*batch_size:last_index] = pred_reward
+        elapsed_time = max(time.time() - start_time, 1e-6)
+        print(f'Relabeled {num_rows} transitions in {elapsed_time:.2f}s ({num_rows/elapsed_time:.0f} per second)')
+        return num_rows / elapsed_time
+
+    def set_rewards(self, idxs, rewards, version):
+        with self.lock:
+            self.rewards[idxs] = rewards
+            self.reward_versions[idxs] = version
+
+    def set_predictor(self, predictor):
+        # lazy relabeling: rows are relabeled when they are sampled (or swept) after the predictor changed version
+        self.predictor = predictor
+
+    def refresh_rewards(self, idxs):
+        # relabel, in one batched call, the rows of idxs predicted by an older version of the reward model
+        if self.predictor is None:
+            return
+        with self.lock:
+            version = self.predictor.model_version
+            stale = np.unique(idxs[self.reward_versions[idxs] != version])
+            stale = stale[self.valid(stale)]
+            if len(stale) == 0:
+                return
+            self.rewards[stale] = self.predict_rewards(self.predictor, self.reward_obs(stale), self.actions[stale])
+            self.reward_versions[stale] = version
+
+    def sweep(self, num_rows):
+        # refresh the next num_rows rows, for the time the loop has to spare
+        if self.predictor is None or len(self) == 0:
+            return
+        idxs = (self.sweep_idx + np.arange(min(num_rows, len(self)))) % len(self)
+        self.sweep_idx = (idxs[-1] + 1) % len(self)
+        self.refresh_rewards(idxs)
             
+    def gather(self, idxs):
+        # the rows idxs as numpy arrays, in the order sample returns them
+        return (self.observations(idxs), self.actions[idxs], self.rewards[idxs],
+                self.observations(idxs, next_obs=True), self.not_dones[idxs], self.not_dones_no_max[idxs])
+
     def sample(self, batch_size):
-        idxs = np.random.randint(0,
-                                 self.capacity if self.full else self.idx,
-                                 size=batch_size)
-
-        obses = torch.as_tensor(self.obses[idxs], device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        next_obses = torch.as_tensor(self.next_obses[idxs],
-                                     device=self.device).float()
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
-        not_dones_no_max = torch.as_tensor(self.not_dones_no_max[idxs],
-                                           device=self.device)
-
-        return obses, actions, rewards, next_obses, not_dones, not_dones_no_max
+        with self.lock:
+            idxs = self.sample_idxs(batch_size)
+            self.refresh_rewards(idxs)
+            batch = self.gather(idxs)
+
+        obses, actions, rewards, next_obses, not_dones, not_dones_no_max = [torch.as_tensor(x, device=self.device) for x in batch]
+        return obses.float(), actions, rewards, next_obses.float(), not_dones, not_dones_no_max
     
     def sample_state_ent(self, batch_size):
-        idxs = np.random.randint(0,
-                                 self.capacity if self.full else self.idx,
-                                 size=batch_size)
-
-        obses = torch.as_tensor(self.obses[idxs], device=self.device).float()
-        actions = torch.as_tensor(self.actions[idxs], device=self.device)
-        rewards = torch.as_tensor(self.rewards[idxs], device=self.device)
-        next_obses = torch.as_tensor(self.next_obses[idxs],
-                                     device=self.device).float()
-        not_dones = torch.as_tensor(self.not_dones[idxs], device=self.device)
-        not_dones_no_max = torch.as_tensor(self.not_dones_no_max[idxs],
-                                           device=self.device)
-        
-        if self.full:
-            full_obs = self.obses
-        else:
-            full_obs = self.obses[: self.idx]
-        full_obs = torch.as_tensor(full_obs, device=self.device)
+        obses, actions, rewards, next_obses, not_dones, not_dones_no_max = self.sample(batch_size)
+        full_obs = torch.as_tensor(self.full_observations(), device=self.device)
         
         return obses, full_obs, actions, rewards, next_obses, not_dones, not_dones_no_max
     
+    def meta_path(self, model_dir, step):
+        return '%s/replay_buffer%s_meta.pt' % (model_dir, step)
+
+    def meta_keys(self):
+        return ['idx', 'full']
+
+    def snapshot_dir(self, model_dir, step):
+        return '%s/replay_buffer%s' % (model_dir, step)
+
+    def save_mapped(self, model_dir, step):
+        # the snapshot is a copy of the storage_dir files, flushed first, and a small metadata file pointing at it.
+        # files are copied by the OS, the arrays are never read into memory
+        snapshot_dir = self.snapshot_dir(model_dir, step)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        for k in self.array_keys:
+            array = self.__dict__[k]
+            path = os.path.join(snapshot_dir, f'{k}.npy')
+            if isinstance(array, np.memmap):
+                array.flush()
+                shutil.copyfile(array.filename, path)
+            else:
+                np.save(path, array)
+        meta = {k: self.__dict__[k] for k in self.meta_keys()}
+        meta.update(storage_dir=os.path.abspath(snapshot_dir), array_keys=self.array_keys)
+        torch.save(meta, self.meta_path(model_dir, step))
+
+    def load_mapped(self, model_dir, step):
+        # the files of a snapshot saved by save_mapped are copied into storage_dir and mapped from there,
+        # so the run never writes into a snapshot
+        meta = torch.load(self.meta_path(model_dir, step))
+        for k in meta['array_keys']:
+            path = os.path.join(self.storage_dir, f'{k}.npy')
+            tmp_path = os.path.join(self.storage_dir, f'{k}.tmp.npy')
+            shutil.copyfile(os.path.join(meta['storage_dir'], f'{k}.npy'), tmp_path)
+            os.replace(tmp_path, path)
+            setattr(self, k, np.load(path, mmap_mode='r+'))
+        for k in self.meta_keys():
+            setattr(self, k, meta[k])
+
+    def close(self):
+        # removes the files of storage_dir, the buffer can not be used anymore
+        if self.storage_dir is not None:
+            for k in self.array_keys:
+                setattr(self, k, None)
+            shutil.rmtree(self.storage_dir, ignore_errors=True)
+            self.storage_dir = None
+
     def save(self, model_dir, step):
+        if self.storage_dir is not None:
+            return self.save_mapped(model_dir, step)
         keys_to_save = ['obses', 'next_obses', 'actions', 'rewards', 'not_dones', 'not_dones_no_max', 'idx']
         payload = {k: self.__dict__[k] for k in keys_to_save}
         torch.save(payload, '%s/replay_buffer%s.pt' % (model_dir, step), pickle_protocol=4)
         
     def load(self, model_dir, step):
+        if os.path.exists(self.meta_path(model_dir, step)):
+            return self.load_mapped(model_dir, step)
         keys_to_load = ['obses', 'next_obses', 'actions', 'rewards', 'not_dones', 'not_dones_no_max', 'idx']
-        payload = torch.load('%s/replay_buffer%s.pt' % (model_dir, step))
+        payload = torch.load('%s/replay_buffer%s.pt' % (model_dir, step), weights_only=False)
         self.obses, self.next_obses, self.actions, self.rewards, self.not_dones, self.not_dones_no_max, self.idx = [payload[k] for k in keys_to_load]
 
         self.idx = (self.idx + 1) % self.capacity
-        self.full = False or self.idx == 0
\ No newline at end of file
+        self.full = False or self.idx == 0
+
+class TorchReplayBuffer(ReplayBuffer):
+    """Replay buffer whose arrays are tensors preallocated on the device, written in place and sampled with index_select."""
+    def __init__(self, obs_space, obs_shape, action_shape, action_type, capacity, device, window=1, relabel_batch_size=10000, obs_dtype=np.float32):
+        super().__init__(obs_space, obs_shape, action_shape, action_type, capacity, device, window=window,
+                         relabel_batch_size=relabel_batch_size, obs_dtype=obs_dtype)
+
+    def allocate(self, name, shape, dtype):
+        # the reward version stamps are bookkeeping of the host, they stay numpy
+        if name == 'reward_versions':
+            return super().allocate(name, shape, dtype)
+        array = torch.empty(shape, dtype=torch.from_numpy(np.empty(0, dtype=dtype)).dtype, device=self.device)
+        self.array_keys.append(name)
+        setattr(self, name, array)
+        return array
+
+    def add(self, obs, action, reward, next_obs, done, done_no_max):
+        with self.lock:
+            self.obses[self.idx].copy_(torch.as_tensor(obs))
+            self.actions[self.idx].copy_(torch.as_tensor(action))
+            self.rewards[self.idx].copy_(torch.as_tensor(reward))
+            self.next_obses[self.idx].copy_(torch.as_tensor(next_obs))
+            self.not_dones[self.idx] = float(not done)
+            self.not_dones_no_max[self.idx] = float(not done_no_max)
+            self.reward_versions[self.idx] = self.current_version()
+
+            self.idx = (self.idx + 1) % self.capacity
+            self.full = self.full or self.idx == 0
+
+    def add_batch(self, obs, action, reward, next_obs, done, done_no_max):
+        with self.lock:
+            rows = (self.idx + np.arange(self.window)) % self.capacity
+            self.reward_versions[rows] = self.current_version()
+            rows = torch.as_tensor(rows, device=self.device)
+            values = {'obses': obs, 'actions': action, 'rewards': reward, 'next_obses': next_obs,
+                      'not_dones': np.asarray(done) <= 0, 'not_dones_no_max': np.asarray(done_no_max) <= 0}
+            for k, v in values.items():
+                array = self.__dict__[k]
+                v = torch.as_tensor(v).to(self.device, array.dtype).reshape(self.window, *array.shape[1:])
+                array.index_copy_(0, rows, v)
+            self.full = self.full or self.idx + self.window >= self.capacity
+            self.idx = (self.idx + self.window) % self.capacity
+
+    def predict_rewards(self, predictor, obses, actions):
+        if not isinstance(self.obs_space, gym.spaces.Box):
+            rewards = super().predict_rewards(predictor, utils.to_np(obses), utils.to_np(actions))
+            return torch.as_tensor(rewards, device=self.device)
+        inputs = torch.cat([obses.reshape(len(obses), -1).float(), actions.float()], dim=-1)
+        return predictor.r_hat_batch(inputs).to(self.device)
+
+    def set_rewards(self, idxs, rewards, version):
+        super().set_rewards(idxs, torch.as_tensor(rewards, device=self.device), version)
+
+    def gather(self, idxs):
+        idxs = torch.as_tensor(idxs, device=self.device)
+        keys = ['obses', 'actions', 'rewards', 'next_obses', 'not_dones', 'not_dones_no_max']
+        return tuple(self.__dict__[k].index_select(0, idxs) for k in keys)
+
+    def save(self, model_dir, step):
+        # saved as numpy arrays, like the snapshots of ReplayBuffer
+        keys_to_save = ['obses', 'next_obses', 'actions', 'rewards', 'not_dones', 'not_dones_no_max', 'idx']
+        payload = {k: utils.to_np(self.__dict__[k]) if torch.is_tensor(self.__dict__[k]) else self.__dict__[k] for k in keys_to_save}
+        torch.save(payload, '%s/replay_buffer%s.pt' % (model_dir, step), pickle_protocol=4)
+
+    def load(self, model_dir, step):
+        super().load(model_dir, step)
+        for k in self.array_keys:
+            if k != 'reward_versions' and not torch.is_tensor(self.__dict__[k]):
+                setattr(self, k, torch.as_tensor(np.array(self.__dict__[k]), device=self.device))
+
+class FrameReplayBuffer(ReplayBuffer):
+    """Pixel replay buffer storing every frame once, the stacked observations are assembled when sampled."""
+    def __init__(self, obs_space, obs_shape, action_shape, action_type, capacity, device, frame_stack=1, frame_capacity=0, 
+                 relabel_batch_size=10000, obs_dtype=np.uint8, storage_dir=None):
+        self.frame_stack = int(frame_stack)
+        # one frame per transition plus the first frame of every episode (0 leaves room for episodes of 4+ steps)
+        self.frame_capacity = int(frame_capacity) if frame_capacity > 0 else capacity + capacity // 4 + self.frame_stack
+        super().__init__(obs_space, obs_shape, action_shape, action_type, capacity, device,
+                         relabel_batch_size=relabel_batch_size, obs_dtype=obs_dtype, storage_dir=storage_dir)
+
+    def allocate_obs(self, obs_shape, obs_dtype):
+        self.allocate('frames', (self.frame_capacity, *obs_shape), obs_dtype)
+        # frames are numbered by a global counter, frame f lives at f % frame_capacity
+        self.allocate('frame_idx', (self.capacity,), np.int64)[:] = 0  # frame of obs, next_obs is frame_idx + 1
+        self.allocate('ep_start', (self.capacity,), np.int64)[:] = 0   # first frame of the episode of the row
+        self.frames_written = 0
+        self.episode_start = -1  # first frame of the running episode, -1 between episodes
+        self.stack_offsets = np.arange(self.frame_stack - 1, -1, -1)
+
+    def write_frame(self, frame):
+        np.copyto(self.frames[self.frames_written % self.frame_capacity], frame)
+        self.frames_written += 1
+        return self.frames_written - 1
+
+    def add(self, obs, action, reward, next_obs, done, done_no_max):
+        with self.lock:
+            if self.episode_start < 0:
+                self.episode_start = self.write_frame(obs)
+            self.frame_idx[self.idx] = self.frames_written - 1
+            self.ep_start[self.idx] = self.episode_start
+            self.write_frame(next_obs)
+            np.copyto(self.actions[self.idx], action)
+            np.copyto(self.rewards[self.idx], reward)
+            np.copyto(self.not_dones[self.idx], not done)
+            np.copyto(self.not_dones_no_max[self.idx], not done_no_max)
+            self.reward_versions[self.idx] = self.current_version()
+            if done or done_no_max:
+                self.episode_start = -1
+
+            self.idx = (self.idx + 1) % self.capacity
+            self.full = self.full or self.idx == 0
+
+    def add_batch(self, obs, action, reward, next_obs, done, done_no_max):
+        # the frames of add, row after row, written with one indexed copy per array
+        num_rows = len(obs)
+        if num_rows == 0:
+            return
+        ended = (np.reshape(done, -1) > 0) | (np.reshape(done_no_max, -1) > 0)
+        # a row starting an episode writes its obs frame before its next_obs frame
+        starts = np.concatenate([[self.episode_start < 0], ended[:-1]])
+        with self.lock:
+            frame_idx = self.frames_written + np.arange(num_rows) + np.cumsum(starts) - 1
+            ep_start = np.where(starts, frame_idx, -1)
+            if not starts[0]:
+                ep_start[0] = self.episode_start
+            ep_start = np.maximum.accumulate(ep_start)
+            # frames and rows overwritten within the batch are skipped
+            oldest = frame_idx[-1] + 1 - self.frame_capacity
+            obs_rows = np.flatnonzero(starts & (frame_idx >= oldest))
+            next_rows = np.flatnonzero(frame_idx + 1 >= oldest)
+            self.frames[frame_idx[obs_rows] % self.frame_capacity] = obs[obs_rows]
+            self.frames[(frame_idx[next_rows] + 1) % self.frame_capacity] = next_obs[next_rows]
+            self.frames_written = int(frame_idx[-1]) + 2
+
+            keep = np.arange(max(num_rows - self.capacity, 0), num_rows)
+            rows = (self.idx + keep) % self.capacity
+            self.frame_idx[rows] = frame_idx[keep]
+            self.ep_start[rows] = ep_start[keep]
+            self.actions[rows] = action[keep]
+            self.rewards[rows] = reward[keep]
+            self.not_dones[rows] = done[keep] <= 0
+            self.not_dones_no_max[rows] = done_no_max[keep] <= 0
+            self.reward_versions[rows] = self.current_version()
+            self.episode_start = -1 if ended[-1] else int(ep_start[-1])
+
+            self.full = self.full or self.idx + num_rows >= self.capacity
+            self.idx = (self.idx + num_rows) % self.capacity
+
+    def stack_ids(self, idxs, next_obs=False):
+        # frames of the stack of each row, the first frame of the episode repeats at its start
+        last = self.frame_idx[idxs] + int(next_obs)
+        ids = last[:, None] - self.stack_offsets[None, :]
+        return np.maximum(ids, self.ep_start[idxs][:, None])
+
+    def valid(self, idxs):
+        # rows whose oldest stacked frame has not been overwritten yet
+        oldest = self.frames_written - self.frame_capacity
+        return self.stack_ids(idxs)[:, 0] >= oldest
+
+    def sample_idxs(self, batch_size):
+        idxs = super().sample_idxs(batch_size)
+        for _ in range(10):
+            invalid = ~self.valid(idxs)
+            if not invalid.any():
+                return idxs
+            idxs[invalid] = super().sample_idxs(int(invalid.sum()))
+        invalid = ~self.valid(idxs)
+        if invalid.any():
+            # mostly overwritten frames: draw the rest among the valid rows
+            valid_rows = np.flatnonzero(self.valid(np.arange(len(self))))
+            idxs[invalid] = np.random.choice(valid_rows, size=int(invalid.sum()))
+        return idxs
+
+    def observations(self, idxs, next_obs=False):
+        idxs = np.arange(len(self))[idxs] if isinstance(idxs, slice) else np.asarray(idxs)
+        stacked = self.frames[self.stack_ids(idxs, next_obs) % self.frame_capacity]  # (n, k, H, W, C)
+        # frames concatenated on the channel axis, oldest first
+        return np.concatenate(np.moveaxis(stacked, 1, 0), axis=-1)
+
+    def reward_obs(self, idxs):
+        # the reward model is trained on single frames
+        return self.frames[self.frame_idx[idxs] % self.frame_capacity]
+
+    def full_observations(self):
+        return self.frames[: min(self.frames_written, self.frame_capacity)]
+
+    def meta_keys(self):
+        return ['idx', 'full', 'frames_written']
+
+    def save(self, model_dir, step):
+        if self.storage_dir is not None:
+            return self.save_mapped(model_dir, step)
+        keys_to_save = ['frames', 'frame_idx', 'ep_start', 'frames_written', 'actions', 'rewards', 'not_dones', 'not_dones_no_max', 'idx', 'full']
+        payload = {k: self.__dict__[k] for k in keys_to_save}
+        torch.save(payload, '%s/replay_buffer%s.pt' % (model_dir, step), pickle_protocol=4)
+
+    def load(self, model_dir, step):
+        if os.path.exists(self.meta_path(model_dir, step)):
+            self.load_mapped(model_dir, step)
+            self.episode_start = -1
+            return
+        keys_to_load = ['frames', 'frame_idx', 'ep_start', 'frames_written', 'actions', 'rewards', 'not_dones', 'not_dones_no_max', 'idx', 'full']
+        payload = torch.load('%s/replay_buffer%s.pt' % (model_dir, step), weights_only=False)
+        (self.frames, self.frame_idx, self.ep_start, self.frames_written, self.actions, self.rewards,
+         self.not_dones, self.not_dones_no_max, self.idx, self.full) = [payload[k] for k in keys_to_load]
+
+        # the run goes on with a new episode
+        self.episode_start = -1
+
+class PendingRewards(object):
+    """Replay rows added with a placeholder reward, predicted later in one batched call."""
+    def __init__(self, replay_buffer, predictor, flush_every):
+        self.replay_buffer = replay_buffer
+        self.predictor = predictor
+        self.flush_every = flush_every
+        self.rows = []
+        self.inputs = []
+
+    def add(self, row, obs_flat, action):
+        # row was just written to the replay buffer, returns the predicted rewards of a flush (0 otherwise)
+        self.replay_buffer.reward_versions[row] = -1
+        self.rows.append(row)
+        self.inputs.append(np.concatenate([obs_flat, action], axis=-1))
+        if len(self.rows) >= self.flush_every:
+            return self.flush()
+        return 0.0
+
+    def flush(self):
+        # write the predicted rewards of all pending rows, returns their sum
+        if len(self.rows) == 0:
+            return 0.0
+        rewards = utils.to_np(self.predictor.r_hat_batch(np.stack(self.inputs)))
+        self.replay_buffer.set_rewards(np.array(self.rows), rewards, self.predictor.model_version)
+        self.rows, self.inputs = [], []
+        return float(rewards.sum())
+
+class BatchPrefetcher(object):
+    """Samples the agent's batches of a replay buffer ahead in a background thread, with the replay buffer interface."""
+    def __init__(self, replay_buffer, batch_size, depth=2):
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.device = torch.device(replay_buffer.device)
+        # batches are gathered on the cpu, in pinned memory when they go to a gpu
+        self.pin = self.device.type == 'cuda'
+        self.batches = queue.Queue(maxsize=depth)
+        self.generation = 0     # bumped by reset, batches of an older generation are dropped
+        self.error = None
+        self.stopped = False
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+
+    def _work(self):
+        # the worker never calls the reward model, stale rewards are refreshed by sample in the main thread
+        rb = self.replay_buffer
+        try:
+            while not self.stopped:
+                with rb.lock:
+                    idxs = rb.sample_idxs(self.batch_size)
+                    batch = rb.gather(idxs)
+                    generation = self.generation
+                batch = [torch.as_tensor(x) for x in batch]
+                if self.pin:
+                    batch = [x if x.is_cuda else x.pin_memory() for x in batch]
+                self._put((generation, idxs, batch))
+        except Exception as e:
+            self.error = e
+            self._put((None, None, None))
+
+    def _put(self, item):
+        # waits for room in the queue until the prefetcher is closed
+        while not self.stopped:
+            try:
+                self.batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def sample(self, batch_size):
+        if batch_size != self.batch_size:
+            return self.replay_buffer.sample(batch_size)
+        self.start()
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                # the wakeup of an error may have been drained by reset
+                generation, idxs, batch = self.batches.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if batch is None:
+                continue
+            # batches gathered before an eager relabel are dropped
+            if generation == self.generation:
+                break
+
+        rb = self.replay_buffer
+        if rb.predictor is not None:
+            # lazy relabeling: rows predicted by an older reward model are relabeled here, in the thread using the model
+            with rb.lock:
+                rb.refresh_rewards(idxs)
+                batch[2] = torch.as_tensor(rb.rewards[idxs])
+        obses, actions, rewards, next_obses, not_dones, not_dones_no_max = [x.to(self.device, non_blocking=self.pin) for x in batch]
+        return obses.float(), actions, rewards, next_obses.float(), not_dones, not_dones_no_max
+
+    def sample_state_ent(self, batch_size):
+        obses, actions, rewards, next_obses, not_dones, not_dones_no_max = self.sample(batch_size)
+        with self.replay_buffer.lock:
+            full_obs = torch.as_tensor(self.replay_buffer.full_observations(), device=self.device)
+
+        return obses, full_obs, actions, rewards, next_obses, not_dones, not_dones_no_max
+
+    def reset(self):
+        # the rewards of the buffer changed (eager relabel), the batches sampled before are stale
+        with self.replay_buffer.lock:
+            self.generation += 1
+        while True:
+            try:
+                self.batches.get_nowait()
+            except queue.Empty:
+                break
+
+    def close(self):
+        self.stopped = True
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
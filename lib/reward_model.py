@@ -4,10 +4,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 import time
 import copy
+import math
+import weakref
 #import lib.human_interface as ui
 from gymnasium.spaces import utils as gym_utils
-
-device = 'cpu'
+from lib.trajectory_store import TrajectoryStore
+from lib.query_index import QueryIndex
+from lib.teacher import SyntheticTeacher
+from lib.segment_embedding import SegmentEmbeddingStore
+from lib.inference import wide_ensemble, prepare_checked
 
 def gen_net(in_size=1, out_size=1, H=128, n_layers=3, activation='tanh'):
     net = []
@@ -25,71 +30,153 @@ def gen_net(in_size=1, out_size=1, H=128, n_layers=3, activation='tanh'):
 
     return net
 
+class EnsembleLinear(nn.Module):
+    """A stack of independent linear layers, one per ensemble member, evaluated with a single batched matmul."""
+    def __init__(self, ensemble_size, in_size, out_size):
+        super().__init__()
+        self.ensemble_size = ensemble_size
+        self.in_size = in_size
+        self.out_size = out_size
+        # same layout as nn.Linear with a leading ensemble dimension
+        self.weight = nn.Parameter(torch.empty(ensemble_size, out_size, in_size))
+        self.bias = nn.Parameter(torch.empty(ensemble_size, out_size))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # initialise every member exactly like a separate nn.Linear
+        bound = 1 / math.sqrt(self.in_size) if self.in_size > 0 else 0
+        for member in range(self.ensemble_size):
+            nn.init.kaiming_uniform_(self.weight[member], a=math.sqrt(5))
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        # x is either (N, in) and shared by all members or (ensemble_size, N, in)
+        return torch.matmul(x, self.weight.transpose(1, 2)) + self.bias.unsqueeze(1)
+
+    def extra_repr(self):
+        return f'ensemble_size={self.ensemble_size}, in_size={self.in_size}, out_size={self.out_size}'
+
+def gen_ensemble_net(ensemble_size, in_size=1, out_size=1, H=128, n_layers=3, activation='tanh'):
+    # same architecture as gen_net, with every member stacked into one set of parameters
+    net = []
+    for i in range(n_layers):
+        net.append(EnsembleLinear(ensemble_size, in_size, H))
+        net.append(nn.LeakyReLU())
+        in_size = H
+    net.append(EnsembleLinear(ensemble_size, in_size, out_size))
+    if activation == 'tanh':
+        net.append(nn.Tanh())
+    elif activation == 'sig':
+        net.append(nn.Sigmoid())
+    else:
+        net.append(nn.ReLU())
+
+    return net
+
 def KCenterGreedy(obs, full_obs, num_new_sample):
+    obs = torch.as_tensor(obs).float()
+    full_obs = torch.as_tensor(full_obs, device=obs.device).float()
     selected_index = []
-    current_index = list(range(obs.shape[0]))
-    new_obs = obs
-    new_full_obs = full_obs
-    start_time = time.time()
-    for count in range(num_new_sample):
-        dist = compute_smallest_dist(new_obs, new_full_obs)
-        max_index = torch.argmax(dist)
-        max_index = max_index.item()
-        
-        if count == 0:
+    with torch.no_grad():
+        # running distance of every candidate to its nearest center (labeled or already selected)
+        min_dist = compute_smallest_dist(obs, full_obs)
+        for count in range(min(num_new_sample, obs.shape[0])):
+            max_index = torch.argmax(min_dist).item()
             selected_index.append(max_index)
-        else:
-            selected_index.append(current_index[max_index])
-        current_index = current_index[0:max_index] + current_index[max_index+1:]
-        
-        new_obs = obs[current_index]
-        new_full_obs = np.concatenate([
-            full_obs, 
-            obs[selected_index]], 
-            axis=0)
+
+            # only the new center can bring candidates closer
+            new_dist = compute_smallest_dist(obs, obs[max_index:max_index+1])
+            min_dist = torch.minimum(min_dist, new_dist)
+            min_dist[selected_index] = -float('inf')
     return selected_index
 
-def compute_smallest_dist(obs, full_obs):
-    obs = torch.from_numpy(obs).float()
-    full_obs = torch.from_numpy(full_obs).float()
-    batch_size = 100
+def compute_smallest_dist(obs, full_obs, batch_size=1024):
+    obs = torch.as_tensor(obs).float()
+    full_obs = torch.as_tensor(full_obs, device=obs.device).float()
+    min_dist = torch.full((obs.shape[0],), float('inf'), device=obs.device)
     with torch.no_grad():
-        total_dists = []
-        for full_idx in range(len(obs) // batch_size + 1):
-            full_start = full_idx * batch_size
-            if full_start < len(obs):
-                full_end = (full_idx + 1) * batch_size
-                dists = []
-                for idx in range(len(full_obs) // batch_size + 1):
-                    start = idx * batch_size
-                    if start < len(full_obs):
-                        end = (idx + 1) * batch_size
-                        dist = torch.norm(
-                            obs[full_start:full_end, None, :].to(device) - full_obs[None, start:end, :].to(device), dim=-1, p=2
-                        )
-                        dists.append(dist)
-                dists = torch.cat(dists, dim=1)
-                small_dists = torch.torch.min(dists, dim=1).values
-                total_dists.append(small_dists)
-                
-        total_dists = torch.cat(total_dists)
-    return total_dists.unsqueeze(1)
+        for start in range(0, full_obs.shape[0], batch_size):
+            # matmul based euclidean distances against one chunk of the reference set
+            dist = torch.cdist(obs, full_obs[start:start+batch_size], compute_mode='use_mm_for_euclid_dist')
+            min_dist = torch.minimum(min_dist, dist.min(dim=1).values)
+    return min_dist
+
+def random_projection(parts, projection_dim, seed=0, chunk_size=4096, device='cpu'):
+    # Johnson-Lindenstrauss projection of the column-wise concatenation of parts to projection_dim features.
+    # The gaussian matrix is drawn chunk by chunk from a seeded generator, so it is never stored whole
+    # and every call with the same seed and widths uses the same projection.
+    generator = torch.Generator().manual_seed(seed)
+    num_rows = parts[0].shape[0]
+    projected = torch.zeros((num_rows, projection_dim), device=device)
+    with torch.no_grad():
+        for part in parts:
+            for start in range(0, part.shape[1], chunk_size):
+                chunk = torch.as_tensor(part[:, start:start+chunk_size], device=device).float()
+                matrix = torch.randn((chunk.shape[1], projection_dim), generator=generator).to(device)
+                projected += chunk @ matrix
+    return projected / math.sqrt(projection_dim)
+
+class SegmentReturnCache(object):
+    """Per-step ensemble predictions over the trajectory store, with prefix sums to get segment returns in O(1)."""
+    def __init__(self, traj_store, ensemble_size):
+        self.traj_store = traj_store
+        self.capacity = traj_store.capacity
+        self.step_preds = np.zeros((ensemble_size, self.capacity), dtype=np.float32)
+        self.prefix = np.zeros((ensemble_size, self.capacity + 1), dtype=np.float64)
+        self.version = -1   # model version the predictions were made with
+        self.ptr = 0        # store rows covered by the predictions
+
+    def refresh(self, model, batch_size=4096):
+        # ptr is read and the new rows copied under the store lock (add bumps ptr before writing the row),
+        # the predictions are made outside of it
+        with self.traj_store.lock:
+            ptr = self.traj_store.ptr
+            if self.version != model.model_version or ptr < self.ptr or ptr - self.ptr >= self.capacity:
+                # new weights (or a reloaded store): predict every stored row again
+                new_rows = np.arange(max(0, ptr - self.capacity), ptr) % self.capacity
+            else:
+                # same weights: only the rows written since the last refresh
+                new_rows = np.arange(self.ptr, ptr) % self.capacity
+            if len(new_rows) == 0 and self.version == model.model_version:
+                return
+            inputs = self.traj_store.inputs[new_rows]
+        
+        with torch.no_grad():
+            for start in range(0, len(new_rows), batch_size):
+                rows = new_rows[start:start+batch_size]
+                preds = model.r_hat_ensemble(inputs[start:start+batch_size])
+                self.step_preds[:, rows] = preds[..., 0].cpu().numpy()
+        np.cumsum(self.step_preds, axis=1, dtype=np.float64, out=self.prefix[:, 1:])
+        self.version, self.ptr = model.model_version, ptr
+
+    def window_sums(self, starts, length):
+        # per member sum of the predictions of length consecutive rows from each physical start, wrapping around the ring
+        ends = starts + length
+        return (self.prefix[:, np.minimum(ends, self.capacity)] - self.prefix[:, starts]
+                + self.prefix[:, np.maximum(ends - self.capacity, 0)])
 
 class RewardModel:
     def __init__(self, obs_space, ds, da, action_type,
                  ensemble_size=3, lr=3e-4, mb_size = 128, size_segment=1, 
-                 env=None, seed = 0, max_size=100, activation='tanh', capacity=1e4,  
+                 env=None, seed = 0, max_size=100, activation='tanh', capacity=1e4, traj_capacity=1e5,
                  large_batch=1, label_margin=0.0, reward_scale=1, reward_intercept=0, human_teacher=False,
                  teacher_beta=-1, teacher_gamma=1, teacher_eps_mistake=0, 
-                 teacher_eps_skip=0, teacher_eps_equal=0, ui_module = None):
+                 teacher_eps_skip=0, teacher_eps_equal=0, kcenter_dim=0, kcenter_embedding='none', embedding_dim=32, num_candidates=0, dedup=True, dedup_quantum=0.0, val_ratio=0.0, pref_archive='float16', device='cpu', inference_mode='none', inference_tol=0.01, obs_scale=1.0, ui_module = None):
         
         # train data is trajectories, must process to sa and s..
         self.obs_space = obs_space
+        self.device = torch.device(device)
+        self.staging = {}   # name -> (pinned host buffer, event of its last copy), only used on cuda
+        # r_hat and r_hat_batch through an int8 / traced copy of the ensemble, CPU only, training keeps float32
+        self.inference_mode = inference_mode if self.device.type == 'cpu' else 'none'
+        self.inference_tol = inference_tol
+        self.inference = None
+        self.inference_version = -1
         self.ds = ds
         self.da = da
         self.de = ensemble_size
         self.lr = lr
-        self.ensemble = []
+        self.ensemble = None
         self.paramlst = []
         self.opt = None
         self.model = None
@@ -100,19 +187,37 @@ class RewardModel:
         
         #obs_dtype = np.float32 if len(obs_shape) == 1 else np.uint8
         #self.seg_dtype = np.float32 if action_type == 'Cont' else np.uint8
-        self.seg_dtype = np.float32
+        # obs_scale != 1: pixel states and discrete actions are stored as uint8, states are scaled at the ensemble input
+        self.obs_scale = obs_scale
+        self.seg_dtype = np.uint8 if obs_scale != 1 else np.float32
 
         self.capacity = int(capacity)
-        self.buffer_seg1 = np.empty((self.capacity, size_segment, self.ds+self.da), dtype=self.seg_dtype)
-        self.buffer_seg2 = np.empty((self.capacity, size_segment, self.ds+self.da), dtype=self.seg_dtype)
+        # labeled pairs keep (trajectory id, offset, length) references, segments are gathered from the trajectory store
+        self.buffer_ref1 = np.zeros((self.capacity, 3), dtype=np.int64)
+        self.buffer_ref2 = np.zeros((self.capacity, 3), dtype=np.int64)
         self.buffer_label = np.empty((self.capacity, 1), dtype=np.float32)
         self.buffer_index = 0
         self.buffer_full = False
+        # segments whose trajectory left the store are kept as compact copies, or their label is dropped
+        self.pref_archive = pref_archive                                # 'float32', 'float16', 'uint8' or 'none'
+        self.archive = {}                                               # (row, side) -> archived segment
+        self.buffer_archived = np.zeros((self.capacity, 2), dtype=bool)
+        self.buffer_dropped = np.zeros(self.capacity, dtype=bool)
+        # bookkeeping for early stopped, incremental training
+        self.val_ratio = val_ratio                                      # fraction of labels held out for validation
+        self.buffer_val = np.zeros(self.capacity, dtype=bool)           # label is in the validation split
+        self.buffer_round = np.zeros(self.capacity, dtype=np.int64)     # put_queries call that added the label
+        self.label_round = 0
+        self.fit_round = 0                                              # last round seen by fit
+        self.model_version = 0                                          # bumped every time the weights change
+        self.journal = None                                             # LabelJournal receiving every labeled batch
+        self.shadows = weakref.WeakSet()                                # live shadow copies, see archive_episode
                 
         self.construct_ensemble()
-        self.inputs = []
-        self.targets = []
-        self.snapshots =[]
+        # trajectories used to sample queries: flat (traj_capacity, ds+da) rows plus an episode table
+        self.traj_store = TrajectoryStore(obs_space, self.ds, self.da, traj_capacity, max_size, dtype=self.seg_dtype)
+        self.traj_store.on_evict = self.archive_episode
+        self.return_cache = SegmentReturnCache(self.traj_store, self.de)
         self.raw_actions = []
         self.img_inputs = []
         self.mb_size = mb_size
@@ -125,6 +230,14 @@ class RewardModel:
         self.best_label = []
         self.best_action = []
         self.large_batch = large_batch
+        self.kcenter_dim = kcenter_dim  # random projection size of k-center features, 0 keeps the raw states
+        # cached low dimensional segment embeddings used by k-center instead of the flattened states
+        self.embeddings = None
+        if kcenter_embedding != 'none':
+            self.embeddings = SegmentEmbeddingStore(self.capacity, self.ds, self.size_segment, mode=kcenter_embedding,
+                                                    dim=embedding_dim, seed=seed, device=self.device)
+        self.num_candidates = num_candidates    # pairs scored by uncertainty sampling, 0 uses mb_size*large_batch
+        self.query_index = QueryIndex(dedup_quantum) if dedup else None    # pairs already shown to the labeler
         
         self.env = env
         self.seed = seed
@@ -137,6 +250,7 @@ class RewardModel:
         self.teacher_eps_skip = teacher_eps_skip
         self.teacher_thres_skip = 0
         self.teacher_thres_equal = 0
+        self.teacher = SyntheticTeacher(teacher_beta, teacher_gamma, teacher_eps_mistake, device=self.device)
         
         self.label_margin = label_margin
         self.label_target = 1 - 2*self.label_margin
@@ -162,544 +276,857 @@ class RewardModel:
         self.teacher_thres_equal = new_margin * self.teacher_eps_equal
         
     def construct_ensemble(self):
-        for i in range(self.de):
-            model = nn.Sequential(*gen_net(in_size=self.ds+self.da, 
-                                           out_size=1, H=256, n_layers=3, 
-                                           activation=self.activation)).float().to(device)
-            self.ensemble.append(model)
-            self.paramlst.extend(model.parameters())
+        # all members live in one stacked network so that they are evaluated in a single pass
+        self.ensemble = nn.Sequential(*gen_ensemble_net(ensemble_size=self.de,
+                                                        in_size=self.ds+self.da, 
+                                                        out_size=1, H=256, n_layers=3, 
+                                                        activation=self.activation)).float().to(self.device)
+        self.paramlst = list(self.ensemble.parameters())
             
         self.opt = torch.optim.Adam(self.paramlst, lr = self.lr)
+
+    def stage(self, x, name='input'):
+        # numpy batch -> tensor on the reward model device. float64 (MuJoCo observations) is cast to float32 on the
+        # host, mps has no float64 and it would double the copied bytes; uint8 pixels and float16 archives are copied as they are
+        if torch.is_tensor(x):
+            x = x.float() if x.dtype == torch.float64 else x
+            return x.to(self.device, non_blocking=True)
+        x = np.asarray(x)
+        x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32 if x.dtype == np.float64 else x.dtype))
+        if self.device.type != 'cuda':
+            return x.to(self.device)
+        
+        # on cuda the copy goes through a pinned buffer that is reused by batches of the same name
+        buffer, event = self.staging.get(name, (None, None))
+        if buffer is None or buffer.dtype != x.dtype or buffer.numel() < x.numel():
+            buffer = torch.empty(x.numel(), dtype=x.dtype).pin_memory()
+        elif event is not None:
+            event.synchronize()  # the previous copy out of this buffer must be done before overwriting it
+        pinned = buffer[:x.numel()].view(x.shape)
+        pinned.copy_(x)
+        out = pinned.to(self.device, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self.staging[name] = (buffer, event)
+        return out
             
     def add_data(self, obs, act, rew, terminated, truncated, snapshot):
-        #print(type(obs))
-        #print(obs.shape)
-        obs_flat = gym_utils.flatten(self.obs_space, obs)
-        #print(obs_flat.shape)
-        if act is np.uint8:
-            act = np.float32(act)
-        #print(act.shape)
-        sa_t = np.concatenate([obs_flat, act], axis=-1)
-        r_t = rew
-        
-        flat_input = sa_t.reshape(1, self.da+self.ds)
-        r_t = np.array(r_t)
-        flat_target = r_t.reshape(1, 1)
-        
-        init_data = len(self.inputs) == 0
-        if init_data:
-            self.inputs.append(flat_input)
-            self.targets.append(flat_target)
-            self.snapshots.append([snapshot])
-        elif terminated or truncated:
-            self.inputs[-1] = np.concatenate([self.inputs[-1], flat_input])
-            self.targets[-1] = np.concatenate([self.targets[-1], flat_target])
-            self.snapshots[-1].append(snapshot)
-            # FIFO on overflow
-            if len(self.inputs) > self.max_size:
-                self.inputs = self.inputs[1:]
-                self.targets = self.targets[1:]
-                self.snapshots = self.snapshots[1:]
-            self.inputs.append([])
-            self.targets.append([])
-            self.snapshots.append([])
-        else:
-            if len(self.inputs[-1]) == 0:
-                self.inputs[-1] = flat_input
-                self.targets[-1] = flat_target
-                self.snapshots[-1] = [snapshot]
-            else:
-                self.inputs[-1] = np.concatenate([self.inputs[-1], flat_input])
-                self.targets[-1] = np.concatenate([self.targets[-1], flat_target])
-                self.snapshots[-1].append(snapshot)   
+        # O(1): the step is written in place into the trajectory store, FIFO eviction is done by index
+        self.traj_store.add(obs, act, rew, snapshot, done=terminated or truncated)
                 
     def add_data_batch(self, obses, rewards, snapshots):
         num_env = obses.shape[0]
         for index in range(num_env):
-            self.inputs.append(obses[index])
-            self.targets.append(rewards[index])
-            self.snapshots.append(snapshots[index])
+            self.traj_store.add_episode(obses[index], rewards[index], snapshots[index])
         
     def get_rank_probability(self, x_1, x_2):
         # get probability x_1 > x_2
-        probs = []
-        for member in range(self.de):
-            probs.append(self.p_hat_member(x_1, x_2, member=member).cpu().numpy())
-        probs = np.array(probs)
+        probs = self.p_hat_member(x_1, x_2).cpu().numpy()
         
         return np.mean(probs, axis=0), np.std(probs, axis=0)
     
     def get_entropy(self, x_1, x_2):
         # get probability x_1 > x_2
-        probs = []
-        for member in range(self.de):
-            probs.append(self.p_hat_entropy(x_1, x_2, member=member).cpu().numpy())
-        probs = np.array(probs)
+        probs = self.p_hat_entropy(x_1, x_2).cpu().numpy()
+        return np.mean(probs, axis=0), np.std(probs, axis=0)
+
+    def segment_returns(self, refs):
+        # per member predicted return of referenced segments (de, n), from the cached prefix sums
+        self.return_cache.refresh(self)
+        seg_ids, offsets, lengths = refs[:, 0], refs[:, 1], refs[:, 2]
+        returns = np.empty((self.de, len(refs)), dtype=np.float64)
+
+        full = lengths == self.size_segment
+        if full.any():
+            starts = (self.traj_store.starts(seg_ids[full]) + offsets[full]) % self.traj_store.capacity
+            returns[:, full] = self.return_cache.window_sums(starts, self.size_segment)
+        if not full.all():
+            # padded segments include mean-state steps that are not in the store, evaluate them directly
+            short = ~full
+            with self.traj_store.lock:
+                sa_t, _, _ = self.get_segments(seg_ids[short], offsets[short], lengths[short])
+            with torch.no_grad():
+                returns[:, short] = self.r_hat_ensemble(sa_t).sum(axis=-2)[..., 0].cpu().numpy()
+        return returns
+
+    def pair_statistics(self, refs_1, refs_2):
+        # per member probability that segment 1 is preferred and entropy of the preference, (de, n) each
+        logits = np.stack([self.segment_returns(refs_1), self.segment_returns(refs_2)], axis=-1)
+        logits -= logits.max(axis=-1, keepdims=True)
+        log_probs = logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+        probs = np.exp(log_probs)
+        ent = np.abs((probs * log_probs).sum(axis=-1))
+        return probs[..., 0], ent
+
+    def get_rank_probability_refs(self, refs_1, refs_2):
+        probs, _ = self.pair_statistics(refs_1, refs_2)
         return np.mean(probs, axis=0), np.std(probs, axis=0)
 
-    def p_hat_member(self, x_1, x_2, member=-1):
+    def get_entropy_refs(self, refs_1, refs_2):
+        _, ent = self.pair_statistics(refs_1, refs_2)
+        return np.mean(ent, axis=0), np.std(ent, axis=0)
+
+    def p_hat_member(self, x_1, x_2, member=None):
         # softmaxing to get the probabilities according to eqn 1
         with torch.no_grad():
-            r_hat1 = self.r_hat_member(x_1, member=member)
-            r_hat2 = self.r_hat_member(x_2, member=member)
-            r_hat1 = r_hat1.sum(axis=1)
-            r_hat2 = r_hat2.sum(axis=1)
+            r_hat1 = self.r_hat_ensemble(x_1)
+            r_hat2 = self.r_hat_ensemble(x_2)
+            r_hat1 = r_hat1.sum(axis=-2)
+            r_hat2 = r_hat2.sum(axis=-2)
             r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
         
-        # taking 0 index for probability x_1 > x_2
-        return F.softmax(r_hat, dim=-1)[:,0]
+        # taking 0 index for probability x_1 > x_2, one row per member
+        probs = F.softmax(r_hat, dim=-1)[..., 0]
+        return probs if member is None else probs[member]
     
-    def p_hat_entropy(self, x_1, x_2, member=-1):
+    def p_hat_entropy(self, x_1, x_2, member=None):
         # softmaxing to get the probabilities according to eqn 1
         with torch.no_grad():
-            r_hat1 = self.r_hat_member(x_1, member=member)
-            r_hat2 = self.r_hat_member(x_2, member=member)
-            r_hat1 = r_hat1.sum(axis=1)
-            r_hat2 = r_hat2.sum(axis=1)
+            r_hat1 = self.r_hat_ensemble(x_1)
+            r_hat2 = self.r_hat_ensemble(x_2)
+            r_hat1 = r_hat1.sum(axis=-2)
+            r_hat2 = r_hat2.sum(axis=-2)
             r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
         
         ent = F.softmax(r_hat, dim=-1) * F.log_softmax(r_hat, dim=-1)
         ent = ent.sum(axis=-1).abs()
-        return ent
+        return ent if member is None else ent[member]
 
-    def r_hat_member(self, x, member=-1):
+    def scale_inputs(self, x):
+        # uint8 pixel states to [0, 1], the actions are left as they are
+        if self.obs_scale == 1:
+            return x
+        return torch.cat([x[..., :self.ds] / self.obs_scale, x[..., self.ds:]], axis=-1)
+
+    def r_hat_ensemble(self, x):
         # the network parameterizes r hat in eqn 1 from the paper
-        return self.ensemble[member](torch.from_numpy(x).float().to(device)) #Here lie the secrets
+        # every member sees the same input tensor: (..., ds+da) -> (de, ..., 1)
+        x = self.scale_inputs(self.stage(x).float())
+        lead_shape = x.shape[:-1]
+        r_hats = self.ensemble(x.reshape(-1, x.shape[-1])) #Here lie the secrets
+        return r_hats.reshape(self.de, *lead_shape, 1)
+    
+    def r_hat_per_member(self, x):
+        # every member gets its own input: (de, ..., ds+da) -> (de, ..., 1)
+        x = self.scale_inputs(self.stage(x, name='member_input').float())
+        lead_shape = x.shape[:-1]
+        r_hats = self.ensemble(x.reshape(self.de, -1, x.shape[-1]))
+        return r_hats.reshape(*lead_shape, 1)
+
+    def r_hat_member(self, x, member=-1):
+        return self.r_hat_ensemble(x)[member]
+
+    def inference_net(self):
+        # inference copy of the ensemble (one column per member), rebuilt and checked after every update
+        if self.inference_version != self.model_version:
+            if self.traj_store.num_rows > 0:
+                inputs = self.traj_store.inputs[:min(self.traj_store.num_rows, 1024)]
+                inputs = self.scale_inputs(torch.as_tensor(inputs).float())
+            else:
+                inputs = torch.randn(256, self.ds+self.da)
+            self.inference = prepare_checked(wide_ensemble(self.ensemble), self.inference_mode, inputs,
+                                             self.inference_tol, name='reward model')
+            self.inference_version = self.model_version
+        return self.inference
+
+    def r_hat_inference(self, x):
+        # (..., ds+da) -> (..., 1) mean over members, through the inference copy
+        x = self.scale_inputs(torch.as_tensor(x).float())
+        lead_shape = x.shape[:-1]
+        with torch.no_grad():
+            r_hats = self.inference_net()(x.reshape(-1, x.shape[-1]))
+        return r_hats.mean(axis=-1).reshape(*lead_shape, 1)
 
     def r_hat(self, x):
         # they say they average the rewards from each member of the ensemble, but I think this only makes sense if the rewards are already normalized
         # but I don't understand how the normalization should be happening right now :(
-        r_hats = []
-        for member in range(self.de):
-            r_hats.append(self.r_hat_member(x, member=member).detach().cpu().numpy())
-        r_hats = np.array(r_hats)
-        return np.mean(r_hats)
+        if self.inference_mode != 'none':
+            return self.r_hat_inference(x).mean().item()
+        with torch.no_grad():
+            r_hats = self.r_hat_ensemble(x)
+        return r_hats.mean().item()
     
     def r_hat_batch(self, x):
         # they say they average the rewards from each member of the ensemble, but I think this only makes sense if the rewards are already normalized
         # but I don't understand how the normalization should be happening right now :(
-        r_hats = []
-        for member in range(self.de):
-            r_hats.append(self.r_hat_member(x, member=member).detach().cpu().numpy())
-        r_hats = np.array(r_hats)
+        # the result stays on the reward model device, callers move it with utils.to_np when needed
+        if self.inference_mode != 'none':
+            return self.r_hat_inference(x)
+        with torch.no_grad():
+            r_hats = self.r_hat_ensemble(x)
 
-        return np.mean(r_hats, axis=0)
+        return r_hats.mean(axis=0)
     
     def save(self, model_dir, step):
         
-        payload = { f'member_{i}' : member.state_dict() for i, member in enumerate(self.ensemble)}
-        keys_to_save =['inputs', 'targets', 'snapshots', 'paramlst']
+        payload = {'ensemble': self.ensemble.state_dict(), 'traj_store': self.traj_store.state_dict(),
+                   'preferences': self.preferences_state_dict()}
+        keys_to_save =['paramlst']
         payload = payload | {k: self.__dict__[k] for k in keys_to_save}
         torch.save(payload, '%s/reward_model_%s.pt' % (model_dir, step))
             
     def load(self, model_dir, step):
-        payload = torch.load('%s/reward_model_%s.pt' % (model_dir, step))
+        # the preference state holds pickled python objects (the query index, the archive dict)
+        payload = torch.load('%s/reward_model_%s.pt' % (model_dir, step), map_location=self.device, weights_only=False)
 
-        keys_to_load =['inputs', 'targets', 'snapshots', 'paramlst']
-        self.inputs, self.targets, self.snapshots, self.paramlst =  [payload[k] for k in keys_to_load]
+        if 'traj_store' in payload:
+            self.traj_store.load_state_dict(payload['traj_store'])
+        else:
+            # checkpoints from before the trajectory store keep one array per episode, the last one still open
+            episodes = [i for i in range(len(payload['inputs'])) if len(payload['inputs'][i]) > 0]
+            for i in episodes:
+                self.traj_store.add_episode(payload['inputs'][i], payload['targets'][i], payload['snapshots'][i],
+                                            done=i < len(payload['inputs']) - 1)
         
-        for i in range(self.de): 
-            self.ensemble[i].load_state_dict(payload[f'member_{i}'])
+        if 'preferences' in payload:
+            self.load_preferences_state_dict(payload['preferences'])
+        
+        if 'ensemble' in payload:
+            self.ensemble.load_state_dict(payload['ensemble'])
+        else:
+            # checkpoints from before the stacked ensemble keep one state dict per member
+            members = [payload[f'member_{i}'] for i in range(self.de)]
+            self.ensemble.load_state_dict(
+                {k: torch.stack([member[k] for member in members]) for k in members[0]})
+        self.paramlst = list(self.ensemble.parameters())
+        self.model_version += 1
     
+    def save_weights(self, path):
+        # the ensemble alone, as exported by themis_reward_offline.py
+        torch.save({'ensemble': self.ensemble.state_dict(), 'ensemble_size': self.de, 'activation': self.activation,
+                    'size_segment': self.size_segment, 'obs_scale': self.obs_scale}, path)
+
+    def load_weights(self, path):
+        # ensemble weights of save_weights, the trajectories and the preference buffer are kept
+        payload = torch.load(path, map_location=self.device, weights_only=True)   # tensors and numbers only
+        # the weights only fit a model of the same configuration (obs_scale is missing in older exports)
+        expected = {'ensemble_size': self.de, 'activation': self.activation,
+                    'size_segment': self.size_segment, 'obs_scale': self.obs_scale}
+        for key, value in expected.items():
+            if key in payload and payload[key] != value:
+                raise ValueError(f'Reward weights {path} have {key}={payload[key]}, the reward model has {value}')
+        self.ensemble.load_state_dict(payload['ensemble'])
+        self.paramlst = list(self.ensemble.parameters())
+        self.model_version += 1
+
+    def preferences_state_dict(self):
+        keys = ['buffer_ref1', 'buffer_ref2', 'buffer_label', 'buffer_val', 'buffer_round', 'buffer_archived',
+                'buffer_dropped', 'archive', 'buffer_index', 'buffer_full', 'label_round', 'fit_round', 'query_index']
+        return {k: self.__dict__[k] for k in keys}
+
+    def load_preferences_state_dict(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        if self.embeddings is not None:
+            self.embeddings.invalidate()
+
+    def journal_record(self, rows):
+        # one labeled batch: references, compact segments (unless archiving is off), labels, model version and time
+        record = {'round': self.label_round, 'time': time.time(), 'version': self.model_version, 'ds': self.ds,
+                  'obs_scale': self.obs_scale,
+                  'refs_1': self.buffer_ref1[rows].copy(), 'refs_2': self.buffer_ref2[rows].copy(),
+                  'labels': self.buffer_label[rows].copy(), 'segs_1': None, 'segs_2': None}
+        if self.pref_archive != 'none':
+            record['segs_1'] = self.pref_segments(rows, 0).astype(self.pref_archive)
+            record['segs_2'] = self.pref_segments(rows, 1).astype(self.pref_archive)
+        return record
+
+    def load_journal(self, records):
+        # rebuild the preference buffer from journal records newer than the labels it already holds,
+        # call before attaching a journal so the records are not written again.
+        # Only the episodes closed in the restored store are the ones the records refer to: the open one goes on
+        # with the steps of the resumed run and later ids are issued again, so those segments come from the record
+        closed_until = self.traj_store.next_ep - int(self.traj_store.open)
+        num_labels = 0
+        for record in records:
+            if record['round'] <= self.label_round:
+                continue
+            self.label_round = record['round'] - 1
+            # segments of trajectories the store does not hold (anymore) come from the record
+            self.put_queries(record['refs_1'], record['refs_2'], record['labels'], record['segs_1'], record['segs_2'],
+                             max_ep=closed_until)
+            num_labels += len(record['labels'])
+        if self.query_index is not None:
+            # pairs of reissued ids must not reject the new segments under those ids
+            self.query_index.discard_episodes(closed_until)
+        return num_labels
+
     def get_train_acc(self):
-        ensemble_acc = np.array([0 for _ in range(self.de)])
-        max_len = self.capacity if self.buffer_full else self.buffer_index
-        total_batch_index = np.random.permutation(max_len)
+        ensemble_acc = torch.zeros(self.de, dtype=torch.long, device=self.device)
+        labeled_rows = self.labeled_rows()
+        max_len = len(labeled_rows)
         batch_size = 256
         num_epochs = int(np.ceil(max_len/batch_size))
         
         total = 0
-        for epoch in range(num_epochs):
-            last_index = (epoch+1)*batch_size
-            if (epoch+1)*batch_size > max_len:
-                last_index = max_len
+        with torch.no_grad():
+            for epoch in range(num_epochs):
+                last_index = (epoch+1)*batch_size
+                if (epoch+1)*batch_size > max_len:
+                    last_index = max_len
+                    
+                idxs = labeled_rows[epoch*batch_size:last_index]
+                sa_t_1 = self.pref_segments(idxs, 0)
+                sa_t_2 = self.pref_segments(idxs, 1)
+                labels = self.buffer_label[idxs]
+                labels = self.stage(labels.flatten(), name='labels').long()
+                total += labels.size(0)
                 
-            sa_t_1 = self.buffer_seg1[epoch*batch_size:last_index]
-            sa_t_2 = self.buffer_seg2[epoch*batch_size:last_index]
-            labels = self.buffer_label[epoch*batch_size:last_index]
-            labels = torch.from_numpy(labels.flatten()).long().to(device)
-            total += labels.size(0)
-            for member in range(self.de):
-                # get logits
-                r_hat1 = self.r_hat_member(sa_t_1, member=member)
-                r_hat2 = self.r_hat_member(sa_t_2, member=member)
-                r_hat1 = r_hat1.sum(axis=1)
-                r_hat2 = r_hat2.sum(axis=1)
+                # get logits of all members at once
+                r_hat1 = self.r_hat_ensemble(sa_t_1)
+                r_hat2 = self.r_hat_ensemble(sa_t_2)
+                r_hat1 = r_hat1.sum(axis=-2)
+                r_hat2 = r_hat2.sum(axis=-2)
                 r_hat = torch.cat([r_hat1, r_hat2], axis=-1)                
-                _, predicted = torch.max(r_hat.data, 1)
-                correct = (predicted == labels).sum().item()
-                ensemble_acc[member] += correct
+                _, predicted = torch.max(r_hat, -1)
+                ensemble_acc += (predicted == labels.unsqueeze(0)).sum(axis=-1)
                 
-        ensemble_acc = ensemble_acc / total
+        ensemble_acc = ensemble_acc.cpu().numpy() / total
         return np.mean(ensemble_acc)
     
-    def get_queries(self, mb_size=20):
-        input_lengths = [len(x) for x in self.inputs]       # lenght of each trajectory
-        
-        #print(input_lengths)
+    def labeled_rows(self):
+        # rows of the preference buffer holding a usable label
+        max_len = self.capacity if self.buffer_full else self.buffer_index
+        return np.flatnonzero(~self.buffer_dropped[:max_len])
 
-        if len(input_lengths)==1:
-            len_traj = input_lengths[0]
-        else:
-            input_lengths.pop()
-            len_traj = min(input_lengths)       #instead of using the 1st traj length find the minimum
-
-        max_len = len(self.inputs)
-        if len(self.inputs[-1]) < len_traj:
-            max_len = max_len - 1           # do not consider the last trajectory if it is too small
-
-        size_segment=self.size_segment
-        if len_traj <= size_segment:         # If you ask for segment smaller than the min traj len
-            size_segment = len_traj-1
-
-        #img_t_1, img_t_2 = None, None
-
-        # get train traj
-        train_inputs = self.inputs[:max_len]    #turn inputs into arrays (minus the last one probably)
-        train_targets = self.targets[:max_len]
-        train_snapshots = self.snapshots[:max_len]
-
-        batch_index_2 = np.random.choice(max_len, size=mb_size, replace=True) # sample mp_size of those inputs
-        sa_t_2 = [train_inputs[i] for i in batch_index_2] # mb_size x (Time x dim of s&a)
-        r_t_2 = [train_targets[i] for i in batch_index_2] # mb_size x (Time x 1)
-        snaps_2 = [train_snapshots[i] for i in batch_index_2] # mb_size x (Time x dim of s&a)
-
-        batch_index_1 = np.random.choice(max_len, size=mb_size, replace=True)
-        sa_t_1 = [train_inputs[i] for i in batch_index_1] # mb_size x (Time x dim of s&a)
-        r_t_1 = [train_targets[i] for i in batch_index_1] # mb_size x (Time x 1)
-        snaps_1 = [train_snapshots[i] for i in batch_index_1] # mb_size x (Time x dim of s&a)
-
-        sa_t_2_padded = np.zeros((mb_size, self.size_segment, self.ds+self.da), dtype=self.seg_dtype)
-        r_t_2_padded = np.zeros((mb_size, self.size_segment, 1))
-        sa_t_1_padded = np.zeros((mb_size, self.size_segment, self.ds+self.da), dtype=self.seg_dtype)
-        r_t_1_padded = np.zeros((mb_size, self.size_segment, 1))
-
-        # Generate time index 
-        time_index = np.array([list(range(size_segment)) for i in range(mb_size)])
-        time_index_2, time_index_1 = np.zeros((2, mb_size, size_segment), dtype=int)
-
-        #print('Segment is: ', size_segment)
-        for i in range(mb_size):
-            duration2 =len(sa_t_2[i])
-            duration1 =len(sa_t_1[i])
-            shift2 = np.random.choice(duration2-size_segment)
-            shift1 = np.random.choice(duration1-size_segment)
+    def split_rows(self):
+        # rows of the preference buffer used for training and for validation
+        rows = self.labeled_rows()
+        val = self.buffer_val[rows]
+        return rows[~val], rows[val]
+
+    def evaluate(self, rows, batch_size=256):
+        # mean loss and accuracy of the ensemble on the given rows, equally preferable labels count as 0.5/0.5
+        total_loss, total_acc = 0.0, 0.0
+        with torch.no_grad():
+            for start in range(0, len(rows), batch_size):
+                idxs = rows[start:start+batch_size]
+                labels = self.stage(self.buffer_label[idxs].flatten(), name='labels').long()
+                r_hat1 = self.r_hat_ensemble(self.pref_segments(idxs, 0)).sum(axis=-2)
+                r_hat2 = self.r_hat_ensemble(self.pref_segments(idxs, 1)).sum(axis=-2)
+                r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
+
+                target = F.one_hot(labels.clamp(min=0), 2).float()
+                target[labels == -1] = 0.5
+                loss = -(target * F.log_softmax(r_hat, dim=-1)).sum(axis=-1)
+                _, predicted = torch.max(r_hat, -1)
+                total_loss += loss.mean(axis=0).sum().item()
+                total_acc += (predicted == labels).float().mean(axis=0).sum().item()
+        return total_loss / len(rows), total_acc / len(rows)
+
+    def fit(self, max_epochs, soft=False, acc_stop=0.97, patience=0, max_time=0, replay_ratio=-1):
+        # train for up to max_epochs passes, stopping when
+        #  - the train accuracy passes acc_stop
+        #  - the validation loss did not improve for patience epochs (the best weights are restored)
+        #  - max_time seconds have passed
+        # with replay_ratio >= 0 every pass uses the labels added since the last fit plus
+        # replay_ratio old labels per new one, instead of the whole buffer
+        train_rows, val_rows = self.split_rows()
+        is_new = self.buffer_round[train_rows] > self.fit_round
+        new_rows, old_rows = train_rows[is_new], train_rows[~is_new]
+        self.fit_round = self.label_round
+
+        train_acc = np.zeros(self.de)
+        if len(train_rows) == 0:
+            return train_acc
+        train_fn = self.train_soft_reward if soft else self.train_reward
+        use_val = patience > 0 and len(val_rows) > 0
+        best_loss, best_state, bad_epochs = float('inf'), None, 0
+        start_time = time.time()
+        for epoch in range(max_epochs):
+            rows = train_rows
+            if replay_ratio >= 0 and len(new_rows) > 0:
+                num_old = min(len(old_rows), int(replay_ratio * len(new_rows)))
+                rows = np.concatenate([new_rows, np.random.choice(old_rows, num_old, replace=False)])
+            train_acc = train_fn(rows)
+
+            if use_val:
+                val_loss, _ = self.evaluate(val_rows)
+                if val_loss < best_loss:
+                    best_loss, bad_epochs = val_loss, 0
+                    best_state = copy.deepcopy(self.ensemble.state_dict())
+                else:
+                    bad_epochs += 1
             
-            time_index_2[i] = time_index[i] + shift2 
-            time_index_1[i] = time_index[i] + shift1
+            if np.mean(train_acc) > acc_stop or (use_val and bad_epochs >= patience):
+                break
+            if max_time > 0 and time.time() - start_time > max_time:
+                break
+
+        if best_state is not None:
+            self.ensemble.load_state_dict(best_state)
+        # once per training round, not per epoch: every bump makes the whole replay buffer stale
+        self.model_version += 1
+        return train_acc
+
+    def shadow_copy(self):
+        # copy with its own weights, optimizer and snapshot of the preference buffer, the trajectories are shared
+        shadow = copy.copy(self)
+        shadow.ensemble = copy.deepcopy(self.ensemble)
+        shadow.paramlst = list(shadow.ensemble.parameters())
+        shadow.opt = torch.optim.Adam(shadow.paramlst, lr = self.lr)
+        shadow.opt.load_state_dict(copy.deepcopy(self.opt.state_dict()))
+        shadow.staging = {}
+        shadow.return_cache = SegmentReturnCache(self.traj_store, self.de)
+        shadow.shadows = weakref.WeakSet()
+        # the main thread keeps putting queries while the shadow works, which reuses rows and resets their
+        # archive entries, so the shadow gets its own archive (its segments are never modified, a shallow copy
+        # is enough). Trajectories evicted meanwhile are archived into the shadow as well, see archive_episode
+        with self.traj_store.lock:
+            for key in ['buffer_ref1', 'buffer_ref2', 'buffer_label', 'buffer_val', 'buffer_round',
+                        'buffer_archived', 'buffer_dropped']:
+                setattr(shadow, key, getattr(self, key).copy())
+            shadow.archive = dict(self.archive)
+            # cached embeddings are per row as well, the shadow must not write those of its refs into the live table
+            if self.embeddings is not None:
+                shadow.embeddings = self.embeddings.copy()
+            self.shadows.add(shadow)
+        return shadow
+
+    def serving_copy(self):
+        # copy holding only the weights, for predictions in another thread: no optimizer, the buffers are shared and unused
+        served = copy.copy(self)
+        served.ensemble = copy.deepcopy(self.ensemble).requires_grad_(False)
+        served.paramlst, served.opt = [], None
+        served.staging = {}
+        served.inference, served.inference_version = None, -1
+        return served
+
+    def publish(self, shadow):
+        # swap in the weights trained by a shadow copy, to be called from the thread that uses the model
+        self.ensemble.load_state_dict(shadow.ensemble.state_dict())
+        self.opt.load_state_dict(shadow.opt.state_dict())
+        self.fit_round = shadow.fit_round
+        self.model_version += 1
+        self.shadows.discard(shadow)
+
+    def sample_segment_refs(self, mb_size=20):
+        # pick (trajectory id, start offset, length) of mb_size segments, all as arrays
+        ep_ids = self.traj_store.episode_ids()
+        input_lengths = self.traj_store.lengths(ep_ids)       # lenght of each trajectory
+        complete_lengths = input_lengths[:-1] if self.traj_store.open else input_lengths
+
+        train_ids, train_lengths = ep_ids, input_lengths
+        if self.traj_store.open and len(complete_lengths) > 0 and input_lengths[-1] < min(complete_lengths):
+            # do not consider the last trajectory if it is too small
+            train_ids, train_lengths = ep_ids[:-1], input_lengths[:-1]
+        if (train_lengths > 1).any():
+            train_ids, train_lengths = train_ids[train_lengths > 1], train_lengths[train_lengths > 1]
+
+        batch_index = np.random.choice(len(train_ids), size=mb_size, replace=True) # sample mp_size of those inputs
+        seg_ids = train_ids[batch_index]
+        durations = train_lengths[batch_index]
+
+        # segments of trajectories shorter than size_segment keep all but one step and are padded later
+        lengths = np.where(durations > self.size_segment, self.size_segment, durations - 1)
+        offsets = np.random.randint(0, durations - lengths)
+        return seg_ids, offsets, lengths
+
+    def segment_rows(self, seg_ids, offsets, lengths):
+        # store rows of (n, size_segment) windows, padded steps point to the last real step of their segment
+        n = len(seg_ids)
+        rows = self.traj_store.rows(seg_ids, offsets, self.size_segment)
+        mask = np.arange(self.size_segment)[None, :] < lengths[:, None]
+        last_rows = rows[np.arange(n), np.maximum(lengths - 1, 0)]
+        return np.where(mask, rows, last_rows[:, None]), mask
+
+    def pad_segments(self, x, mask, lengths, dims):
+        # We pad the tragectories with the mean of their first dims features to unafect its value
+        if mask.all():
+            return x
+        pad = ~mask
+        count = np.maximum(lengths, 1)
+        mean = (x[:, :, :dims] * mask[:, :, None]).sum(axis=(1, 2), dtype=np.float64) / (count * dims)
+        if np.issubdtype(x.dtype, np.integer):
+            # uint8 segments get the rounded mean instead of a truncated one
+            mean = np.rint(mean)
+        x[pad] = np.broadcast_to(mean[:, None, None], x.shape)[pad]
+        return x
+
+    def get_segments(self, seg_ids, offsets, lengths):
+        # gather (n, size_segment, ds+da) windows with one fancy index and pad the short ones
+        rows, mask = self.segment_rows(seg_ids, offsets, lengths)
+        sa_t = self.pad_segments(self.traj_store.inputs[rows], mask, lengths, self.ds)     # n x size_seg x dim of s&a
+        r_t = self.pad_segments(self.traj_store.targets[rows], mask, lengths, 1)           # n x size_seg x 1
+        snaps = self.traj_store.snapshots[rows]                                             # n x size_seg
+        return sa_t, r_t, snaps
+
+    def pref_segments(self, rows, side):
+        # segments of one side (0 or 1) of the labeled pairs in rows: rows.shape + (size_segment, ds+da)
+        rows = np.asarray(rows)
+        flat = rows.reshape(-1)
+        refs = (self.buffer_ref1 if side == 0 else self.buffer_ref2)[flat]
+
+        sa_t = np.empty((len(flat), self.size_segment, self.ds+self.da), dtype=self.seg_dtype)
+        # a shadow copy trains in another thread: no episode may be evicted (and archived) between the check and the gather
+        with self.traj_store.lock:
+            archived = self.buffer_archived[flat, side]
+            live = ~archived
+            if live.any():
+                seg_rows, mask = self.segment_rows(refs[live, 0], refs[live, 1], refs[live, 2])
+                sa_t[live] = self.pad_segments(self.traj_store.inputs[seg_rows], mask, refs[live, 2], self.ds)
+            for i in np.flatnonzero(archived):
+                sa_t[i] = self.archive[(flat[i], side)]
+        return sa_t.reshape(*rows.shape, *sa_t.shape[1:])
+
+    def archive_episode(self, ep_id):
+        # called by the trajectory store right before ep_id is dropped: keep the labeled segments that use it,
+        # here and in the live shadow copies, whose labels are a snapshot of an earlier buffer
+        for model in [self, *list(self.shadows)]:
+            model.archive_labels(ep_id)
+
+    def archive_labels(self, ep_id):
+        max_len = self.capacity if self.buffer_full else self.buffer_index
+        for side, refs in enumerate([self.buffer_ref1, self.buffer_ref2]):
+            hits = np.flatnonzero((refs[:max_len, 0] == ep_id) & ~self.buffer_archived[:max_len, side] & ~self.buffer_dropped[:max_len])
+            if len(hits) == 0:
+                continue
+            if self.pref_archive == 'none':
+                self.buffer_dropped[hits] = True
+                continue
+            for row, seg in zip(hits, self.pref_segments(hits, side).astype(self.pref_archive)):
+                self.archive[(row, side)] = seg
+            self.buffer_archived[hits, side] = True
+
+    def segment_signatures(self, refs, max_dims=64):
+        # first, middle and last state of each segment on at most max_dims evenly spaced state dims
+        steps = np.stack([np.zeros_like(refs[:, 2]), refs[:, 2] // 2, np.maximum(refs[:, 2] - 1, 0)], axis=1)
+        rows = (self.traj_store.starts(refs[:, 0])[:, None] + refs[:, 1:2] + steps) % self.traj_store.capacity
+        dims = np.unique(np.linspace(0, self.ds - 1, min(self.ds, max_dims)).astype(np.int64))
+        return self.traj_store.inputs[rows[:, :, None], dims[None, None, :]].reshape(len(refs), -1).astype(np.float32)
+
+    def sample_query_refs(self, mb_size=20, max_tries=3):
+        # references of mb_size candidate pairs, nothing is gathered yet
+        # (the episode table and the signature rows are read under the store lock)
+        with self.traj_store.lock:
+            refs_1 = np.stack(self.sample_segment_refs(mb_size), axis=1)
+            refs_2 = np.stack(self.sample_segment_refs(mb_size), axis=1)
+            if self.query_index is None:
+                return refs_1, refs_2
             
-            sa_t_2[i] = np.take(sa_t_2[i], time_index_2[i], axis=0) # Batch[i] x (size_seg x dim of s&a)
-            r_t_2[i] = np.take(r_t_2[i], time_index_2[i], axis=0)   # Batch[i] x (size_seg x 1)
-            snaps_2[i] = np.take(snaps_2[i], time_index_2[i], axis=0) # Batch[i] x (size_seg x dim of s&a)
-            sa_t_1[i] = np.take(sa_t_1[i], time_index_1[i], axis=0) # Batch[i] x (size_seg x dim of s&a)
-            r_t_1[i] = np.take(r_t_1[i], time_index_1[i], axis=0)   # Batch[i] x (size_seg x 1)
-            snaps_1[i] = np.take(snaps_1[i], time_index_1[i], axis=0) # Batch[i] x (size_seg x dim of s&a)
-
-            mean_state2 = np.mean(sa_t_2[i][:size_segment, :self.ds])
-            mean_reward2 = np.mean(r_t_2[i][:size_segment])
-            mean_state1 = np.mean(sa_t_1[i][:size_segment, :self.ds])
-            mean_reward1 = np.mean(r_t_1[i][:size_segment])
-
-            for j in range(size_segment, self.size_segment):
-                sa_t_2_padded[i][j,:self.ds] = mean_state2
-                r_t_2_padded[i][j] = mean_reward2
-                sa_t_1_padded[i][j,:self.ds] = mean_state1
-                r_t_1_padded[i][j] = mean_reward1
-
-                # We pad the tragectories wth mean state values and random actions to unafect the trajectory value
-                random_actions2 = np.random.choice(sa_t_2_padded[i][j, :self.ds], self.da, replace=True)
-                random_actions1 = np.random.choice(sa_t_1_padded[i][j, :self.ds], self.da, replace=True)
-                
-                np.copyto( sa_t_2_padded[i][j,self.ds:] , random_actions2)
-                np.copyto( sa_t_1_padded[i][j,self.ds:] , random_actions1)
-                
-        np.copyto( sa_t_2_padded[:, :size_segment] , np.array(sa_t_2))
-        np.copyto( r_t_2_padded[:, :size_segment] , np.array(r_t_2))
-        np.copyto( sa_t_1_padded[:, :size_segment] , np.array(sa_t_1))
-        np.copyto( r_t_1_padded[:, :size_segment] , np.array(r_t_1))
+            # pairs that were already queried are rejected and replaced, a few times at most
+            for attempt in range(max_tries + 1):
+                sigs = (None, None)
+                if self.query_index.quantum > 0:
+                    sigs = (self.segment_signatures(refs_1), self.segment_signatures(refs_2))
+                keep = self.query_index.new_mask(refs_1, refs_2, *sigs)
+                refs_1, refs_2 = refs_1[keep], refs_2[keep]
+                missing = mb_size - len(refs_1)
+                if missing == 0 or attempt == max_tries:
+                    break
+                refs_1 = np.concatenate([refs_1, np.stack(self.sample_segment_refs(missing), axis=1)])
+                refs_2 = np.concatenate([refs_2, np.stack(self.sample_segment_refs(missing), axis=1)])
+        return refs_1, refs_2
+
+    def gather_queries(self, refs_1, refs_2):
+        # pairs referencing a trajectory evicted since their selection are left out
+        with self.traj_store.lock:
+            stored = self.traj_store.is_stored(refs_1[:, 0]) & self.traj_store.is_stored(refs_2[:, 0])
+            if not stored.all():
+                refs_1, refs_2 = refs_1[stored], refs_2[stored]
+            sa_t_1, r_t_1, snaps_1 = self.get_segments(refs_1[:, 0], refs_1[:, 1], refs_1[:, 2])
+            sa_t_2, r_t_2, snaps_2 = self.get_segments(refs_2[:, 0], refs_2[:, 1], refs_2[:, 2])
+        return sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2, refs_1, refs_2
+
+    def get_queries(self, mb_size=20):
+        return self.gather_queries(*self.sample_query_refs(mb_size))
 
-        return sa_t_1_padded, sa_t_2_padded, r_t_1_padded, r_t_2_padded, snaps_1, snaps_2
+    def candidate_refs(self):
+        # candidate pairs of the uncertainty based sampling methods
+        num_candidates = self.num_candidates if self.num_candidates > 0 else self.mb_size*self.large_batch
+        return self.sample_query_refs(num_candidates)
 
-    def put_queries(self, sa_t_1, sa_t_2, labels):
-        total_sample = sa_t_1.shape[0]          # Fix changes based on new padded states
+    def put_queries(self, refs_1, refs_2, labels, segs_1=None, segs_2=None, max_ep=None):
+        # segs_1, segs_2: the segments of the pairs as gathered at selection, archived for the pairs
+        # whose trajectory was evicted before they were labeled (None drops those labels)
+        # max_ep: refs into episodes from this id on are not read from the store either (journal replay)
+        total_sample = refs_1.shape[0]          # Fix changes based on new padded states
         next_index = self.buffer_index + total_sample
 
+        self.label_round += 1
+        rows = (self.buffer_index + np.arange(total_sample)) % self.capacity
+        self.buffer_round[rows] = self.label_round
+        self.buffer_val[rows] = np.random.rand(total_sample) < self.val_ratio
+        self.buffer_dropped[rows] = False
+        for row in rows[self.buffer_archived[rows].any(axis=1)]:
+            self.archive.pop((row, 0), None)
+            self.archive.pop((row, 1), None)
+        self.buffer_archived[rows] = False
+        if self.embeddings is not None:
+            self.embeddings.invalidate(rows)
+
         if next_index >= self.capacity:
             self.buffer_full = True
             maximum_index = self.capacity - self.buffer_index
-            np.copyto(self.buffer_seg1[self.buffer_index:self.capacity], sa_t_1[:maximum_index])
-            np.copyto(self.buffer_seg2[self.buffer_index:self.capacity], sa_t_2[:maximum_index])
+            np.copyto(self.buffer_ref1[self.buffer_index:self.capacity], refs_1[:maximum_index])
+            np.copyto(self.buffer_ref2[self.buffer_index:self.capacity], refs_2[:maximum_index])
             np.copyto(self.buffer_label[self.buffer_index:self.capacity], labels[:maximum_index])
 
             remain = total_sample - (maximum_index)
 
             if remain > 0:
-                np.copyto(self.buffer_seg1[0:remain], sa_t_1[maximum_index:])
-                np.copyto(self.buffer_seg2[0:remain], sa_t_2[maximum_index:])
+                np.copyto(self.buffer_ref1[0:remain], refs_1[maximum_index:])
+                np.copyto(self.buffer_ref2[0:remain], refs_2[maximum_index:])
                 np.copyto(self.buffer_label[0:remain], labels[maximum_index:])
 
             self.buffer_index = remain
         else:
-            np.copyto(self.buffer_seg1[self.buffer_index:next_index], sa_t_1)
-            np.copyto(self.buffer_seg2[self.buffer_index:next_index], sa_t_2)
+            np.copyto(self.buffer_ref1[self.buffer_index:next_index], refs_1)
+            np.copyto(self.buffer_ref2[self.buffer_index:next_index], refs_2)
             np.copyto(self.buffer_label[self.buffer_index:next_index], labels)
             self.buffer_index = next_index
+
+        def stored(refs):
+            in_store = self.traj_store.is_stored(refs[:, 0])
+            return in_store if max_ep is None else in_store & (refs[:, 0] < max_ep)
+
+        for side, (refs, segs) in enumerate([(refs_1, segs_1), (refs_2, segs_2)]):
+            gone = ~stored(refs)
+            if not gone.any():
+                continue
+            if segs is None or self.pref_archive == 'none':
+                self.buffer_dropped[rows[gone]] = True
+                continue
+            for row, seg in zip(rows[gone], segs[gone]):
+                self.archive[(row, side)] = seg.astype(self.pref_archive)
+            self.buffer_archived[rows[gone], side] = True
+
+        if self.query_index is not None:
+            self.query_index.add(refs_1, refs_2)
+            both = stored(refs_1) & stored(refs_2)
+            if self.query_index.quantum > 0 and both.any():
+                self.query_index.add_signatures(self.segment_signatures(refs_1[both]),
+                                                self.segment_signatures(refs_2[both]))
+
+        if self.journal is not None:
+            self.journal.append(self.journal_record(rows))
             
-    def get_label(self, sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2, first_flag=False):
-        sum_r_t_1 = np.sum(r_t_1, axis=1)
-        sum_r_t_2 = np.sum(r_t_2, axis=1)
+    def render_queries(self, sa_t_1, sa_t_2, snaps_1, snaps_2, clipname='TestPairClip'):
+        # replay both segments of every pair from their snapshots and write the paired clips
+        clips1, xclips1, time_sum1 = self.ui_module.generate_frames(sa_t_1, self.env, self.seed, snaps_1, copy.deepcopy(self.obs_space))
+        clips2, xclips2, time_sum2 = self.ui_module.generate_frames(sa_t_2, self.env, self.seed, snaps_2, copy.deepcopy(self.obs_space))
+        time_sum3 = self.ui_module.generate_paired_clips(clips1, xclips1, clips2, xclips2, clipname, 'mp4')
+    
+        timesum =time_sum1+time_sum2+time_sum3
+        print('Elapsed time: ', timesum)
 
-        if self.human_teacher or self.ui_module.debug:
-            clips1, xclips1, time_sum1 = self.ui_module.generate_frames(sa_t_1, self.env, self.seed, snaps_1, copy.deepcopy(self.obs_space))
-            clips2, xclips2, time_sum2 = self.ui_module.generate_frames(sa_t_2, self.env, self.seed, snaps_2, copy.deepcopy(self.obs_space))
-            time_sum3 = self.ui_module.generate_paired_clips(clips1, xclips1, clips2, xclips2, 'TestPairClip', 'mp4')
-        
-            timesum =time_sum1+time_sum2+time_sum3
-            print('Elapsed time: ', timesum)
+    def needs_clips(self):
+        return self.human_teacher or (self.ui_module is not None and self.ui_module.debug)
+
+    def segment_targets(self, refs):
+        # true rewards of referenced segments (n, size_segment, 1), the states are not gathered
+        rows, mask = self.segment_rows(refs[:, 0], refs[:, 1], refs[:, 2])
+        return self.pad_segments(self.traj_store.targets[rows], mask, refs[:, 2], 1)
+
+    def simulated_labels(self, refs_1, refs_2):
+        # scripted labels straight from the references (about 4e5 pairs of 50 steps per second on one cpu)
+        with self.traj_store.lock:
+            # pairs referencing a trajectory evicted since their selection are left out
+            stored = self.traj_store.is_stored(refs_1[:, 0]) & self.traj_store.is_stored(refs_2[:, 0])
+            refs_1, refs_2 = refs_1[stored], refs_2[stored]
+            r_t_1, r_t_2 = self.segment_targets(refs_1), self.segment_targets(refs_2)
+        keep, labels = self.teacher.label(r_t_1, r_t_2, self.teacher_thres_skip, self.teacher_thres_equal)
+        return refs_1[keep], refs_2[keep], labels
+
+    def simulate_queries(self, refs_1, refs_2):
+        # simulated labeling mode, for offline benchmarks of the query selection methods:
+        # pairs are labeled and stored without gathering their segments or rendering clips
+        refs_1, refs_2, labels = self.simulated_labels(refs_1, refs_2)
+        if len(labels) > 0:
+            self.put_queries(refs_1, refs_2, labels)
+        return len(labels)
+
+    def get_label(self, sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2, refs_1, refs_2, first_flag=False, clipname='TestPairClip', rendered=False):
+        # rendered: the clips of these pairs were already written (by the query prefetcher) under clipname
+        if self.needs_clips() and not rendered:
+            self.render_queries(sa_t_1, sa_t_2, snaps_1, snaps_2, clipname)
 
         if self.human_teacher:
             # Get human input
+            print(f'Clips: Clips/{clipname}_1 to {clipname}_{len(sa_t_1)}')
             labels =[]
-            labels = self.ui_module.get_input_keyboad(self.mb_size)
+            labels = self.ui_module.get_input_keyboad(len(sa_t_1))
             if len(labels) == 0:
-                return None, None, None, None, []
+                return None, None, None, None, None, None, []
             labels = np.array(labels).reshape(-1,1)
             print(labels)
 
         else:
-            # skip the query
-            if self.teacher_thres_skip > 0: 
-                max_r_t = np.maximum(sum_r_t_1, sum_r_t_2)
-                max_index = (max_r_t > self.teacher_thres_skip).reshape(-1)
-                if sum(max_index) == 0:
-                    return None, None, None, None, []
-
-                sa_t_1 = sa_t_1[max_index]
-                sa_t_2 = sa_t_2[max_index]
-                r_t_1 = r_t_1[max_index]
-                r_t_2 = r_t_2[max_index]
-                sum_r_t_1 = np.sum(r_t_1, axis=1)
-                sum_r_t_2 = np.sum(r_t_2, axis=1)
-            
-            # equally preferable
-            margin_index = (np.abs(sum_r_t_1 - sum_r_t_2) < self.teacher_thres_equal).reshape(-1)
-            
-            # perfectly rational
-            seg_size = r_t_1.shape[0]
-            temp_r_t_1 = r_t_1.copy()
-            temp_r_t_2 = r_t_2.copy()
-            for index in range(seg_size-1):
-                temp_r_t_1[:index+1] *= self.teacher_gamma
-                temp_r_t_2[:index+1] *= self.teacher_gamma
-            sum_r_t_1 = np.sum(temp_r_t_1, axis=1)
-            sum_r_t_2 = np.sum(temp_r_t_2, axis=1)
-            
-            rational_labels = 1*(sum_r_t_1 < sum_r_t_2)
-            if self.teacher_beta > 0: # Bradley-Terry rational model
-                r_hat = torch.cat([torch.Tensor(sum_r_t_1), 
-                                torch.Tensor(sum_r_t_2)], axis=-1)
-                r_hat = r_hat*self.teacher_beta
-                ent = F.softmax(r_hat, dim=-1)[:, 1]
-                labels = torch.bernoulli(ent).int().numpy().reshape(-1, 1)
-            else:
-                labels = rational_labels
-        
-            # making a mistake
-            len_labels = labels.shape[0]
-            rand_num = np.random.rand(len_labels)
-            noise_index = rand_num <= self.teacher_eps_mistake
-            labels[noise_index] = 1 - labels[noise_index]
+            # scripted teacher, skip / equal / mistake all decided in one pass over the batch
+            keep, labels = self.teacher.label(r_t_1, r_t_2, self.teacher_thres_skip, self.teacher_thres_equal)
+            if not keep.any():
+                return None, None, None, None, None, None, []
+            if not keep.all():
+                sa_t_1, sa_t_2 = sa_t_1[keep], sa_t_2[keep]
+                refs_1, refs_2, r_t_1, r_t_2 = refs_1[keep], refs_2[keep], r_t_1[keep], r_t_2[keep]
 
-            # equally preferable
-            labels[margin_index] = -1 
+        return sa_t_1, sa_t_2, refs_1, refs_2, r_t_1, r_t_2, labels
+    
+    def kcenter_features(self, sa_t_1, sa_t_2):
+        # states of both segments of every pair, flattened (and projected when kcenter_dim > 0)
+        n = sa_t_1.shape[0]
+        parts = [sa_t_1[:, :, :self.ds].reshape(n, -1), sa_t_2[:, :, :self.ds].reshape(n, -1)]
+        if self.kcenter_dim > 0:
+            return random_projection(parts, self.kcenter_dim, seed=self.seed, device=self.device)
+        return self.stage(np.concatenate(parts, axis=1), name='kcenter').float()
 
-            #print(labels)
+    def kcenter_select(self, sa_t_1, sa_t_2, num_new_sample, batch_size=256):
+        rows = self.labeled_rows()
+        if self.embeddings is not None:
+            # candidates are embedded once, labeled pairs come from the cache
+            temp_sa = self.embeddings.embed_pairs(self, sa_t_1, sa_t_2)
+            tot_sa = self.embeddings.labeled(self, rows, batch_size)
+            return KCenterGreedy(temp_sa, tot_sa, num_new_sample)
 
-        return sa_t_1, sa_t_2, r_t_1, r_t_2, labels
-    
-    def kcenter_sampling(self):
-        
-        # get queries
-        num_init = self.mb_size*self.large_batch
-        sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2 =  self.get_queries(
-            mb_size=num_init)
-        
-        # get final queries based on kmeans clustering
-        temp_sa_t_1 = sa_t_1[:,:,:self.ds]
-        temp_sa_t_2 = sa_t_2[:,:,:self.ds]
-        temp_sa = np.concatenate([temp_sa_t_1.reshape(num_init, -1),  
-                                  temp_sa_t_2.reshape(num_init, -1)], axis=1)
-        
-        max_len = self.capacity if self.buffer_full else self.buffer_index
+        temp_sa = self.kcenter_features(sa_t_1, sa_t_2)
         
-        tot_sa_1 = self.buffer_seg1[:max_len, :, :self.ds]
-        tot_sa_2 = self.buffer_seg2[:max_len, :, :self.ds]
-        tot_sa = np.concatenate([tot_sa_1.reshape(max_len, -1),  
-                                 tot_sa_2.reshape(max_len, -1)], axis=1)
+        # labeled pairs are gathered a chunk at a time
+        tot_sa = [temp_sa[:0]]
+        for start in range(0, len(rows), batch_size):
+            idxs = rows[start:start+batch_size]
+            tot_sa.append(self.kcenter_features(self.pref_segments(idxs, 0), self.pref_segments(idxs, 1)))
+        tot_sa = torch.cat(tot_sa)
         
-        selected_index = KCenterGreedy(temp_sa, tot_sa, self.mb_size)
+        return KCenterGreedy(temp_sa, tot_sa, num_new_sample)
 
-        r_t_1, sa_t_1 = r_t_1[selected_index], sa_t_1[selected_index]
-        r_t_2, sa_t_2 = r_t_2[selected_index], sa_t_2[selected_index]
-        
-        # get labels
-        sa_t_1, sa_t_2, r_t_1, r_t_2, labels = self.get_label(
-            sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2)
+    def select_pairs(self, queries, index):
+        return tuple(x[index] for x in queries)
+
+    def kcenter_queries(self):
         
-        if len(labels) > 0:
-            self.put_queries(sa_t_1, sa_t_2, labels)
+        # get queries
+        num_init = self.mb_size*self.large_batch
+        queries = self.get_queries(mb_size=num_init)
+        sa_t_1, sa_t_2 = queries[:2]
         
-        return len(labels)
+        # get final queries based on kmeans clustering
+        selected_index = self.kcenter_select(sa_t_1, sa_t_2, self.mb_size)
+        return self.select_pairs(queries, selected_index)
     
-    def kcenter_disagree_sampling(self):
+    def kcenter_disagree_queries(self):
         
         num_init = self.mb_size*self.large_batch
         num_init_half = int(num_init*0.5)
         
-        # get queries
-        sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2 =  self.get_queries(
-            mb_size=num_init)
+        # get queries, scored from the cached returns before anything is gathered
+        refs_1, refs_2 = self.candidate_refs()
         
         # get final queries based on uncertainty
-        _, disagree = self.get_rank_probability(sa_t_1, sa_t_2)
+        _, disagree = self.get_rank_probability_refs(refs_1, refs_2)
         top_k_index = (-disagree).argsort()[:num_init_half]
-        r_t_1, sa_t_1 = r_t_1[top_k_index], sa_t_1[top_k_index]
-        r_t_2, sa_t_2 = r_t_2[top_k_index], sa_t_2[top_k_index]
+        queries = self.gather_queries(refs_1[top_k_index], refs_2[top_k_index])
+        sa_t_1, sa_t_2 = queries[:2]
         
         # get final queries based on kmeans clustering
-        temp_sa_t_1 = sa_t_1[:,:,:self.ds]
-        temp_sa_t_2 = sa_t_2[:,:,:self.ds]
-        
-        temp_sa = np.concatenate([temp_sa_t_1.reshape(num_init_half, -1),  
-                                  temp_sa_t_2.reshape(num_init_half, -1)], axis=1)
-        
-        max_len = self.capacity if self.buffer_full else self.buffer_index
-        
-        tot_sa_1 = self.buffer_seg1[:max_len, :, :self.ds]
-        tot_sa_2 = self.buffer_seg2[:max_len, :, :self.ds]
-        tot_sa = np.concatenate([tot_sa_1.reshape(max_len, -1),  
-                                 tot_sa_2.reshape(max_len, -1)], axis=1)
-        
-        selected_index = KCenterGreedy(temp_sa, tot_sa, self.mb_size)
-        
-        r_t_1, sa_t_1 = r_t_1[selected_index], sa_t_1[selected_index]
-        r_t_2, sa_t_2 = r_t_2[selected_index], sa_t_2[selected_index]
-
-        # get labels
-        sa_t_1, sa_t_2, r_t_1, r_t_2, labels = self.get_label(
-            sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2)
-        
-        if len(labels) > 0:
-            self.put_queries(sa_t_1, sa_t_2, labels)
-        
-        return len(labels)
+        selected_index = self.kcenter_select(sa_t_1, sa_t_2, self.mb_size)
+        return self.select_pairs(queries, selected_index)
     
-    def kcenter_entropy_sampling(self):
+    def kcenter_entropy_queries(self):
         
         num_init = self.mb_size*self.large_batch
         num_init_half = int(num_init*0.5)
         
-        # get queries
-        sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2 =  self.get_queries(
-            mb_size=num_init)
-        
+        # get queries, scored from the cached returns before anything is gathered
+        refs_1, refs_2 = self.candidate_refs()
         
         # get final queries based on uncertainty
-        entropy, _ = self.get_entropy(sa_t_1, sa_t_2)
+        entropy, _ = self.get_entropy_refs(refs_1, refs_2)
         top_k_index = (-entropy).argsort()[:num_init_half]
-        r_t_1, sa_t_1 = r_t_1[top_k_index], sa_t_1[top_k_index]
-        r_t_2, sa_t_2 = r_t_2[top_k_index], sa_t_2[top_k_index]
+        queries = self.gather_queries(refs_1[top_k_index], refs_2[top_k_index])
+        sa_t_1, sa_t_2 = queries[:2]
         
         # get final queries based on kmeans clustering
-        temp_sa_t_1 = sa_t_1[:,:,:self.ds]
-        temp_sa_t_2 = sa_t_2[:,:,:self.ds]
-        
-        temp_sa = np.concatenate([temp_sa_t_1.reshape(num_init_half, -1),  
-                                  temp_sa_t_2.reshape(num_init_half, -1)], axis=1)
+        selected_index = self.kcenter_select(sa_t_1, sa_t_2, self.mb_size)
+        return self.select_pairs(queries, selected_index)
+    
+    def uniform_refs(self):
+        return self.sample_query_refs(self.mb_size)
+
+    def disagreement_refs(self):
         
-        max_len = self.capacity if self.buffer_full else self.buffer_index
+        # get queries, scored from the cached returns before anything is gathered
+        refs_1, refs_2 = self.candidate_refs()
         
-        tot_sa_1 = self.buffer_seg1[:max_len, :, :self.ds]
-        tot_sa_2 = self.buffer_seg2[:max_len, :, :self.ds]
-        tot_sa = np.concatenate([tot_sa_1.reshape(max_len, -1),  
-                                 tot_sa_2.reshape(max_len, -1)], axis=1)
+        # get final queries based on uncertainty
+        _, disagree = self.get_rank_probability_refs(refs_1, refs_2)
+        top_k_index = (-disagree).argsort()[:self.mb_size]
+        return refs_1[top_k_index], refs_2[top_k_index]
+    
+    def entropy_refs(self):
         
-        selected_index = KCenterGreedy(temp_sa, tot_sa, self.mb_size)
+        # get queries, scored from the cached returns before anything is gathered
+        refs_1, refs_2 = self.candidate_refs()
         
-        r_t_1, sa_t_1 = r_t_1[selected_index], sa_t_1[selected_index]
-        r_t_2, sa_t_2 = r_t_2[selected_index], sa_t_2[selected_index]
+        # get final queries based on uncertainty
+        entropy, _ = self.get_entropy_refs(refs_1, refs_2)
+        top_k_index = (-entropy).argsort()[:self.mb_size]
+        return refs_1[top_k_index], refs_2[top_k_index]
+
+    def uniform_queries(self):
+        return self.gather_queries(*self.uniform_refs())
+    
+    def disagreement_queries(self):
+        return self.gather_queries(*self.disagreement_refs())
+    
+    def entropy_queries(self):
+        return self.gather_queries(*self.entropy_refs())
 
+    def select_queries(self, feed_type):
+        # (sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2, refs_1, refs_2) of the next round, nothing is labeled
+        # the store is only locked while refs are sampled and segments gathered, so a selection running in
+        # another thread does not hold up add_data while it scores candidates and runs k-center. Pairs evicted
+        # before they are gathered are left out, those evicted before they are labeled are archived by put_queries
+        select_fn = [self.uniform_queries, self.disagreement_queries, self.entropy_queries,
+                     self.kcenter_queries, self.kcenter_disagree_queries, self.kcenter_entropy_queries][feed_type]
+        return select_fn()
+
+    def label_queries(self, queries, first_flag=False, clipname='TestPairClip', rendered=False):
         # get labels
-        sa_t_1, sa_t_2, r_t_1, r_t_2, labels = self.get_label(
-            sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2)
+        sa_t_1, sa_t_2, refs_1, refs_2, r_t_1, r_t_2, labels = self.get_label(
+            *queries, first_flag=first_flag, clipname=clipname, rendered=rendered)
         
         if len(labels) > 0:
-            self.put_queries(sa_t_1, sa_t_2, labels)
+            # a prefetched round can outlive its trajectories, its gathered segments are archived then
+            self.put_queries(refs_1, refs_2, labels, sa_t_1, sa_t_2)
         
         return len(labels)
+
+    def simulated_sampling(self, feed_type=0):
+        # simulated labeling mode (scripted teacher only): the pairs of uniform (0), disagreement (1) or
+        # entropy (2) sampling are labeled from their references, no segment is gathered and no clip rendered
+        select_fn = [self.uniform_refs, self.disagreement_refs, self.entropy_refs][feed_type]
+        return self.simulate_queries(*select_fn())
+
+    def kcenter_sampling(self):
+        return self.label_queries(self.select_queries(3))
+    
+    def kcenter_disagree_sampling(self):
+        return self.label_queries(self.select_queries(4))
+    
+    def kcenter_entropy_sampling(self):
+        return self.label_queries(self.select_queries(5))
     
     def uniform_sampling(self, first_flag=0):
-        # get queries
-        sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2 =  self.get_queries(mb_size=self.mb_size)
-        
-        # get labels
-        sa_t_1, sa_t_2, r_t_1, r_t_2, labels = self.get_label(sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2, first_flag=first_flag)
-        
-        if len(labels) > 0:
-            self.put_queries(sa_t_1, sa_t_2, labels)
-        
-        return len(labels)
+        return self.label_queries(self.select_queries(0), first_flag=first_flag)
     
     def disagreement_sampling(self):
-        
-        # get queries
-        sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2 =  self.get_queries(
-            mb_size=self.mb_size*self.large_batch)
-        
-        # get final queries based on uncertainty
-        _, disagree = self.get_rank_probability(sa_t_1, sa_t_2)
-        top_k_index = (-disagree).argsort()[:self.mb_size]
-        r_t_1, sa_t_1 = r_t_1[top_k_index], sa_t_1[top_k_index]
-        r_t_2, sa_t_2 = r_t_2[top_k_index], sa_t_2[top_k_index]        
-        
-        # get labels
-        sa_t_1, sa_t_2, r_t_1, r_t_2, labels = self.get_label(
-            sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2)        
-        if len(labels) > 0:
-            self.put_queries(sa_t_1, sa_t_2, labels)
-        
-        return len(labels)
+        return self.label_queries(self.select_queries(1))
     
     def entropy_sampling(self):
-        
-        # get queries
-        sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2 =  self.get_queries(
-            mb_size=self.mb_size*self.large_batch)
-        
-        # get final queries based on uncertainty
-        entropy, _ = self.get_entropy(sa_t_1, sa_t_2)
-        
-        top_k_index = (-entropy).argsort()[:self.mb_size]
-        r_t_1, sa_t_1 = r_t_1[top_k_index], sa_t_1[top_k_index]
-        r_t_2, sa_t_2 = r_t_2[top_k_index], sa_t_2[top_k_index]
-        
-        # get labels
-        sa_t_1, sa_t_2, r_t_1, r_t_2, labels = self.get_label(    
-            sa_t_1, sa_t_2, r_t_1, r_t_2, snaps_1, snaps_2)
-        
-        if len(labels) > 0:
-            self.put_queries(sa_t_1, sa_t_2, labels)
-        
-        return len(labels)
+        return self.label_queries(self.select_queries(2))
     
-    def train_reward(self):
-        ensemble_losses = [[] for _ in range(self.de)]
-        ensemble_acc = np.array([0 for _ in range(self.de)])
-        
-        max_len = self.capacity if self.buffer_full else self.buffer_index
+    def train_reward(self, rows=None):
+        # accumulated on the device, read back once after the last batch
+        ensemble_losses = torch.zeros(self.de, device=self.device)
+        ensemble_acc = torch.zeros(self.de, dtype=torch.long, device=self.device)
+        
+        if rows is None:
+            rows = np.arange(self.capacity if self.buffer_full else self.buffer_index)
+        max_len = len(rows)
         total_batch_index = []
         for _ in range(self.de):
-            total_batch_index.append(np.random.permutation(max_len))
+            total_batch_index.append(np.random.permutation(rows))
+        total_batch_index = np.stack(total_batch_index)
         
         num_epochs = int(np.ceil(max_len/self.train_batch_size))
         list_debug_loss1, list_debug_loss2 = [], []
@@ -707,58 +1134,57 @@ class RewardModel:
         
         for epoch in range(num_epochs):
             self.opt.zero_grad()
-            loss = 0.0
             
             last_index = (epoch+1)*self.train_batch_size
             if last_index > max_len:
                 last_index = max_len
                 
-            for member in range(self.de):
-                
-                # get random batch
-                idxs = total_batch_index[member][epoch*self.train_batch_size:last_index]
-                sa_t_1 = self.buffer_seg1[idxs]
-                sa_t_2 = self.buffer_seg2[idxs]
-                labels = self.buffer_label[idxs]
-                labels = torch.from_numpy(labels.flatten()).long().to(device)
-                
-                if member == 0:
-                    total += labels.size(0)
-                
-                # get logits
-                r_hat1 = self.r_hat_member(sa_t_1, member=member)
-                r_hat2 = self.r_hat_member(sa_t_2, member=member)
-                r_hat1 = r_hat1.sum(axis=1) #*self.reward_scale+self.reward_intercept
-                r_hat2 = r_hat2.sum(axis=1) #*self.reward_scale+self.reward_intercept
-                r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
+            # get random batch, one row of indices per member
+            idxs = total_batch_index[:, epoch*self.train_batch_size:last_index]
+            sa_t_1 = self.pref_segments(idxs, 0)
+            sa_t_2 = self.pref_segments(idxs, 1)
+            labels = self.buffer_label[idxs]
+            labels = self.stage(labels.reshape(self.de, -1), name='labels').long()
+            total += labels.size(1)
+            
+            # get logits of every member in one pass
+            r_hat1 = self.r_hat_per_member(sa_t_1)
+            r_hat2 = self.r_hat_per_member(sa_t_2)
+            r_hat1 = r_hat1.sum(axis=-2) #*self.reward_scale+self.reward_intercept
+            r_hat2 = r_hat2.sum(axis=-2) #*self.reward_scale+self.reward_intercept
+            r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
 
-                # compute loss
-                curr_loss = self.CEloss(r_hat, labels)
-                #curr_loss = self.CEloss(r_hat, labels *self.reward_scale+self.reward_intercept)      #Reward Shape
-                loss += curr_loss
-                ensemble_losses[member].append(curr_loss.item())
-                
-                # compute acc
-                _, predicted = torch.max(r_hat.data, 1)
-                #_, predicted = torch.max(r_hat.data, 1 * self.reward_scale+self.reward_intercept)     #Reward Shape
-                correct = (predicted == labels).sum().item()
-                ensemble_acc[member] += correct
+            # compute loss, averaged per member and summed over the ensemble
+            curr_loss = F.cross_entropy(r_hat.reshape(-1, 2), labels.reshape(-1), reduction='none')
+            curr_loss = curr_loss.reshape(self.de, -1).mean(axis=-1)
+            #curr_loss = self.CEloss(r_hat, labels *self.reward_scale+self.reward_intercept)      #Reward Shape
+            loss = curr_loss.sum()
+            ensemble_losses += curr_loss.detach()
+            
+            # compute acc
+            _, predicted = torch.max(r_hat.data, -1)
+            #_, predicted = torch.max(r_hat.data, 1 * self.reward_scale+self.reward_intercept)     #Reward Shape
+            ensemble_acc += (predicted == labels).sum(axis=-1)
                 
             loss.backward()
             self.opt.step()
         
-        ensemble_acc = ensemble_acc / total
+        ensemble_acc = ensemble_acc.cpu().numpy() / total
         
         return ensemble_acc
     
-    def train_soft_reward(self):
-        ensemble_losses = [[] for _ in range(self.de)]
-        ensemble_acc = np.array([0 for _ in range(self.de)])
-        
-        max_len = self.capacity if self.buffer_full else self.buffer_index
+    def train_soft_reward(self, rows=None):
+        # accumulated on the device, read back once after the last batch
+        ensemble_losses = torch.zeros(self.de, device=self.device)
+        ensemble_acc = torch.zeros(self.de, dtype=torch.long, device=self.device)
+        
+        if rows is None:
+            rows = np.arange(self.capacity if self.buffer_full else self.buffer_index)
+        max_len = len(rows)
         total_batch_index = []
         for _ in range(self.de):
-            total_batch_index.append(np.random.permutation(max_len))
+            total_batch_index.append(np.random.permutation(rows))
+        total_batch_index = np.stack(total_batch_index)
         
         num_epochs = int(np.ceil(max_len/self.train_batch_size))
         list_debug_loss1, list_debug_loss2 = [], []
@@ -766,55 +1192,50 @@ class RewardModel:
         
         for epoch in range(num_epochs):
             self.opt.zero_grad()
-            loss = 0.0
             
             last_index = (epoch+1)*self.train_batch_size
             if last_index > max_len:
                 last_index = max_len
                 
-            for member in range(self.de):
-                
-                # get random batch
-                idxs = total_batch_index[member][epoch*self.train_batch_size:last_index]
-                sa_t_1 = self.buffer_seg1[idxs]
-                sa_t_2 = self.buffer_seg2[idxs]
-                labels = self.buffer_label[idxs]
-                labels = torch.from_numpy(labels.flatten()).long().to(device)
-                
-                if member == 0:
-                    total += labels.size(0)
-                
-                # get logits
-                r_hat1 = self.r_hat_member(sa_t_1, member=member)
-                r_hat2 = self.r_hat_member(sa_t_2, member=member)
-                r_hat1 = r_hat1.sum(axis=1) *self.reward_scale+self.reward_intercept
-                r_hat2 = r_hat2.sum(axis=1) *self.reward_scale+self.reward_intercept
-                r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
+            # get random batch, one row of indices per member
+            idxs = total_batch_index[:, epoch*self.train_batch_size:last_index]
+            sa_t_1 = self.pref_segments(idxs, 0)
+            sa_t_2 = self.pref_segments(idxs, 1)
+            labels = self.buffer_label[idxs]
+            labels = self.stage(labels.reshape(self.de, -1), name='labels').long()
+            total += labels.size(1)
+            
+            # get logits of every member in one pass
+            r_hat1 = self.r_hat_per_member(sa_t_1)
+            r_hat2 = self.r_hat_per_member(sa_t_2)
+            r_hat1 = r_hat1.sum(axis=-2) *self.reward_scale+self.reward_intercept
+            r_hat2 = r_hat2.sum(axis=-2) *self.reward_scale+self.reward_intercept
+            r_hat = torch.cat([r_hat1, r_hat2], axis=-1)
 
-                # compute loss
-                uniform_index = labels == -1
-                labels[uniform_index] = 0
-                #target_onehot = torch.zeros_like(r_hat).scatter(1, labels.unsqueeze(1), self.label_target)
-                target_onehot = torch.zeros_like(r_hat).scatter(1, labels.unsqueeze(1), self.label_target*self.reward_scale+self.reward_intercept)  #Reward Shape
-                target_onehot += self.label_margin
-                if sum(uniform_index) > 0:
-                    #target_onehot[uniform_index] = 0.5
-                    target_onehot[uniform_index] = 0.5*self.reward_scale+self.reward_intercept      #Reward Shape
-
-                print(target_onehot)
-                curr_loss = self.softXEnt_loss(r_hat, target_onehot)
-                loss += curr_loss
-                ensemble_losses[member].append(curr_loss.item())
-                
-                # compute acc
-                #_, predicted = torch.max(r_hat.data, 1)
-                _, predicted = torch.max(r_hat.data, 1*self.reward_scale+self.reward_intercept)     #Reward Shape
-                correct = (predicted == labels).sum().item()
-                ensemble_acc[member] += correct
+            # compute loss
+            uniform_index = labels == -1
+            labels[uniform_index] = 0
+            #target_onehot = torch.zeros_like(r_hat).scatter(-1, labels.unsqueeze(-1), self.label_target)
+            target_onehot = torch.zeros_like(r_hat).scatter(-1, labels.unsqueeze(-1), self.label_target*self.reward_scale+self.reward_intercept)  #Reward Shape
+            target_onehot += self.label_margin
+            if uniform_index.any():
+                #target_onehot[uniform_index] = 0.5
+                target_onehot[uniform_index] = 0.5*self.reward_scale+self.reward_intercept      #Reward Shape
+
+            print(target_onehot)
+            logprobs = F.log_softmax(r_hat, dim=-1)
+            curr_loss = -(target_onehot * logprobs).sum(axis=-1).mean(axis=-1)
+            loss = curr_loss.sum()
+            ensemble_losses += curr_loss.detach()
+            
+            # compute acc
+            #_, predicted = torch.max(r_hat.data, 1)
+            _, predicted = torch.max(r_hat.data, -1)     #Reward Shape
+            ensemble_acc += (predicted == labels).sum(axis=-1)
                 
             loss.backward()
             self.opt.step()
         
-        ensemble_acc = ensemble_acc / total
+        ensemble_acc = ensemble_acc.cpu().numpy() / total
         
-        return ensemble_acc
\ No newline at end of file
+        return ensemble_acc
@@ -0,0 +1,155 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import torch
+import lib.utils as utils
+from multiprocessing.connection import Listener, Client
+
+# messages are raw bytes, nothing received is unpickled:
+#  - request: an array of inputs
+#  - reply: int64 model version and status, then the array of rewards (status 0) or a utf-8 error message (status 1)
+# an array is its int64 ndim and shape followed by its float32 data
+
+def pack_array(x):
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    return np.array([x.ndim, *x.shape], dtype=np.int64).tobytes() + x.tobytes()
+
+def unpack_array(data, offset=0):
+    if len(data) < offset + 8:
+        raise ValueError('truncated array header')
+    ndim = int(np.frombuffer(data, dtype=np.int64, count=1, offset=offset)[0])
+    if ndim < 0 or len(data) < offset + 8 * (ndim + 1):
+        raise ValueError(f'bad array header (ndim {ndim})')
+    shape = tuple(int(n) for n in np.frombuffer(data, dtype=np.int64, count=ndim, offset=offset + 8))
+    offset += 8 * (ndim + 1)
+    if min(shape, default=1) < 0 or len(data) - offset != 4 * int(np.prod(shape)):
+        raise ValueError(f'{len(data) - offset} bytes of data for an array of shape {shape}')
+    return np.frombuffer(data, dtype=np.float32, offset=offset).reshape(shape)
+
+class RewardServer(object):
+    """Serves r_hat predictions of one reward model to local processes over a Unix socket, with dynamic batching."""
+    def __init__(self, reward_model, address, max_batch=8192, max_delay=0.002):
+        self.address = str(address)
+        self.max_batch = max_batch      # rows coalesced into one forward pass at most
+        self.max_delay = max_delay      # seconds a request may wait for others to join its batch
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+
+        # the served copy holds the weights only (no optimizer), swapped in by publish
+        self.model = reward_model.serving_copy()
+        self.version = reward_model.model_version
+        self.width = reward_model.ds + reward_model.da
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.listener = Listener(self.address, family='AF_UNIX')
+        self.closed = False
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def publish(self, reward_model):
+        # hot swap: requests batched after this call use the new weights
+        with self.lock:
+            self.model.ensemble.load_state_dict(reward_model.ensemble.state_dict())
+            self.model.model_version = self.version = reward_model.model_version
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        # a client has a single request in flight, its reply is sent by the batching thread
+        while not self.closed:
+            try:
+                data = conn.recv_bytes()
+            except (EOFError, OSError):
+                break
+            try:
+                x = unpack_array(data)
+            except ValueError as e:
+                self._reply(conn, None, self.version, f'malformed request: {e}')
+                continue
+            self.requests.put((conn, x))
+        conn.close()
+
+    def _serve(self):
+        while not self.closed:
+            batch = [self.requests.get()]
+            num_rows = len(batch[0][1])
+            deadline = time.time() + self.max_delay
+            while num_rows < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+                num_rows += len(batch[-1][1])
+
+            # a request of the wrong width gets an error reply, the others are still served
+            valid = []
+            for conn, x in batch:
+                if x.ndim == 0 or x.shape[-1] != self.width:
+                    self._reply(conn, None, self.version, f'expected inputs of width {self.width}, got shape {x.shape}')
+                else:
+                    valid.append((conn, x))
+            if len(valid) == 0:
+                continue
+
+            try:
+                inputs = np.concatenate([x.reshape(-1, x.shape[-1]) for _, x in valid])
+                with self.lock:
+                    rewards = utils.to_np(self.model.r_hat_batch(inputs))
+                    version = self.version
+            except Exception as e:
+                # the batching thread keeps running, every client of the batch gets the error
+                for conn, x in valid:
+                    self._reply(conn, None, self.version, f'{type(e).__name__}: {e}')
+                continue
+            start = 0
+            for conn, x in valid:
+                end = start + len(x.reshape(-1, x.shape[-1]))
+                self._reply(conn, rewards[start:end].reshape(*x.shape[:-1], 1), version)
+                start = end
+
+    def _reply(self, conn, rewards, version, error=None):
+        if error is None:
+            message = np.array([version, 0], dtype=np.int64).tobytes() + pack_array(rewards)
+        else:
+            message = np.array([version, 1], dtype=np.int64).tobytes() + error.encode()
+        try:
+            conn.send_bytes(message)
+        except OSError:
+            pass
+
+class RewardClient(object):
+    """Client side of RewardServer, with the prediction methods of RewardModel."""
+    def __init__(self, address):
+        self.conn = Client(str(address), family='AF_UNIX')
+        self.model_version = -1     # version of the weights behind the last prediction
+
+    def r_hat_batch(self, x):
+        # (..., ds+da) -> (..., 1) tensor, like RewardModel.r_hat_batch
+        self.conn.send_bytes(pack_array(x))
+        data = self.conn.recv_bytes()
+        version, status = (int(v) for v in np.frombuffer(data, dtype=np.int64, count=2))
+        self.model_version = version
+        if status != 0:
+            raise RuntimeError(f'reward server: {data[16:].decode()}')
+        return torch.as_tensor(unpack_array(data, offset=16).copy())
+
+    def r_hat(self, x):
+        return float(self.r_hat_batch(np.asarray(x).reshape(1, -1)).mean())
+
+    def close(self):
+        self.conn.close()
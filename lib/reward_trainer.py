@@ -0,0 +1,51 @@
+import threading
+
+class AsyncRewardTrainer(object):
+    """Trains a shadow copy of a RewardModel in a background thread and publishes its weights when done."""
+    def __init__(self, reward_model):
+        self.reward_model = reward_model
+        self.thread = None
+        self.shadow = None
+        self.train_acc = None
+        self.error = None
+
+    @property
+    def busy(self):
+        return self.thread is not None
+
+    def start(self, **fit_kwargs):
+        # the shadow gets its own weights and a snapshot of the preference buffer,
+        # so the main thread keeps acting and labeling with the published model
+        assert not self.busy, 'reward model is already training'
+        self.shadow = self.reward_model.shadow_copy()
+        self.train_acc, self.error = None, None
+        self.thread = threading.Thread(target=self._work, kwargs=fit_kwargs, daemon=True)
+        self.thread.start()
+
+    def _work(self, **fit_kwargs):
+        try:
+            self.train_acc = self.shadow.fit(**fit_kwargs)
+        except Exception as e:
+            self.error = e
+
+    def poll(self):
+        # called from the main thread: publishes the new weights once training is over
+        # returns the train accuracy of the published model, None while still training or idle
+        if self.thread is None or self.thread.is_alive():
+            return None
+        return self._finish()
+
+    def wait(self):
+        if self.thread is None:
+            return None
+        self.thread.join()
+        return self._finish()
+
+    def _finish(self):
+        self.thread.join()
+        self.thread = None
+        shadow, self.shadow = self.shadow, None
+        if self.error is not None:
+            raise self.error
+        self.reward_model.publish(shadow)
+        return self.train_acc
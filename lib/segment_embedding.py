@@ -0,0 +1,70 @@
+import copy
+import math
+import numpy as np
+import torch
+
+class SegmentEmbeddingStore(object):
+    """Low dimensional segment embeddings for diversity based query selection, cached per labeled pair."""
+    # every step is mapped to a few features, a fixed random projection of its state ('projection') or of
+    # the last hidden layer of the reward ensemble averaged over members ('hidden'), then averaged over bins
+    # equal chunks of the segment. Embeddings of labeled pairs are kept with the model version they were
+    # computed with, so projections are computed once per pair and hidden features once per pair and version.
+    def __init__(self, capacity, ds, size_segment, mode='projection', dim=32, bins=4, hidden_size=256, seed=0, device='cpu'):
+        assert mode in ['projection', 'hidden'], f'unknown segment embedding {mode}'
+        self.ds = ds
+        self.mode = mode
+        self.bins = min(bins, size_segment)
+        self.dim = self.bins * dim      # size of the embedding of one segment
+        self.device = device
+
+        # fixed gaussian projection of the per-step features
+        generator = torch.Generator().manual_seed(seed)
+        in_size = ds if mode == 'projection' else hidden_size
+        self.matrix = (torch.randn((in_size, dim), generator=generator) / math.sqrt(dim)).to(device)
+
+        self.table = torch.zeros((int(capacity), 2, self.dim), device=device)
+        self.versions = np.full((int(capacity), 2), -1, dtype=np.int64)
+
+    def version(self, model):
+        return 0 if self.mode == 'projection' else model.model_version
+
+    def embed(self, model, sa_t):
+        # (n, size_segment, ds+da) segments -> (n, dim)
+        x = torch.as_tensor(sa_t, device=self.device).float()
+        with torch.no_grad():
+            if self.mode == 'projection':
+                feats = x[..., :self.ds] @ self.matrix
+            else:
+                lead_shape = x.shape[:-1]
+                hidden = model.ensemble[:-2](model.scale_inputs(x.reshape(-1, x.shape[-1]))).mean(axis=0)
+                feats = hidden.reshape(*lead_shape, -1) @ self.matrix
+            pooled = [chunk.mean(axis=1) for chunk in torch.tensor_split(feats, self.bins, dim=1)]
+        return torch.cat(pooled, axis=-1)
+
+    def embed_pairs(self, model, sa_t_1, sa_t_2):
+        return torch.cat([self.embed(model, sa_t_1), self.embed(model, sa_t_2)], axis=-1)
+
+    def labeled(self, model, rows, batch_size=256):
+        # embeddings of the labeled pairs in rows, (len(rows), 2*dim), only missing or outdated ones are computed
+        version = self.version(model)
+        stale = rows[(self.versions[rows] != version).any(axis=1)]
+        for start in range(0, len(stale), batch_size):
+            idxs = stale[start:start+batch_size]
+            table_idxs = torch.as_tensor(idxs, device=self.device)
+            for side in range(2):
+                self.table[table_idxs, side] = self.embed(model, model.pref_segments(idxs, side))
+            self.versions[idxs] = version
+        return self.table[torch.as_tensor(rows, device=self.device)].reshape(len(rows), -1)
+
+    def copy(self):
+        # independent cache for a shadow copy of the model, whose preference rows diverge from the live ones
+        store = copy.copy(self)
+        store.table = self.table.clone()
+        store.versions = self.versions.copy()
+        return store
+
+    def invalidate(self, rows=None):
+        if rows is None:
+            self.versions[:] = -1
+        else:
+            self.versions[rows] = -1
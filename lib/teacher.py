@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+class SyntheticTeacher(object):
+    """Scripted teacher labeling segment pairs from their true rewards, one vectorized pass over the whole batch."""
+    def __init__(self, beta=-1, gamma=1, eps_mistake=0, device='cpu'):
+        self.beta = beta                # > 0: labels sampled from a Bradley-Terry model, otherwise perfectly rational
+        self.gamma = gamma              # discount of the earlier steps of a segment
+        self.eps_mistake = eps_mistake  # probability of flipping a label
+        self.device = torch.device(device)     # labels are computed on the reward model device, in float32 (mps has no float64)
+        self.weights = {}               # discount weights per segment length
+
+    def discount(self, length):
+        # gamma^(length-1-t), the last step of a segment counts fully
+        if length not in self.weights:
+            powers = torch.arange(length - 1, -1, -1, dtype=torch.float32, device=self.device)
+            self.weights[length] = self.gamma ** powers
+        return self.weights[length]
+
+    def label(self, r_t_1, r_t_2, thres_skip=0, thres_equal=0):
+        # r_t_1, r_t_2: (n, size_segment, 1) true rewards of both segments
+        # returns the mask of the pairs kept (not skipped) and their labels, (num_kept, 1)
+        r_t = torch.as_tensor(np.stack([r_t_1[..., 0], r_t_2[..., 0]]).astype(np.float32), device=self.device)
+        returns = r_t.sum(axis=-1)
+        discounted = r_t @ self.discount(r_t.shape[-1]) if self.gamma != 1 else returns
+        return self.label_returns(returns[0], returns[1], discounted[0], discounted[1], thres_skip, thres_equal)
+
+    def label_returns(self, sum_1, sum_2, disc_1, disc_2, thres_skip=0, thres_equal=0):
+        # same as label, from the (discounted) returns of the segments
+        # skip the query
+        keep = torch.maximum(sum_1, sum_2) > thres_skip if thres_skip > 0 else torch.ones_like(sum_1, dtype=torch.bool)
+        # equally preferable
+        equal = (sum_1 - sum_2).abs() < thres_equal
+
+        if self.beta > 0: # Bradley-Terry rational model
+            labels = torch.bernoulli(torch.sigmoid(self.beta * (disc_2 - disc_1))).long()
+        else: # perfectly rational
+            labels = (disc_1 < disc_2).long()
+
+        # making a mistake
+        mistake = torch.rand(labels.shape, device=labels.device) < self.eps_mistake
+        labels = torch.where(mistake, 1 - labels, labels)
+        labels = torch.where(equal, -torch.ones_like(labels), labels)
+        return keep.cpu().numpy(), labels[keep].cpu().numpy().reshape(-1, 1)
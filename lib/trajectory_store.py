@@ -0,0 +1,167 @@
+import threading
+import numpy as np
+from gymnasium.spaces import Box
+from gymnasium.spaces import utils as gym_utils
+
+class TrajectoryStore(object):
+    """Fixed capacity ring of flat (state, action) rows grouped into episodes."""
+    def __init__(self, obs_space, ds, da, capacity, max_episodes, dtype=np.float32):
+        self.obs_space = obs_space
+        self.ds = ds
+        self.da = da
+        self.capacity = int(capacity)
+        self.max_episodes = int(max_episodes)
+        self.dtype = dtype
+
+        self.inputs = np.empty((self.capacity, ds+da), dtype=dtype)
+        self.targets = np.empty((self.capacity, 1), dtype=np.float32)
+        self.snapshots = np.empty((self.capacity,), dtype=object)
+
+        # episode table: slot = episode id % table_size, starts are global row counters
+        self.table_size = self.max_episodes + 1     # completed episodes + the one being collected
+        self.ep_start = np.zeros(self.table_size, dtype=np.int64)
+        self.ep_len = np.zeros(self.table_size, dtype=np.int64)
+
+        self.ptr = 0            # global counter of written rows
+        self.first_ep = 0       # id of the oldest stored episode
+        self.next_ep = 0        # id given to the next episode
+        self.open = False       # True while the last episode is still being collected
+        self.on_evict = None    # called with the episode id before an episode is dropped
+        self.lock = threading.RLock()   # held by writers and by query selection running in another thread
+
+    def __len__(self):
+        # number of stored episodes, including the one being collected
+        return self.next_ep - self.first_ep
+
+    @property
+    def num_rows(self):
+        return min(self.ptr, self.capacity)
+
+    def flatten(self, obs):
+        # same result as gym_utils.flatten, without the per-call dispatch for Box spaces
+        if isinstance(self.obs_space, Box):
+            return np.asarray(obs, dtype=self.obs_space.dtype).reshape(-1)
+        return gym_utils.flatten(self.obs_space, obs)
+
+    def add(self, obs, act, rew, snapshot, done, flat=False):
+        flat_obs = obs if flat else self.flatten(obs)
+        with self.lock:
+            if not self.open:
+                self._start_episode()
+            pos = self._reserve_row()
+
+            self.inputs[pos, :self.ds] = flat_obs
+            self.inputs[pos, self.ds:] = act
+            self.targets[pos] = rew
+            self.snapshots[pos] = snapshot
+            self.ep_len[(self.next_ep - 1) % self.table_size] += 1
+
+            if done:
+                self._end_episode()
+
+    def add_episode(self, inputs, targets, snapshots, done=True):
+        # append a whole (already flattened) episode at once
+        with self.lock:
+            if self.open:
+                self._end_episode()
+            self._start_episode()
+            for t in range(len(inputs)):
+                pos = self._reserve_row()
+                self.inputs[pos] = inputs[t]
+                self.targets[pos] = targets[t]
+                self.snapshots[pos] = snapshots[t] if t < len(snapshots) else None
+                self.ep_len[(self.next_ep - 1) % self.table_size] += 1
+            if done:
+                self._end_episode()
+
+    def episode_ids(self):
+        return np.arange(self.first_ep, self.next_ep)
+
+    def lengths(self, ep_ids):
+        return self.ep_len[np.asarray(ep_ids) % self.table_size]
+
+    def starts(self, ep_ids):
+        return self.ep_start[np.asarray(ep_ids) % self.table_size]
+
+    def is_stored(self, ep_ids):
+        ep_ids = np.asarray(ep_ids)
+        return (ep_ids >= self.first_ep) & (ep_ids < self.next_ep)
+
+    def rows(self, ep_ids, offsets, length):
+        # physical row index of every step of every requested window: (n, length)
+        start = self.starts(ep_ids) + np.asarray(offsets)
+        return (start[:, None] + np.arange(length)[None, :]) % self.capacity
+
+    def episode(self, ep_id):
+        rows = self.rows([ep_id], [0], self.lengths([ep_id])[0])[0]
+        return self.inputs[rows], self.targets[rows], self.snapshots[rows]
+
+    def _start_episode(self):
+        if len(self) == self.table_size:
+            self._evict_episode()
+        slot = self.next_ep % self.table_size
+        self.ep_start[slot] = self.ptr
+        self.ep_len[slot] = 0
+        self.next_ep += 1
+        self.open = True
+
+    def _end_episode(self):
+        self.open = False
+        # FIFO on overflow
+        while len(self) > self.max_episodes:
+            self._evict_episode()
+
+    def _reserve_row(self):
+        # free the row about to be overwritten, dropping the episodes that own it
+        oldest_row = self.ptr - self.capacity
+        while oldest_row >= 0 and len(self) > 0:
+            slot = self.first_ep % self.table_size
+            if self.ep_start[slot] > oldest_row:
+                break
+            if len(self) == 1:
+                # a single episode longer than the store
+                self._split_episode()
+                break
+            self._evict_episode()
+        pos = self.ptr % self.capacity
+        self.ptr += 1
+        return pos
+
+    def _split_episode(self):
+        # the open episode is evicted under its id and its newest capacity // 2 rows go on under a new id,
+        # so this happens once every half ring instead of every step, and references into the evicted id
+        # are archived (or dropped) by on_evict instead of silently pointing at other steps
+        slot = self.first_ep % self.table_size
+        keep = min(int(self.ep_len[slot]), self.capacity // 2)
+        end = self.ep_start[slot] + self.ep_len[slot]
+        self._evict_episode()
+        self._start_episode()
+        slot = (self.next_ep - 1) % self.table_size
+        self.ep_start[slot] = end - keep
+        self.ep_len[slot] = keep
+
+    def _evict_episode(self):
+        if self.on_evict is not None:
+            self.on_evict(self.first_ep)
+        self.first_ep += 1
+
+    def state_dict(self):
+        # stored episodes in order, without the unused part of the ring
+        ep_ids = self.episode_ids()
+        lengths = self.lengths(ep_ids)
+        rows = np.concatenate([self.rows([i], [0], l)[0] for i, l in zip(ep_ids, lengths)]) if len(ep_ids) else np.zeros(0, dtype=np.int64)
+        return {'inputs': self.inputs[rows], 'targets': self.targets[rows], 'snapshots': self.snapshots[rows],
+                'lengths': lengths, 'first_ep': self.first_ep, 'open': self.open}
+
+    def load_state_dict(self, state):
+        self.ptr = 0
+        self.first_ep = self.next_ep = int(state['first_ep'])
+        self.open = False
+        start = 0
+        num_eps = len(state['lengths'])
+        for i, length in enumerate(state['lengths']):
+            end = start + int(length)
+            done = not (state['open'] and i == num_eps - 1)
+            self.add_episode(state['inputs'][start:end], state['targets'][start:end],
+                             state['snapshots'][start:end], done=done)
+            start = end
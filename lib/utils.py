@@ -66,7 +66,8 @@ def make_minigrid_env(cfg, render_mode=None):
                         )
                     ),
                     reward_scale = cfg.reward_scale,
-                    reward_intercept = cfg.reward_intercept
+                    reward_intercept = cfg.reward_intercept,
+                    normalize_obs = not cfg.pixel_uint8
                 ), 
                 cfg.domain), 
             max_episode_steps = 100)
@@ -81,7 +82,8 @@ def make_minigrid_env(cfg, render_mode=None):
                         )
                     ),
                     reward_scale = cfg.reward_scale,
-                    reward_intercept = cfg.reward_intercept
+                    reward_intercept = cfg.reward_intercept,
+                    normalize_obs = not cfg.pixel_uint8
                 ), 
                 max_episode_steps = 100)
 
@@ -97,7 +99,8 @@ def make_minigrid_env(cfg, render_mode=None):
                                 )
                             ),
                             reward_scale = cfg.reward_scale,
-                            reward_intercept = cfg.reward_intercept
+                            reward_intercept = cfg.reward_intercept,
+                            normalize_obs = not cfg.pixel_uint8
                         ), cfg.domain
                     ), 
                     max_episode_steps = 100)
@@ -299,7 +302,37 @@ def update_mean_var_count_from_moments(
 
     return new_mean, new_var, new_count
 
-def cnn(obs_space, n_input_channels, mode=0):
+class ObsStack(object):
+    """The last k frames of the running episode concatenated on the channel axis, as the agent acts on them."""
+    def __init__(self, k=1):
+        self.k = k
+        self.frames = deque([], maxlen=k)
+
+    def reset(self, obs):
+        # the first frame of an episode fills the whole stack
+        for _ in range(self.k):
+            self.frames.append(obs)
+        return self.stacked()
+
+    def step(self, obs):
+        self.frames.append(obs)
+        return self.stacked()
+
+    def stacked(self):
+        if self.k == 1:
+            return self.frames[-1]
+        return np.concatenate(self.frames, axis=-1)
+
+class PixelScale(nn.Module):
+    """Casts uint8 (or raw float) frames to float and divides them by scale."""
+    def __init__(self, scale=255.0):
+        super().__init__()
+        self.scale = scale
+
+    def forward(self, x):
+        return x.float() / self.scale
+
+def cnn(obs_space, n_input_channels, mode=0, obs_scale=1.0):
 
     kernel_size = [[8,4,3],[3,3,3]] # Parameterisation
     stride = [[4,2,1],[1,1,1]]
@@ -309,7 +342,10 @@ def cnn(obs_space, n_input_channels, mode=0):
     stride = stride[mode]
     padding = padding[mode]
 
+    # obs_scale != 1: the frames come unnormalized (uint8) and are scaled by the first layer
+    scale = [PixelScale(obs_scale)] if obs_scale != 1 else []
     feature_extractor=nn.Sequential(
+        *scale,
         nn.Conv2d(n_input_channels, 32, kernel_size=kernel_size[0], stride=stride[0], padding=padding[0]),
         nn.ReLU(),
         nn.Conv2d(32, 64, kernel_size=kernel_size[1], stride=stride[1], padding=padding[1]),
@@ -319,10 +355,10 @@ def cnn(obs_space, n_input_channels, mode=0):
         nn.Flatten(),
     )
     
-    # Compute shape by doing one forward pass
+    # Compute shape by doing one forward pass (n_input_channels can be frame_stack frames of obs_space)
     with torch.no_grad():
-        obs_sample = torch.as_tensor(obs_space.sample()[None]).permute(0, 3, 1, 2)
-        n_flatten = feature_extractor(obs_sample.float()).shape[1]
+        height, width = obs_space.shape[0], obs_space.shape[1]
+        n_flatten = feature_extractor(torch.zeros(1, n_input_channels, height, width)).shape[1]
     
     #feature_extractor
 
@@ -349,6 +385,12 @@ def to_np(t):
     else:
         return t.cpu().detach().numpy()
 
+def flatten_batch(obs_space, obses):
+    # same rows as gym_utils.flatten applied to each obs, with one reshape for Box spaces
+    if isinstance(obs_space, gym.spaces.Box):
+        return np.asarray(obses).reshape(len(obses), -1).astype(obs_space.dtype, copy=False)
+    return np.array([gym.spaces.utils.flatten(obs_space, obs) for obs in obses])
+
 class RewindWrapper(gym.Wrapper):
     def __init__(self, env, domain):
         super().__init__(env)
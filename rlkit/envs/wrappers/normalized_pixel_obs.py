@@ -14,10 +14,13 @@ class NormalizePixelObs(ProxyEnv):
             reward_scale=1.,
             reward_intercept = 0.,
             obs_std=255,
+            normalize_obs=True,
     ):
         ProxyEnv.__init__(self, env)
 
         self._obs_std = np.array(obs_std, dtype = "float32")
+        # False keeps the uint8 frames, the networks normalize the batches themselves
+        self._normalize_obs = normalize_obs
 
         self._reward_scale = reward_scale
         self._reward_intercept = reward_intercept
@@ -28,7 +31,8 @@ class NormalizePixelObs(ProxyEnv):
     def step(self, action):
         next_obs, reward, terminated, truncated, info = self._wrapped_env.step(action)
         
-        next_obs = self._apply_normalize_obs(next_obs)
+        if self._normalize_obs:
+            next_obs = self._apply_normalize_obs(next_obs)
         return next_obs, reward * self._reward_scale + self._reward_intercept, terminated, truncated, info
 
     def __str__(self):
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+from gymnasium.spaces import Box
+
+from lib.reward_model import RewardModel
+from lib.trajectory_store import TrajectoryStore
+from lib.replay_buffer import ReplayBuffer, TorchReplayBuffer, FrameReplayBuffer
+
+# factories shared by the test files, every one is a fixture returning a function so tests can build several objects
+
+@pytest.fixture
+def make_reward_model():
+    # reward model of 3 dim states and 2 dim continuous actions
+    def make(**kwargs):
+        torch.manual_seed(0)
+        config = dict(size_segment=5, capacity=100, traj_capacity=2000, mb_size=8, max_size=20)
+        config.update(kwargs)
+        return RewardModel(obs_space=Box(-np.inf, np.inf, (3,), np.float32), ds=3, da=2, action_type='Cont', **config)
+    return make
+
+@pytest.fixture
+def add_reward_steps():
+    # num_steps random steps in episodes of episode_len steps, the same steps for the same seed
+    def add(model, num_steps, episode_len=20, seed=0):
+        rng = np.random.default_rng(seed)
+        for t in range(num_steps):
+            model.add_data(rng.standard_normal(3).astype(np.float32), rng.standard_normal(2), float(rng.standard_normal()),
+                           False, (t + 1) % episode_len == 0, None)
+    return add
+
+@pytest.fixture
+def make_labeled_model(make_reward_model, add_reward_steps):
+    # reward model with num_steps random steps and rounds of labeled uniform queries, the same for the same seed
+    def make(rounds=3, num_steps=300, seed=0, **kwargs):
+        np.random.seed(seed)
+        model = make_reward_model(**kwargs)
+        add_reward_steps(model, num_steps)
+        for _ in range(rounds):
+            model.uniform_sampling()
+        return model
+    return make
+
+@pytest.fixture
+def make_store():
+    def make(capacity=10, max_episodes=4):
+        return TrajectoryStore(Box(-np.inf, np.inf, (2,), np.float32), ds=2, da=1, capacity=capacity, max_episodes=max_episodes)
+    return make
+
+@pytest.fixture
+def add_store_episode():
+    # steps carry (episode, step) in the state so a row tells where it came from
+    def add(store, ep, length):
+        for t in range(length):
+            store.add(np.array([ep, t], dtype=np.float32), [0.0], float(t), None, done=t == length - 1)
+    return add
+
+@pytest.fixture
+def make_buffer():
+    # replay buffer of 3 dim states and 2 dim actions, torch=True for the torch storage
+    def make(capacity=10, storage_dir=None, torch=False):
+        if torch:
+            return TorchReplayBuffer(Box(-np.inf, np.inf, (3,), np.float32), (3,), (2,), 'Cont', capacity, 'cpu')
+        return ReplayBuffer(Box(-np.inf, np.inf, (3,), np.float32), (3,), (2,), 'Cont', capacity, 'cpu', storage_dir=storage_dir)
+    return make
+
+@pytest.fixture
+def add_rows():
+    # num_rows random transitions, episodes of 4 steps
+    def add(buffer, num_rows, seed=0):
+        rng = np.random.default_rng(seed)
+        for t in range(num_rows):
+            buffer.add(rng.standard_normal(3), rng.standard_normal(2), rng.standard_normal(), rng.standard_normal(3), t % 4 == 3, False)
+    return add
+
+@pytest.fixture
+def make_frame_buffer():
+    # pixel replay buffer of (2, 2, 1) uint8 frames
+    def make(capacity=20, frame_stack=3, frame_capacity=0, storage_dir=None):
+        return FrameReplayBuffer(Box(0, 255, (2, 2, 1), np.uint8), (2, 2, 1), (1,), 'Cont', capacity, 'cpu',
+                                 frame_stack=frame_stack, frame_capacity=frame_capacity, storage_dir=storage_dir)
+    return make
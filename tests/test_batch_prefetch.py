@@ -0,0 +1,65 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+from lib.replay_buffer import BatchPrefetcher
+
+def wait_full(prefetcher):
+    for _ in range(100):
+        if prefetcher.batches.full():
+            return
+        time.sleep(0.01)
+    raise AssertionError('the prefetcher did not fill its queue')
+
+def test_batches_gathered_before_a_relabel_are_dropped(make_reward_model, make_buffer, add_rows):
+    np.random.seed(0)
+    buffer = make_buffer(capacity=50)
+    add_rows(buffer, 50)
+    prefetcher = BatchPrefetcher(buffer, batch_size=8, depth=2)
+    prefetcher.start()
+    wait_full(prefetcher)
+
+    # eager relabel: every reward changes, the queued batches hold the old ones
+    old_rewards = set(buffer.rewards[:, 0].tolist())
+    buffer.relabel_with_predictor(make_reward_model())
+    prefetcher.reset()
+    new_rewards = set(buffer.rewards[:, 0].tolist())
+    assert not old_rewards & new_rewards
+    for _ in range(5):
+        _, _, rewards, _, _, _ = prefetcher.sample(8)
+        assert set(rewards[:, 0].tolist()) <= new_rewards
+    prefetcher.close()
+
+def failing_gather(buffer, after):
+    calls = []
+    gather = buffer.gather
+    def gather_or_fail(idxs):
+        calls.append(idxs)
+        if len(calls) > after:
+            raise RuntimeError('gather failed')
+        return gather(idxs)
+    buffer.gather = gather_or_fail
+
+def test_an_error_with_a_full_queue_does_not_block_close(make_buffer, add_rows):
+    buffer = make_buffer(capacity=20)
+    add_rows(buffer, 20)
+    failing_gather(buffer, after=2)
+    prefetcher = BatchPrefetcher(buffer, batch_size=4, depth=2)
+    prefetcher.start()
+    wait_full(prefetcher)
+    closing = threading.Thread(target=prefetcher.close)
+    closing.start()
+    closing.join(timeout=5)
+    assert not closing.is_alive(), 'close waited for the worker'
+
+def test_an_error_drained_by_reset_is_still_raised(make_buffer, add_rows):
+    buffer = make_buffer(capacity=20)
+    add_rows(buffer, 20)
+    failing_gather(buffer, after=0)
+    prefetcher = BatchPrefetcher(buffer, batch_size=4, depth=2)
+    prefetcher.start()
+    prefetcher.worker.join(timeout=5)
+    prefetcher.reset()
+    with pytest.raises(RuntimeError, match='gather failed'):
+        prefetcher.sample(4)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import torch
+
+cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason='needs a cuda device')
+
+def test_stage_keeps_uint8_and_casts_float64_on_the_host(make_reward_model):
+    model = make_reward_model()
+    staged = model.stage(np.arange(6, dtype=np.uint8).reshape(2, 3))
+    assert staged.dtype == torch.uint8 and staged.device == model.device
+    assert model.stage(torch.ones(2)).device == model.device
+    # MuJoCo observations are float64
+    assert model.stage(np.ones((2, 5))).dtype == torch.float32
+    assert model.stage(torch.ones(2, dtype=torch.float64)).dtype == torch.float32
+    assert model.stage(np.arange(4)).dtype == torch.int64    # labels
+
+def test_predictions_stay_on_the_model_device(make_reward_model, add_reward_steps):
+    model = make_reward_model()
+    add_reward_steps(model, 40)
+    assert all(p.device == model.device for p in model.ensemble.parameters())
+    rewards = model.r_hat_batch(model.traj_store.inputs[:10])
+    assert torch.is_tensor(rewards) and rewards.device == model.device and rewards.shape == (10, 1)
+
+@cuda
+def test_cuda_model_matches_the_cpu_model(make_reward_model, add_reward_steps):
+    model, cuda_model = make_reward_model(), make_reward_model(device='cuda')
+    cuda_model.ensemble.load_state_dict(model.ensemble.state_dict())
+    add_reward_steps(model, 40)
+    x = model.traj_store.inputs[:20]
+    # the pinned staging buffer is reused by the second batch
+    for _ in range(2):
+        rewards = cuda_model.r_hat_batch(x)
+        assert rewards.is_cuda
+        torch.testing.assert_close(rewards.cpu(), model.r_hat_batch(x), rtol=1e-4, atol=1e-4)
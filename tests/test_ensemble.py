@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib.reward_model import EnsembleLinear
+
+def member_linear(layer, member):
+    # the nn.Linear equivalent to one member of an EnsembleLinear
+    linear = nn.Linear(layer.in_size, layer.out_size)
+    with torch.no_grad():
+        linear.weight.copy_(layer.weight[member])
+        linear.bias.copy_(layer.bias[member])
+    return linear
+
+def test_shared_and_per_member_inputs_match_separate_layers():
+    torch.manual_seed(0)
+    layer = EnsembleLinear(3, 5, 4)
+    x = torch.randn(7, 5)
+    per_member = torch.randn(3, 7, 5)
+    with torch.no_grad():
+        shared, separate = layer(x), layer(per_member)
+        for member in range(3):
+            linear = member_linear(layer, member)
+            torch.testing.assert_close(shared[member], linear(x))
+            torch.testing.assert_close(separate[member], linear(per_member[member]))
+
+def test_single_pass_matches_every_member_on_its_own(make_reward_model):
+    model = make_reward_model()
+    x = np.random.default_rng(0).standard_normal((4, 6, 5)).astype(np.float32)
+    with torch.no_grad():
+        r_hats = model.r_hat_ensemble(x)
+        assert r_hats.shape == (model.de, 4, 6, 1)
+        for member in range(model.de):
+            h = torch.as_tensor(x)
+            for module in model.ensemble:
+                h = member_linear(module, member)(h) if isinstance(module, EnsembleLinear) else module(h)
+            torch.testing.assert_close(r_hats[member], h)
+        # the mean over members, and one input per member
+        torch.testing.assert_close(model.r_hat_batch(x), r_hats.mean(axis=0))
+        stacked = np.stack([x] * model.de)
+        torch.testing.assert_close(model.r_hat_per_member(stacked), r_hats)
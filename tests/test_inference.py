@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+import numpy as np
+import torch
+import torch.nn as nn
+
+from lib.inference import prepare_checked, max_abs_error
+from agent.sac import SACAgent
+
+def mlp(scale=1.0):
+    torch.manual_seed(0)
+    module = nn.Sequential(nn.Linear(8, 64), nn.ReLU(), nn.Linear(64, 1))
+    with torch.no_grad():
+        for p in module.parameters():
+            p.mul_(scale)
+    return module
+
+def test_int8_within_tolerance_is_kept():
+    module, inputs = mlp(), torch.randn(64, 8)
+    prepared = prepare_checked(module, 'int8', inputs, tol=1.0)
+    error = max_abs_error(module, prepared, inputs)
+    assert 0 < error <= 1.0
+    assert 'quantized' in str(prepared.graph)
+
+def test_int8_off_by_more_than_tolerance_falls_back_to_float32(capsys):
+    # large weights and inputs: the int8 error is far above the tolerance
+    module, inputs = mlp(scale=50.0), 100 * torch.randn(64, 8)
+    prepared = prepare_checked(module, 'int8', inputs, tol=1e-3, name='test')
+    assert 'using float32 instead' in capsys.readouterr().out
+    assert 'quantized' not in str(prepared.graph)
+    with torch.no_grad():
+        torch.testing.assert_close(prepared(inputs), module(inputs), rtol=1e-4, atol=1e-2)
+
+def make_agent():
+    torch.manual_seed(0)
+    actor_cfg = SimpleNamespace(action_type='Cont', obs_dim=3, action_dim=2, policy='MLP',
+                                hidden_dim=16, hidden_depth=1, log_std_bounds=[-5, 2])
+    critic_cfg = SimpleNamespace(action_type='Cont', action_dim=2, policy='MLP', hidden_dim=16, hidden_depth=1)
+    return SACAgent(obs_space=None, obs_dim=3, action_dim=2, action_range=[-1, 1], device='cpu',
+                    critic_cfg=critic_cfg, actor_cfg=actor_cfg, discount=0.99, init_temperature=0.1,
+                    alpha_lr=1e-4, alpha_betas=[0.9, 0.999], actor_lr=1e-4, actor_betas=[0.9, 0.999],
+                    actor_update_frequency=1, critic_lr=1e-4, critic_betas=[0.9, 0.999], critic_tau=0.005,
+                    critic_target_update_frequency=2, batch_size=8, policy='MLP', learnable_temperature=True)
+
+def test_act_keeps_the_observations_before_a_refresh():
+    agent = make_agent()
+    agent.prepare_inference('jit', refresh=300, tol=0.01)
+    rng = np.random.default_rng(0)
+    observations = rng.standard_normal((301, 3)).astype(np.float32)
+    for obs in observations:
+        action = agent.act(obs)
+    # the first call, then the 255 calls just before the refresh of the last one
+    assert len(agent.act_history) == 256
+    np.testing.assert_array_equal(np.stack(agent.act_history), observations[-256:])
+    with torch.no_grad():
+        expected = agent.actor(torch.as_tensor(observations[-1:])).mean.clamp(-1, 1)[0].numpy()
+    np.testing.assert_allclose(action, expected, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,37 @@
+import numpy as np
+import torch
+
+from lib.reward_model import KCenterGreedy, compute_smallest_dist
+
+def baseline_kcenter(obs, full_obs, num_new_sample):
+    # the original selection: distances of the remaining candidates recomputed against every center each step
+    selected_index = []
+    current_index = list(range(obs.shape[0]))
+    centers = full_obs
+    for count in range(num_new_sample):
+        dist = torch.cdist(torch.as_tensor(obs[current_index]), torch.as_tensor(centers)).min(dim=1).values
+        max_index = current_index[torch.argmax(dist).item()]
+        selected_index.append(max_index)
+        current_index.remove(max_index)
+        centers = np.concatenate([full_obs, obs[selected_index]], axis=0)
+    return selected_index
+
+def test_smallest_dist_over_chunks():
+    rng = np.random.default_rng(0)
+    obs = rng.standard_normal((70, 8)).astype(np.float32)
+    full_obs = rng.standard_normal((2500, 8)).astype(np.float32)
+    expected = torch.cdist(torch.as_tensor(obs), torch.as_tensor(full_obs)).min(dim=1).values
+    torch.testing.assert_close(compute_smallest_dist(obs, full_obs, batch_size=1000), expected, rtol=1e-4, atol=1e-4)
+
+def test_same_selection_as_the_baseline():
+    rng = np.random.default_rng(1)
+    for num_candidates, num_labeled, dim in [(200, 50, 16), (64, 300, 4), (30, 1, 32)]:
+        obs = rng.standard_normal((num_candidates, dim)).astype(np.float32)
+        full_obs = rng.standard_normal((num_labeled, dim)).astype(np.float32)
+        assert KCenterGreedy(obs, full_obs, 20) == baseline_kcenter(obs, full_obs, 20)
+
+def test_selects_each_candidate_once():
+    rng = np.random.default_rng(2)
+    obs = rng.standard_normal((10, 3)).astype(np.float32)
+    selected = KCenterGreedy(obs, obs[:2], 15)
+    assert sorted(selected) == list(range(10))
@@ -0,0 +1,93 @@
+import numpy as np
+
+from lib.label_journal import LabelJournal
+
+def test_read_stops_at_a_partial_record(tmp_path):
+    path = tmp_path / 'labels.journal'
+    journal = LabelJournal(path)
+    for i in range(3):
+        journal.append({'round': i + 1, 'labels': np.arange(i + 1)})
+    journal.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x80\x04\x95')   # a record cut by a crash
+    records = LabelJournal.read(path)
+    assert [r['round'] for r in records] == [1, 2, 3]
+    assert np.array_equal(records[2]['labels'], np.arange(3))
+    assert LabelJournal.read(tmp_path / 'missing.journal') == []
+
+def test_replay_rebuilds_the_preference_buffer(tmp_path, make_reward_model, make_labeled_model, add_reward_steps):
+    path = tmp_path / 'labels.journal'
+    model = make_labeled_model(rounds=0, num_steps=200)
+    model.journal = LabelJournal(path)
+    for _ in range(3):
+        model.uniform_sampling()
+    model.journal.close()
+
+    restored = make_reward_model()
+    add_reward_steps(restored, 200)
+    assert restored.load_journal(LabelJournal.read(path)) == 24
+    rows = model.labeled_rows()
+    assert np.array_equal(restored.labeled_rows(), rows)
+    assert restored.label_round == model.label_round
+    for k in ['buffer_ref1', 'buffer_ref2', 'buffer_label', 'buffer_round']:
+        assert np.array_equal(restored.__dict__[k][rows], model.__dict__[k][rows]), k
+    # records of rounds the buffer already holds are skipped
+    assert restored.load_journal(LabelJournal.read(path)) == 0
+
+def test_replay_without_the_trajectories_uses_the_recorded_segments(tmp_path, make_reward_model, make_labeled_model):
+    path = tmp_path / 'labels.journal'
+    model = make_labeled_model(rounds=0, num_steps=200, seed=1)
+    model.journal = LabelJournal(path)
+    model.uniform_sampling()
+    model.journal.close()
+
+    # a store holding nothing of those episodes: every segment comes from the journal
+    restored = make_reward_model(traj_capacity=1)
+    assert restored.load_journal(LabelJournal.read(path)) == 8
+    rows = model.labeled_rows()
+    assert restored.buffer_archived[rows].all()
+    for side in [0, 1]:
+        np.testing.assert_allclose(restored.pref_segments(rows, side), model.pref_segments(rows, side), atol=1e-2)
+
+def test_snapshot_round_trip_of_the_preference_buffer(tmp_path, make_reward_model, make_labeled_model, add_reward_steps):
+    model = make_labeled_model(rounds=2, seed=2, traj_capacity=300, dedup_quantum=0.5)
+    add_reward_steps(model, 100, seed=1)   # some labeled segments are archived
+    assert model.buffer_archived.any()
+    model.save(tmp_path, 0)
+
+    restored = make_reward_model(traj_capacity=300, dedup_quantum=0.5)
+    restored.load(tmp_path, 0)
+    rows = model.labeled_rows()
+    assert np.array_equal(restored.labeled_rows(), rows)
+    assert restored.query_index.pairs == model.query_index.pairs
+    for side in [0, 1]:
+        np.testing.assert_array_equal(restored.pref_segments(rows, side), model.pref_segments(rows, side))
+
+def test_resume_does_not_trust_episodes_open_or_issued_after_the_snapshot(tmp_path, make_reward_model, make_labeled_model,
+                                                                            add_reward_steps):
+    path = tmp_path / 'labels.journal'
+    model = make_labeled_model(rounds=1, num_steps=210, traj_capacity=1000)   # the last episode is open
+    model.save(tmp_path, 0)
+    closed_until = model.traj_store.next_ep - 1
+
+    # the interrupted run finishes that episode and starts new ones before labeling again
+    model.journal = LabelJournal(path)
+    add_reward_steps(model, 150, seed=1)
+    for _ in range(4):
+        model.uniform_sampling()
+    model.journal.close()
+    rows = np.setdiff1d(model.labeled_rows(), np.arange(8))
+    late = (model.buffer_ref1[rows, 0] >= closed_until) | (model.buffer_ref2[rows, 0] >= closed_until)
+    assert late.any()
+
+    restored = make_reward_model(traj_capacity=1000)
+    restored.load(tmp_path, 0)
+    assert restored.load_journal(LabelJournal.read(path)) == len(rows)
+    for side, refs in enumerate([restored.buffer_ref1, restored.buffer_ref2]):
+        reissued = refs[rows, 0] >= closed_until
+        assert restored.buffer_archived[rows[reissued], side].all()
+        assert not restored.buffer_archived[rows[~reissued], side].any()
+        np.testing.assert_allclose(restored.pref_segments(rows, side), model.pref_segments(rows, side), atol=1e-2)
+    # the resumed run issues those ids again, their pairs are not known anymore
+    assert all(key[2] < closed_until for key in restored.query_index.pairs)
+    assert restored.query_index.new_mask(restored.buffer_ref1[rows[late]], restored.buffer_ref2[rows[late]]).all()
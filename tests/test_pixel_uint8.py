@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+from gymnasium.spaces import Box
+
+import lib.utils as utils
+from lib.replay_buffer import ReplayBuffer
+from lib.reward_model import RewardModel
+
+def test_scaled_cnn_matches_the_cnn_on_normalized_frames():
+    obs_space = Box(0, 255, (7, 7, 3), np.uint8)
+    torch.manual_seed(0)
+    cnn, flatten = utils.cnn(obs_space, 3, mode=1)
+    scaled_cnn, scaled_flatten = utils.cnn(obs_space, 3, mode=1, obs_scale=255.0)
+    assert isinstance(scaled_cnn[0], utils.PixelScale) and scaled_flatten == flatten
+    with torch.no_grad():
+        for scaled_param, param in zip(scaled_cnn.parameters(), cnn.parameters()):
+            scaled_param.copy_(param)
+    frames = torch.as_tensor(np.random.default_rng(0).integers(0, 256, (4, 3, 7, 7), dtype=np.uint8))
+    with torch.no_grad():
+        torch.testing.assert_close(scaled_cnn(frames), cnn(frames.float() / 255))
+
+def test_replay_buffer_keeps_uint8_frames():
+    obs_space = Box(0, 255, (7, 7, 3), np.uint8)
+    buffer = ReplayBuffer(obs_space, (7, 7, 3), (1,), 'Discrete', 8, 'cpu', obs_dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, (9, 7, 7, 3), dtype=np.uint8)
+    for t in range(8):
+        buffer.add(frames[t], np.array([t % 3], dtype=np.uint8), 0.0, frames[t + 1], False, False)
+    assert buffer.obses.dtype == np.uint8 and buffer.next_obses.dtype == np.uint8
+    np.testing.assert_array_equal(buffer.obses, frames[:8])
+    obses, _, _, next_obses, _, _ = buffer.sample(4)
+    assert obses.max() > 1    # not normalized on the way
+    for obs, next_obs in zip(obses.numpy(), next_obses.numpy()):
+        t = np.flatnonzero((buffer.obses == obs).all(axis=(1, 2, 3)))[0]
+        np.testing.assert_array_equal(next_obs, frames[t + 1])
+
+def test_reward_model_scales_uint8_states():
+    def model(obs_scale):
+        torch.manual_seed(0)
+        return RewardModel(obs_space=Box(0, 255, (6,), np.uint8), ds=6, da=1, action_type='Discrete',
+                           size_segment=5, capacity=10, traj_capacity=100, obs_scale=obs_scale)
+    scaled, plain = model(255.0), model(1.0)
+    assert scaled.seg_dtype == np.uint8
+    rng = np.random.default_rng(0)
+    x = np.concatenate([rng.integers(0, 256, (4, 6)), rng.integers(0, 3, (4, 1))], axis=-1).astype(np.uint8)
+    normalized = np.concatenate([x[:, :6] / 255, x[:, 6:]], axis=-1).astype(np.float32)
+    torch.testing.assert_close(scaled.r_hat_batch(x), plain.r_hat_batch(normalized))
+    # the trajectory store keeps the frames as they are
+    for t in range(4):
+        scaled.add_data(x[t, :6], x[t, 6:], 0.0, False, t == 3, None)
+    np.testing.assert_array_equal(scaled.traj_store.inputs[:4], x)
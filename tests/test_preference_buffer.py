@@ -0,0 +1,38 @@
+import numpy as np
+
+def test_labels_keep_references_to_the_store(make_labeled_model):
+    model = make_labeled_model(rounds=1, num_steps=200, traj_capacity=200)
+    rows = model.labeled_rows()
+    assert len(rows) == 8 and not model.buffer_archived.any()
+    for side, refs in enumerate([model.buffer_ref1, model.buffer_ref2]):
+        sa_t, _, _ = model.get_segments(refs[rows, 0], refs[rows, 1], refs[rows, 2])
+        np.testing.assert_array_equal(model.pref_segments(rows, side), sa_t)
+
+def test_evicted_segments_are_archived(make_labeled_model, add_reward_steps):
+    model = make_labeled_model(rounds=1, num_steps=200, traj_capacity=200)
+    rows = model.labeled_rows()
+    segments = [model.pref_segments(rows, side) for side in range(2)]
+    add_reward_steps(model, 200, seed=1)
+    assert not model.traj_store.is_stored(model.buffer_ref1[rows, 0]).any()
+    assert model.buffer_archived[rows].all() and len(model.archive) == 2 * len(rows)
+    for side in range(2):
+        np.testing.assert_allclose(model.pref_segments(rows, side), segments[side], atol=1e-2)   # float16 archive
+
+def test_evicted_labels_are_dropped_without_archive(make_labeled_model, add_reward_steps):
+    model = make_labeled_model(rounds=1, num_steps=200, traj_capacity=200, pref_archive='none')
+    add_reward_steps(model, 200, seed=1)
+    assert len(model.labeled_rows()) == 0 and len(model.archive) == 0
+
+def test_pairs_evicted_before_labeling_use_their_gathered_segments(make_labeled_model, add_reward_steps):
+    model = make_labeled_model(rounds=0, num_steps=200, seed=1, traj_capacity=200)
+    queries = model.uniform_queries()
+    sa_t_1, sa_t_2, refs_1, refs_2 = queries[0], queries[1], queries[6], queries[7]
+    add_reward_steps(model, 200, seed=1)
+    labels = np.zeros((len(refs_1), 1))
+    model.put_queries(refs_1, refs_2, labels, sa_t_1, sa_t_2)
+    rows = model.labeled_rows()
+    assert len(rows) == len(refs_1) and model.buffer_archived[rows].all()
+    np.testing.assert_allclose(model.pref_segments(rows, 0), sa_t_1, atol=1e-2)
+    # without the segments the labels are dropped
+    model.put_queries(refs_1, refs_2, labels)
+    assert len(model.labeled_rows()) == len(refs_1)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from lib.query_index import QueryIndex
+
+def test_known_and_repeated_pairs_are_rejected():
+    index = QueryIndex()
+    index.add(np.array([[1, 2, 5]]), np.array([[3, 0, 5]]))
+    refs_1 = np.array([[3, 0, 5], [1, 2, 5], [4, 4, 5], [4, 4, 5]])
+    refs_2 = np.array([[1, 2, 5], [3, 1, 5], [0, 0, 5], [0, 0, 5]])
+    # the known pair in the other order, a new pair, a new pair and its repetition
+    assert list(index.new_mask(refs_1, refs_2)) == [False, True, True, False]
+
+def test_near_duplicate_signatures_are_rejected():
+    index = QueryIndex(quantum=0.5)
+    index.add_signatures(np.array([[0.1, 0.2]]), np.array([[1.1, 1.2]]))
+    refs = np.array([[0, 0, 5], [0, 1, 5], [0, 2, 5]])
+    sig_1 = np.array([[1.2, 1.4], [0.9, 1.2], [0.1, 0.2]])
+    sig_2 = np.array([[0.0, 0.4], [0.1, 0.2], [5.0, 5.0]])
+    # the first pair falls in the cells of the known pair (swapped), the second one does not
+    assert list(index.new_mask(refs, refs + [1, 0, 0], sig_1, sig_2)) == [False, True, True]
+
+def test_sampled_queries_are_never_repeated(make_reward_model, add_reward_steps):
+    np.random.seed(0)
+    model = make_reward_model(size_segment=5)
+    add_reward_steps(model, 40, episode_len=10)     # few distinct segments, repeats are likely
+    seen = set()
+    for _ in range(6):
+        model.uniform_sampling()
+        rows = model.labeled_rows()
+        keys = model.query_index.pair_keys(model.buffer_ref1[rows], model.buffer_ref2[rows])
+        assert len(set(keys)) == len(keys)
+        seen.update(keys)
+    assert seen == model.query_index.pairs
@@ -0,0 +1,38 @@
+import threading
+import numpy as np
+
+from lib.reward_model import RewardModel
+from lib.query_pipeline import QueryPrefetcher
+
+def test_add_data_runs_while_the_prefetcher_scores(make_labeled_model, add_reward_steps, monkeypatch):
+    model = make_labeled_model(rounds=1, traj_capacity=300, large_batch=8)
+
+    # hold the selection in the middle of its scoring
+    scoring, release = threading.Event(), threading.Event()
+    get_rank_probability_refs = RewardModel.get_rank_probability_refs
+    def blocked(self, refs_1, refs_2):
+        scoring.set()
+        release.wait(timeout=10)
+        return get_rank_probability_refs(self, refs_1, refs_2)
+    monkeypatch.setattr(RewardModel, 'get_rank_probability_refs', blocked)
+
+    prefetcher = QueryPrefetcher(model, feed_type=4)
+    prefetcher.start()
+    assert scoring.wait(timeout=10)
+    # the main loop keeps collecting, evicting the trajectories of some candidates
+    writer = threading.Thread(target=add_reward_steps, args=(model, 150), kwargs={'seed': 1})
+    writer.start()
+    writer.join(timeout=10)
+    assert not writer.is_alive(), 'add_data waited for the query selection'
+    release.set()
+
+    queries, _ = prefetcher.get()
+    sa_t_1, sa_t_2, refs_1, refs_2 = queries[0], queries[1], queries[6], queries[7]
+    assert 0 < len(refs_1) <= model.mb_size
+    add_reward_steps(model, 300, seed=2)    # evicts the rest before labeling
+    num_labels = model.label_queries(queries, rendered=True)
+    assert num_labels == len(refs_1)
+    rows = np.arange(model.buffer_index - num_labels, model.buffer_index)
+    assert model.buffer_archived[rows].all()
+    np.testing.assert_allclose(model.pref_segments(rows, 0), sa_t_1, atol=1e-2)   # float16 archive
+    np.testing.assert_allclose(model.pref_segments(rows, 1), sa_t_2, atol=1e-2)
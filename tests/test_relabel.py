@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+
+from lib.replay_buffer import PendingRewards
+
+def predicted(model, buffer, rows):
+    inputs = np.concatenate([buffer.obses[rows], buffer.actions[rows]], axis=-1)
+    with torch.no_grad():
+        return model.r_hat_ensemble(inputs).mean(axis=0).numpy()
+
+def test_chunked_relabel_matches_the_model(make_reward_model, make_buffer, add_rows):
+    model = make_reward_model()
+    buffer = make_buffer(capacity=10)
+    buffer.relabel_batch_size = 3
+    add_rows(buffer, 13)
+    model.model_version = 4
+    buffer.relabel_with_predictor(model)
+    np.testing.assert_allclose(buffer.rewards, predicted(model, buffer, np.arange(10)), rtol=1e-5, atol=1e-6)
+    assert (buffer.reward_versions == 4).all()
+
+def test_one_version_per_training_round(make_labeled_model):
+    model = make_labeled_model()
+    version = model.model_version
+    model.fit(max_epochs=5, acc_stop=1.1)
+    assert model.model_version == version + 1
+
+def test_stale_rows_are_relabeled_when_sampled(make_reward_model, make_buffer, add_rows):
+    np.random.seed(0)
+    model = make_reward_model()
+    buffer = make_buffer(capacity=50)
+    buffer.set_predictor(model)
+    add_rows(buffer, 50)
+    assert (buffer.reward_versions == model.model_version).all()
+    old_rewards = buffer.rewards.copy()
+
+    model.model_version += 1
+    buffer.sample(8)
+    fresh = np.flatnonzero(buffer.reward_versions == model.model_version)
+    assert 0 < len(fresh) <= 8
+    np.testing.assert_allclose(buffer.rewards[fresh], predicted(model, buffer, fresh), rtol=1e-5, atol=1e-6)
+    stale = np.setdiff1d(np.arange(50), fresh)
+    np.testing.assert_array_equal(buffer.rewards[stale], old_rewards[stale])
+
+def test_sweep_refreshes_the_next_rows(make_reward_model, make_buffer, add_rows):
+    model = make_reward_model()
+    buffer = make_buffer(capacity=20)
+    buffer.set_predictor(model)
+    add_rows(buffer, 20)
+    model.model_version += 1
+    buffer.sweep(15)
+    buffer.sweep(15)   # wraps around to the first rows
+    assert (buffer.reward_versions == model.model_version).all()
+    np.testing.assert_allclose(buffer.rewards, predicted(model, buffer, np.arange(20)), rtol=1e-5, atol=1e-6)
+
+def test_pending_rewards_are_predicted_together(make_reward_model, make_buffer):
+    model = make_reward_model()
+    buffer = make_buffer(capacity=10)
+    pending = PendingRewards(buffer, model, flush_every=4)
+    rng = np.random.default_rng(0)
+    sums = []
+    for row in range(6):
+        obs, action = rng.standard_normal(3).astype(np.float32), rng.standard_normal(2).astype(np.float32)
+        buffer.add(obs, action, 0.0, obs, False, False)
+        sums.append(pending.add(row, obs, action))
+    # a flush on the fourth row, the last two rows are still pending
+    assert sums[:3] == [0.0] * 3 and sums[4:] == [0.0] * 2
+    assert list(buffer.reward_versions[:6]) == [model.model_version] * 4 + [-1] * 2
+    np.testing.assert_allclose(sums[3], predicted(model, buffer, np.arange(4)).sum(), rtol=1e-5)
+    pending.flush()
+    np.testing.assert_allclose(buffer.rewards[:6], predicted(model, buffer, np.arange(6)), rtol=1e-5, atol=1e-6)
+    assert pending.flush() == 0.0
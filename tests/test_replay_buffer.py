@@ -0,0 +1,161 @@
+import os
+import numpy as np
+import torch
+
+def frame(value):
+    return np.full((2, 2, 1), value, dtype=np.uint8)
+
+def stack(*values):
+    # the stacked observation of frames with these values, oldest first on the channel axis
+    return np.concatenate([frame(v) for v in values], axis=-1)
+
+def add_frame_episode(buffer, first, length):
+    # frames first, first+1, ..., first+length: length transitions, the last one ends the episode
+    for t in range(length):
+        buffer.add(frame(first + t), [0.0], 0.0, frame(first + t + 1), t == length - 1, t == length - 1)
+
+def test_frame_stacks_repeat_the_first_frame_of_the_episode(make_frame_buffer):
+    buffer = make_frame_buffer()
+    add_frame_episode(buffer, 10, 3)
+    add_frame_episode(buffer, 50, 2)
+    assert buffer.frames_written == 4 + 3
+
+    obs = buffer.observations(np.arange(5))
+    next_obs = buffer.observations(np.arange(5), next_obs=True)
+    expected = [stack(10, 10, 10), stack(10, 10, 11), stack(10, 11, 12), stack(50, 50, 50), stack(50, 50, 51)]
+    expected_next = [stack(10, 10, 11), stack(10, 11, 12), stack(11, 12, 13), stack(50, 50, 51), stack(50, 51, 52)]
+    assert np.array_equal(obs, np.stack(expected))
+    assert np.array_equal(next_obs, np.stack(expected_next))
+    # the reward model sees the newest frame alone
+    assert np.array_equal(buffer.reward_obs(np.arange(5)), np.stack([frame(v) for v in [10, 11, 12, 50, 51]]))
+
+def test_rows_whose_frames_were_overwritten_are_not_sampled(make_frame_buffer):
+    buffer = make_frame_buffer(capacity=8, frame_capacity=6)
+    add_frame_episode(buffer, 0, 4)
+    add_frame_episode(buffer, 100, 3)   # 9 frames written in a ring of 6, frames 0-2 are gone
+    # the stack of the last row of the first episode still reaches frames 1 and 2
+    assert list(buffer.valid(np.arange(7))) == [False, False, False, False, True, True, True]
+    idxs = buffer.sample_idxs(200)
+    assert (idxs >= 4).all()
+    assert np.array_equal(buffer.observations(np.array([6])), stack(100, 101, 102)[None])
+
+def test_add_batch_matches_add(make_frame_buffer):
+    rng = np.random.default_rng(0)
+    ends = rng.random(40) < 0.2
+    starts = np.concatenate([[True], ends[:-1]])
+    frames = rng.integers(0, 256, (41, 2, 2, 1), dtype=np.uint8)
+    next_frames = frames[1:]
+    # an episode goes on from the last next_obs, a new one starts from a new frame
+    obs = np.where(starts[:, None, None, None], rng.integers(0, 256, (40, 2, 2, 1), dtype=np.uint8), frames[:-1])
+    actions, rewards = rng.standard_normal((40, 1)), rng.standard_normal((40, 1))
+    done = ends.astype(np.float32)[:, None]
+
+    rows, batches = make_frame_buffer(capacity=8, frame_capacity=10), make_frame_buffer(capacity=8, frame_capacity=10)
+    for i in range(40):
+        rows.add(obs[i], actions[i], rewards[i], next_frames[i], ends[i], ends[i])
+    # batches across episodes, and batches longer than the rows and the frames
+    for start, end in [(0, 3), (3, 4), (4, 16), (16, 29), (29, 40)]:
+        batches.add_batch(obs[start:end], actions[start:end], rewards[start:end], next_frames[start:end],
+                          done[start:end], done[start:end])
+        assert batches.frames_written == rows.frames_written - sum(starts[end:]) - (40 - end)
+    assert (batches.idx, batches.full, batches.episode_start) == (rows.idx, rows.full, rows.episode_start)
+    for k in ['frames', 'frame_idx', 'ep_start', 'actions', 'rewards', 'not_dones', 'not_dones_no_max']:
+        assert np.array_equal(batches.__dict__[k], rows.__dict__[k]), k
+
+class SumPredictor(object):
+    model_version = 3
+
+    def r_hat_batch(self, inputs):
+        return torch.as_tensor(inputs).sum(axis=-1, keepdims=True)
+
+def test_relabel_leaves_rows_whose_frames_were_overwritten(make_frame_buffer):
+    buffer = make_frame_buffer(capacity=8, frame_capacity=6)
+    add_frame_episode(buffer, 0, 4)
+    add_frame_episode(buffer, 100, 3)
+    buffer.relabel_with_predictor(SumPredictor())
+    assert list(buffer.reward_versions[:7]) == [-1] * 4 + [3] * 3
+    assert list(buffer.rewards[:7, 0]) == [0.0] * 4 + [4 * 100.0, 4 * 101.0, 4 * 102.0]
+
+def assert_same_rows(buffer, other):
+    assert (buffer.idx, buffer.full) == (other.idx, other.full)
+    for k in ['obses', 'next_obses', 'actions', 'rewards', 'not_dones', 'not_dones_no_max']:
+        assert np.array_equal(np.asarray(buffer.__dict__[k]), np.asarray(other.__dict__[k])), k
+
+def test_memmap_snapshot_round_trip(tmp_path, make_buffer, add_rows):
+    storage_dir = tmp_path / 'storage'
+    buffer = make_buffer(storage_dir=storage_dir)
+    add_rows(buffer, 13)
+    buffer.save(tmp_path, 100)
+
+    loaded = make_buffer(storage_dir=storage_dir)
+    assert loaded.storage_dir != buffer.storage_dir
+    loaded.load(tmp_path, 100)
+    assert_same_rows(loaded, buffer)
+
+    # the loaded buffer writes into its own copy, the snapshot files stay as they were saved
+    add_rows(loaded, 4, seed=1)
+    loaded.save(tmp_path, 200)
+    again = make_buffer(storage_dir=storage_dir)
+    again.load(tmp_path, 100)
+    assert_same_rows(again, buffer)
+    latest = make_buffer(storage_dir=storage_dir)
+    latest.load(tmp_path, 200)
+    assert_same_rows(latest, loaded)
+
+def test_memmap_snapshot_outlives_the_buffer_files(tmp_path, make_buffer, add_rows):
+    buffer = make_buffer(storage_dir=tmp_path / 'storage')
+    add_rows(buffer, 3)
+    buffer.save(tmp_path, 0)
+    expected = make_buffer(storage_dir=tmp_path / 'storage')
+    add_rows(expected, 3)
+    # a buffer can go back to its own snapshot
+    add_rows(buffer, 5, seed=1)
+    buffer.load(tmp_path, 0)
+    assert_same_rows(buffer, expected)
+
+    storage_dir = buffer.storage_dir
+    buffer.close()
+    assert not os.path.exists(storage_dir)
+    loaded = make_buffer(storage_dir=tmp_path / 'storage')
+    loaded.load(tmp_path, 0)
+    assert_same_rows(loaded, expected)
+    loaded.close()
+    expected.close()
+    assert os.listdir(tmp_path / 'storage') == []
+
+def test_memmap_frame_buffer_round_trip(tmp_path, make_frame_buffer):
+    buffer = make_frame_buffer(storage_dir=tmp_path / 'storage')
+    add_frame_episode(buffer, 10, 3)
+    add_frame_episode(buffer, 50, 2)
+    buffer.save(tmp_path, 0)
+
+    loaded = make_frame_buffer(storage_dir=tmp_path / 'storage')
+    loaded.load(tmp_path, 0)
+    assert loaded.frames_written == buffer.frames_written
+    assert np.array_equal(loaded.observations(np.arange(5)), buffer.observations(np.arange(5)))
+    # a new episode starts after the load
+    add_frame_episode(loaded, 80, 1)
+    assert np.array_equal(loaded.observations(np.array([5])), stack(80, 80, 80)[None])
+
+def test_torch_storage_matches_numpy_storage(make_buffer, add_rows):
+    buffer, torch_buffer = make_buffer(), make_buffer(torch=True)
+    add_rows(buffer, 13)
+    add_rows(torch_buffer, 13)
+    assert_same_rows(torch_buffer, buffer)
+    idxs = np.array([0, 4, 9, 2])
+    for x, y in zip(torch_buffer.gather(idxs), buffer.gather(idxs)):
+        assert np.array_equal(x.numpy(), y)
+
+def test_torch_storage_save_load_round_trip(tmp_path, make_buffer, add_rows):
+    torch_buffer = make_buffer(torch=True)
+    add_rows(torch_buffer, 7)
+    torch_buffer.save(tmp_path, 0)
+
+    # the snapshot holds numpy arrays, loadable by either storage
+    loaded, numpy_loaded = make_buffer(torch=True), make_buffer()
+    loaded.load(tmp_path, 0)
+    numpy_loaded.load(tmp_path, 0)
+    assert all(torch.is_tensor(loaded.__dict__[k]) for k in ['obses', 'actions', 'rewards', 'not_dones'])
+    assert_same_rows(loaded, numpy_loaded)
+    for k in ['obses', 'next_obses', 'actions', 'rewards', 'not_dones', 'not_dones_no_max']:
+        assert np.array_equal(loaded.__dict__[k][:7].numpy(), torch_buffer.__dict__[k][:7].numpy()), k
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import torch
+
+from lib.label_journal import LabelJournal
+from themis_reward_offline import train_config
+
+def write_journal(path, make_labeled_model, rounds=3):
+    model = make_labeled_model(rounds=0, num_steps=200)
+    model.journal = LabelJournal(path)
+    for _ in range(rounds):
+        model.uniform_sampling()
+    model.journal.close()
+    return model
+
+def test_weights_round_trip(tmp_path, make_reward_model):
+    model = make_reward_model()
+    model.save_weights(tmp_path / 'weights.pt')
+    restored = make_reward_model()
+    torch.manual_seed(1)
+    for p in restored.ensemble.parameters():
+        torch.nn.init.normal_(p)
+    version = restored.model_version
+    restored.load_weights(tmp_path / 'weights.pt')
+    assert restored.model_version == version + 1
+    x = np.random.default_rng(0).standard_normal((6, 5)).astype(np.float32)
+    torch.testing.assert_close(restored.r_hat_batch(x), model.r_hat_batch(x))
+
+def test_weights_of_another_configuration_are_rejected(tmp_path, make_reward_model):
+    make_reward_model(activation='sig').save_weights(tmp_path / 'weights.pt')
+    with pytest.raises(ValueError, match='activation=sig'):
+        make_reward_model().load_weights(tmp_path / 'weights.pt')
+
+def test_train_config_exports_loadable_weights(tmp_path, make_reward_model, make_labeled_model):
+    path = tmp_path / 'labels.journal'
+    model = write_journal(path, make_labeled_model)
+    cfg = SimpleNamespace(journals=[str(path)], threads_per_config=1, seed=1, state_dim=None, obs_scale=1.0,
+                          action_type='Cont', reward_update=3, reward_val_ratio=0.25, reward_patience=0, device='cpu')
+    params = dict(ensemble_size=2, reward_lr=1e-3, activation='tanh', segment=4)
+    result = train_config((cfg, params, tmp_path))
+    assert result['labels'] == len(model.labeled_rows()) and result['skipped'] == 0
+    assert 0 <= result['val_acc'] <= 1
+
+    restored = make_reward_model(ensemble_size=2, size_segment=4)
+    restored.load_weights(result['path'])
+
+    # segments longer than the recorded ones are skipped
+    result = train_config((cfg, dict(params, segment=6), tmp_path))
+    assert result['labels'] == 0 and result['skipped'] == len(model.labeled_rows())
@@ -0,0 +1,88 @@
+import pickle
+import threading
+import numpy as np
+import pytest
+import torch
+
+from lib.reward_server import RewardServer, RewardClient
+
+@pytest.fixture
+def served(tmp_path, make_reward_model):
+    model = make_reward_model()
+    server = RewardServer(model, tmp_path / 'reward.sock')
+    yield model, server
+    server.close()
+
+def test_round_trip_matches_the_model(tmp_path, served):
+    model, _ = served
+    client = RewardClient(tmp_path / 'reward.sock')
+    x = np.random.default_rng(0).standard_normal((4, 6, 5)).astype(np.float32)
+    rewards = client.r_hat_batch(x)
+    assert torch.is_tensor(rewards) and rewards.shape == (4, 6, 1)
+    torch.testing.assert_close(rewards, model.r_hat_batch(x), rtol=1e-5, atol=1e-6)
+    assert client.model_version == model.model_version
+    assert client.r_hat(x[0, 0]) == pytest.approx(model.r_hat(x[0, 0]), abs=1e-6)
+    client.close()
+
+def test_a_bad_request_gets_an_error_reply(tmp_path, served):
+    model, _ = served
+    client = RewardClient(tmp_path / 'reward.sock')
+    with pytest.raises(RuntimeError, match='width 5'):
+        client.r_hat_batch(np.zeros((3, 4)))
+    # the server is still serving
+    x = np.ones((2, 5), dtype=np.float32)
+    torch.testing.assert_close(client.r_hat_batch(x), model.r_hat_batch(x), rtol=1e-5, atol=1e-6)
+    client.close()
+
+unpickled = []
+
+class Payload(object):
+    def __reduce__(self):
+        return (unpickled.append, ('unpickled',))
+
+def test_requests_are_never_unpickled(tmp_path, served):
+    model, _ = served
+    client = RewardClient(tmp_path / 'reward.sock')
+    for data in [pickle.dumps(Payload()), b'abc', np.array([2, 3, 5], dtype=np.int64).tobytes()]:
+        client.conn.send_bytes(data)
+        reply = client.conn.recv_bytes()
+        assert np.frombuffer(reply, dtype=np.int64, count=2)[1] == 1
+        assert b'malformed request' in reply
+    assert unpickled == []
+    x = np.ones((2, 5), dtype=np.float32)
+    torch.testing.assert_close(client.r_hat_batch(x), model.r_hat_batch(x), rtol=1e-5, atol=1e-6)
+    client.close()
+
+def test_published_weights_are_served(tmp_path, served):
+    model, server = served
+    client = RewardClient(tmp_path / 'reward.sock')
+    x = np.ones((2, 5), dtype=np.float32)
+    before = client.r_hat_batch(x)
+    with torch.no_grad():
+        for p in model.ensemble.parameters():
+            p.add_(0.1)
+    model.model_version += 1
+    server.publish(model)
+    after = client.r_hat_batch(x)
+    assert client.model_version == model.model_version
+    assert not torch.allclose(before, after)
+    torch.testing.assert_close(after, model.r_hat_batch(x), rtol=1e-5, atol=1e-6)
+    client.close()
+
+def test_concurrent_clients_get_their_own_rows(tmp_path, served):
+    model, _ = served
+    rng = np.random.default_rng(1)
+    inputs = [rng.standard_normal((n, 5)).astype(np.float32) for n in [1, 7, 30, 3]]
+    results = [None] * len(inputs)
+    def request(i):
+        client = RewardClient(tmp_path / 'reward.sock')
+        for _ in range(5):
+            results[i] = client.r_hat_batch(inputs[i])
+        client.close()
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(len(inputs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+    for x, rewards in zip(inputs, results):
+        torch.testing.assert_close(rewards, model.r_hat_batch(x), rtol=1e-5, atol=1e-6)
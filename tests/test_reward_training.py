@@ -0,0 +1,47 @@
+import copy
+import numpy as np
+import torch
+
+def record_epochs(model):
+    # rows and resulting weights of every epoch fit runs
+    epochs = []
+    train_reward = model.train_reward
+    def train(rows):
+        acc = train_reward(rows)
+        epochs.append((np.sort(rows), copy.deepcopy(model.ensemble.state_dict())))
+        return acc
+    model.train_reward = train
+    return epochs
+
+def test_validation_labels_are_held_out(make_labeled_model):
+    model = make_labeled_model(rounds=6, val_ratio=0.5)
+    train_rows, val_rows = model.split_rows()
+    assert len(train_rows) > 0 and len(val_rows) > 0
+    assert sorted(np.concatenate([train_rows, val_rows])) == list(model.labeled_rows())
+    epochs = record_epochs(model)
+    model.fit(max_epochs=2, acc_stop=1.1)
+    assert all(np.array_equal(rows, train_rows) for rows, _ in epochs)
+
+def test_early_stop_restores_the_best_weights(make_labeled_model):
+    model = make_labeled_model(val_ratio=0.3)
+    epochs = record_epochs(model)
+    losses = iter([1.0, 0.5, 0.8, 0.9, 0.2, 0.1])
+    model.evaluate = lambda rows: (next(losses), 0.0)
+    model.fit(max_epochs=10, acc_stop=1.1, patience=2)
+    # the loss did not improve for 2 epochs after the second one
+    assert len(epochs) == 4
+    for k, v in model.ensemble.state_dict().items():
+        torch.testing.assert_close(v, epochs[1][1][k])
+
+def test_incremental_rounds_replay_old_labels(make_labeled_model):
+    model = make_labeled_model(rounds=4)
+    model.fit(max_epochs=1, acc_stop=1.1)
+    model.uniform_sampling()
+    new_rows = np.flatnonzero(model.buffer_round[:model.buffer_index] == model.label_round)
+    epochs = record_epochs(model)
+    model.fit(max_epochs=3, acc_stop=1.1, replay_ratio=0.5)
+    assert len(epochs) == 3
+    for rows, _ in epochs:
+        # every new label, and half as many old ones
+        assert np.isin(new_rows, rows).all()
+        assert len(rows) == len(new_rows) + len(new_rows) // 2
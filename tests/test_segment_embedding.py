@@ -0,0 +1,57 @@
+import torch
+
+def count_embeds(store):
+    calls = []
+    embed = store.embed
+    store.embed = lambda model, sa_t: (calls.append(len(sa_t)), embed(model, sa_t))[1]
+    return calls
+
+def test_labeled_embeddings_are_computed_once(make_labeled_model):
+    model = make_labeled_model(rounds=2, kcenter_embedding='projection', embedding_dim=4)
+    store, rows = model.embeddings, model.labeled_rows()
+    calls = count_embeds(store)
+    first = store.labeled(model, rows).clone()
+    assert first.shape == (len(rows), 2 * store.dim) and sum(calls) == 2 * len(rows)
+    # projections do not depend on the weights
+    model.model_version += 1
+    torch.testing.assert_close(store.labeled(model, rows), first)
+    assert sum(calls) == 2 * len(rows)
+    # only the rows of the new round are embedded
+    model.uniform_sampling()
+    store.labeled(model, model.labeled_rows())
+    assert sum(calls) == 3 * len(rows)
+
+def test_hidden_embeddings_follow_the_model_version(make_labeled_model):
+    model = make_labeled_model(rounds=2, kcenter_embedding='hidden', embedding_dim=4)
+    store, rows = model.embeddings, model.labeled_rows()
+    calls = count_embeds(store)
+    store.labeled(model, rows)
+    store.labeled(model, rows)
+    assert sum(calls) == 2 * len(rows)
+    model.model_version += 1
+    store.labeled(model, rows)
+    assert sum(calls) == 4 * len(rows)
+    # the cached table holds the embeddings of the pairs
+    expected = torch.cat([store.embed(model, model.pref_segments(rows, side)) for side in range(2)], axis=-1)
+    torch.testing.assert_close(store.labeled(model, rows), expected)
+
+def test_kcenter_selection_on_embeddings(make_labeled_model):
+    model = make_labeled_model(rounds=2, kcenter_embedding='projection', embedding_dim=4, large_batch=4)
+    queries = model.select_queries(3)
+    assert len(queries[0]) == model.mb_size
+    keys = model.query_index.pair_keys(queries[6], queries[7])
+    assert len(set(keys)) == len(keys)
+
+def test_shadow_copies_do_not_write_into_the_live_embeddings(make_labeled_model):
+    model = make_labeled_model(rounds=2, kcenter_embedding='projection', embedding_dim=4)
+    rows = model.labeled_rows()
+    live = model.embeddings.labeled(model, rows).clone()
+    shadow = model.shadow_copy()
+    assert shadow.embeddings is not model.embeddings
+    # the snapshot's refs of the rows differ from the live ones once the main thread reuses them
+    shadow.buffer_ref1[rows] = shadow.buffer_ref1[rows[::-1]]
+    shadow.embeddings.invalidate()
+    shadow.embeddings.labeled(shadow, rows)
+    torch.testing.assert_close(model.embeddings.labeled(model, rows), live)
+    expected = model.embeddings.embed(model, model.pref_segments(rows, 0))
+    torch.testing.assert_close(live[:, :model.embeddings.dim], expected)
@@ -0,0 +1,73 @@
+import threading
+import numpy as np
+import torch
+
+from lib.reward_model import SegmentReturnCache
+
+def direct_sums(model, starts, length):
+    rows = (starts[:, None] + np.arange(length)[None, :]) % model.traj_store.capacity
+    with torch.no_grad():
+        preds = model.r_hat_ensemble(model.traj_store.inputs[rows])[..., 0].cpu().numpy()
+    return preds.sum(axis=-1)
+
+def test_window_sums_across_the_wrap(make_reward_model, add_reward_steps):
+    model = make_reward_model(traj_capacity=50)
+    add_reward_steps(model, 80, episode_len=7, seed=0)
+    cache = SegmentReturnCache(model.traj_store, model.de)
+    cache.refresh(model)
+    starts = np.arange(model.traj_store.capacity)   # the last windows run past the end of the ring
+    np.testing.assert_allclose(cache.window_sums(starts, 5), direct_sums(model, starts, 5), rtol=1e-4, atol=1e-4)
+
+def test_incremental_refresh_matches_a_full_one(make_reward_model, add_reward_steps):
+    model = make_reward_model(traj_capacity=50)
+    add_reward_steps(model, 30, episode_len=7, seed=1)
+    cache = SegmentReturnCache(model.traj_store, model.de)
+    cache.refresh(model)
+    add_reward_steps(model, 35, episode_len=7, seed=2)   # wraps the ring, only the new rows are predicted
+    cache.refresh(model)
+
+    full = SegmentReturnCache(model.traj_store, model.de)
+    full.refresh(model)
+    starts = np.arange(model.traj_store.capacity)
+    np.testing.assert_allclose(cache.window_sums(starts, 5), full.window_sums(starts, 5), rtol=1e-4, atol=1e-4)
+
+def test_new_weights_invalidate_the_predictions(make_reward_model, add_reward_steps):
+    model = make_reward_model(traj_capacity=50)
+    add_reward_steps(model, 20, episode_len=7, seed=3)
+    cache = SegmentReturnCache(model.traj_store, model.de)
+    cache.refresh(model)
+    with torch.no_grad():
+        for p in model.ensemble.parameters():
+            p.add_(0.5)
+    model.model_version += 1
+    cache.refresh(model)
+    starts = np.arange(15)
+    np.testing.assert_allclose(cache.window_sums(starts, 5), direct_sums(model, starts, 5), rtol=1e-4, atol=1e-4)
+
+def test_a_reserved_row_is_not_predicted_before_it_is_written(make_reward_model, add_reward_steps):
+    model = make_reward_model(traj_capacity=50)
+    add_reward_steps(model, 20, episode_len=7, seed=4)
+    cache = SegmentReturnCache(model.traj_store, model.de)
+    store = model.traj_store
+    # add holds the lock from reserving a row until it is written
+    reserved, release = threading.Event(), threading.Event()
+    def add():
+        with store.lock:
+            pos = store._reserve_row()
+            reserved.set()
+            release.wait(timeout=10)
+            store.inputs[pos] = 1.0
+            store.ep_len[(store.next_ep - 1) % store.table_size] += 1
+    writer = threading.Thread(target=add)
+    writer.start()
+    assert reserved.wait(timeout=10)
+    refresh = threading.Thread(target=cache.refresh, args=(model,))
+    refresh.start()
+    refresh.join(timeout=0.2)
+    assert refresh.is_alive(), 'refresh read the store while a row was being written'
+    release.set()
+    writer.join(timeout=10)
+    refresh.join(timeout=10)
+    assert cache.ptr == 21
+    np.testing.assert_allclose(cache.window_sums(np.array([20]), 1), direct_sums(model, np.array([20]), 1),
+                               rtol=1e-4, atol=1e-4)
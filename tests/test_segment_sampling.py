@@ -0,0 +1,44 @@
+import numpy as np
+
+def add_marked_episode(model, ep, length):
+    # the state of every step carries (episode, step, 0)
+    for t in range(length):
+        model.add_data(np.array([ep, t, 0], dtype=np.float32), np.zeros(2), float(t), False, t == length - 1, None)
+
+def test_segments_lie_inside_their_episode(make_reward_model):
+    np.random.seed(0)
+    model = make_reward_model(size_segment=5)
+    for ep, length in enumerate([12, 3, 9, 20]):
+        add_marked_episode(model, ep, length)
+    seg_ids, offsets, lengths = model.sample_segment_refs(500)
+    durations = model.traj_store.lengths(seg_ids)
+    assert (offsets >= 0).all() and (offsets + lengths <= durations).all()
+    # episodes shorter than a segment keep all but one step
+    assert (lengths == np.where(durations > 5, 5, durations - 1)).all()
+    assert set(seg_ids) == {0, 1, 2, 3}
+
+    sa_t, r_t, _ = model.get_segments(seg_ids, offsets, lengths)
+    assert sa_t.shape == (500, 5, 5) and r_t.shape == (500, 5, 1)
+    for i in np.flatnonzero(lengths == 5)[:50]:
+        assert (sa_t[i, :, 0] == seg_ids[i]).all()
+        assert list(sa_t[i, :, 1]) == list(range(offsets[i], offsets[i] + 5))
+        assert list(r_t[i, :, 0]) == list(range(offsets[i], offsets[i] + 5))
+
+def test_short_segments_are_padded_with_their_mean_state(make_reward_model):
+    model = make_reward_model(size_segment=5)
+    add_marked_episode(model, 0, 3)
+    add_marked_episode(model, 1, 10)
+    sa_t, r_t, _ = model.get_segments(np.array([0]), np.array([0]), np.array([2]))
+    # steps 0 and 1 of episode 0, then the mean of their state features
+    assert list(sa_t[0, :2, 1]) == [0, 1]
+    np.testing.assert_allclose(sa_t[0, 2:, :3], 1 / 6)
+    np.testing.assert_allclose(r_t[0, 2:, 0], 0.5)
+
+def test_the_open_episode_is_skipped_while_too_short(make_reward_model):
+    np.random.seed(1)
+    model = make_reward_model()
+    add_marked_episode(model, 0, 10)
+    add_marked_episode(model, 1, 10)
+    model.add_data(np.array([2, 0, 0], dtype=np.float32), np.zeros(2), 0.0, False, False, None)
+    seg_ids, _, _ = model.sample_segment_refs(200)
+    assert set(seg_ids) == {0, 1}
@@ -0,0 +1,55 @@
+import numpy as np
+import torch
+
+from lib.reward_trainer import AsyncRewardTrainer
+
+def weights(model):
+    return {k: v.clone() for k, v in model.ensemble.state_dict().items()}
+
+def assert_same_weights(model, expected):
+    for k, v in model.ensemble.state_dict().items():
+        torch.testing.assert_close(v, expected[k])
+
+def test_shadow_trains_without_touching_the_live_model(make_labeled_model):
+    model = make_labeled_model()
+    before, version = weights(model), model.model_version
+    shadow = model.shadow_copy()
+    shadow.fit(max_epochs=3, acc_stop=1.1)
+    assert_same_weights(model, before)
+    assert model.model_version == version
+
+    model.publish(shadow)
+    assert_same_weights(model, weights(shadow))
+    assert model.model_version == version + 1
+    assert model.fit_round == shadow.fit_round
+    assert shadow not in model.shadows
+
+def test_shadow_keeps_its_labels_while_the_live_buffer_wraps(make_labeled_model, add_reward_steps):
+    model = make_labeled_model(capacity=16, traj_capacity=200)
+    rows = model.labeled_rows()
+    shadow = model.shadow_copy()
+    segments = [shadow.pref_segments(rows, side).copy() for side in range(2)]
+
+    # the live model evicts every labeled trajectory and reuses every row of the preference buffer
+    add_reward_steps(model, 400, seed=1)
+    for _ in range(3):
+        model.uniform_sampling()
+    assert shadow.buffer_archived[rows].all()
+    for side in range(2):
+        np.testing.assert_allclose(shadow.pref_segments(rows, side), segments[side], atol=1e-2)   # float16 archive
+    shadow.fit(max_epochs=2, acc_stop=1.1)
+
+def test_background_training_while_labeling(make_labeled_model, add_reward_steps):
+    model = make_labeled_model(capacity=16, traj_capacity=200)
+    trainer = AsyncRewardTrainer(model)
+    version = model.model_version
+    trainer.start(max_epochs=20, acc_stop=1.1)
+    assert trainer.busy
+    for seed in range(4):
+        add_reward_steps(model, 100, seed=seed + 1)
+        model.uniform_sampling()
+    shadow = trainer.shadow
+    trainer.wait()
+    assert not trainer.busy and trainer.error is None
+    assert_same_weights(model, weights(shadow))
+    assert model.model_version == version + 1
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import torch
+
+from lib.teacher import SyntheticTeacher
+
+def reference_labels(r_t_1, r_t_2, gamma, thres_skip, thres_equal):
+    # the original per pair loop of the scripted teacher, without mistakes
+    keep, labels = [], []
+    weights = gamma ** np.arange(r_t_1.shape[1] - 1, -1, -1)
+    for r_1, r_2 in zip(r_t_1[..., 0], r_t_2[..., 0]):
+        if thres_skip > 0 and max(r_1.sum(), r_2.sum()) <= thres_skip:
+            keep.append(False)
+            continue
+        keep.append(True)
+        if abs(r_1.sum() - r_2.sum()) < thres_equal:
+            labels.append(-1)
+        else:
+            labels.append(int((r_1 * weights).sum() < (r_2 * weights).sum()))
+    return np.array(keep), np.array(labels).reshape(-1, 1)
+
+@pytest.mark.parametrize('gamma, thres_skip, thres_equal', [(1, 0, 0), (0.9, 0, 0), (1, 2.0, 0.5), (0.8, 1.0, 1.0)])
+def test_same_labels_as_the_per_pair_teacher(gamma, thres_skip, thres_equal):
+    rng = np.random.default_rng(0)
+    r_t_1, r_t_2 = rng.standard_normal((2, 500, 10, 1))
+    keep, labels = SyntheticTeacher(gamma=gamma).label(r_t_1, r_t_2, thres_skip, thres_equal)
+    expected_keep, expected_labels = reference_labels(r_t_1, r_t_2, gamma, thres_skip, thres_equal)
+    assert np.array_equal(keep, expected_keep)
+    assert np.array_equal(labels, expected_labels)
+
+def test_mistakes_flip_labels_at_their_rate():
+    torch.manual_seed(0)
+    rng = np.random.default_rng(1)
+    r_t_1, r_t_2 = rng.standard_normal((2, 20000, 5, 1))
+    _, labels = SyntheticTeacher().label(r_t_1, r_t_2)
+    _, noisy = SyntheticTeacher(eps_mistake=0.2).label(r_t_1, r_t_2)
+    assert abs((labels != noisy).mean() - 0.2) < 0.02
+
+def test_the_teacher_runs_on_the_reward_model_device(make_reward_model):
+    model = make_reward_model()
+    assert model.teacher.device == model.device
+    assert model.teacher.discount(5).device == model.device
+    # float32 only, there is no float64 on mps
+    assert SyntheticTeacher(gamma=0.9).discount(5).dtype == torch.float32
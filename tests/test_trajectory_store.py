@@ -0,0 +1,78 @@
+import numpy as np
+
+def test_rows_wrap_around_the_ring(make_store, add_store_episode):
+    store = make_store()
+    add_store_episode(store, 0, 4)
+    add_store_episode(store, 1, 4)
+    add_store_episode(store, 2, 4)   # rows 8, 9, 0, 1: the first episode loses its rows and is evicted
+    assert list(store.episode_ids()) == [1, 2]
+    assert store.ptr == 12 and store.num_rows == 10
+    inputs, targets, _ = store.episode(2)
+    assert (inputs[:, 0] == 2).all() and list(inputs[:, 1]) == [0, 1, 2, 3]
+    assert list(targets[:, 0]) == [0, 1, 2, 3]
+    assert list(store.rows([2], [0], 4)[0]) == [8, 9, 0, 1]
+
+def test_fifo_eviction_on_episode_count(make_store, add_store_episode):
+    store = make_store(capacity=100, max_episodes=2)
+    evicted = []
+    store.on_evict = evicted.append
+    for ep in range(4):
+        add_store_episode(store, ep, 3)
+    assert evicted == [0, 1]
+    assert list(store.episode_ids()) == [2, 3]
+    assert list(store.is_stored([0, 1, 2, 3, 4])) == [False, False, True, True, False]
+
+def test_eviction_hook_sees_the_rows_before_they_are_overwritten(make_store, add_store_episode):
+    store = make_store()
+    seen = {}
+    store.on_evict = lambda ep_id: seen.setdefault(ep_id, store.episode(ep_id)[0].copy())
+    add_store_episode(store, 0, 6)
+    add_store_episode(store, 1, 6)
+    assert list(seen) == [0]
+    assert (seen[0][:, 0] == 0).all() and list(seen[0][:, 1]) == list(range(6))
+
+def test_episode_longer_than_the_store_goes_on_under_new_ids(make_store, add_store_episode):
+    store = make_store(capacity=6)
+    evicted = []
+    store.on_evict = evicted.append
+    add_store_episode(store, 0, 14)
+    # evicted once every half ring, the newest 3 rows are kept by the next id
+    assert evicted == [0, 1, 2]
+    assert list(store.episode_ids()) == [3] and not store.open
+    assert list(store.episode(3)[0][:, 1]) == [9, 10, 11, 12, 13]
+    # the ids that were split off are not stored anymore, their references can not point at other steps
+    assert list(store.is_stored([0, 1, 2, 3])) == [False, False, False, True]
+
+def test_labels_of_an_episode_longer_than_the_store_are_archived(make_reward_model):
+    model = make_reward_model(traj_capacity=40, size_segment=5)
+    evictions = []
+    archive_episode = model.archive_episode
+    model.traj_store.on_evict = lambda ep_id: (evictions.append(ep_id), archive_episode(ep_id))
+    rng = np.random.default_rng(0)
+    for _ in range(30):
+        model.add_data(rng.standard_normal(3).astype(np.float32), rng.standard_normal(2), 0.0, False, False, None)
+    refs = np.array([[0, 2, 5], [0, 10, 5]])
+    model.put_queries(refs[:1], refs[1:], np.array([[1]]))
+    labeled = [model.pref_segments([0], side).copy() for side in range(2)]
+
+    for _ in range(100):
+        model.add_data(rng.standard_normal(3).astype(np.float32), rng.standard_normal(2), 0.0, False, False, None)
+    # one eviction per 20 steps past the capacity, not one per step
+    assert evictions == [0, 1, 2, 3, 4]
+    assert model.buffer_archived[0].all()
+    for side in range(2):
+        np.testing.assert_allclose(model.pref_segments([0], side), labeled[side], atol=1e-2)   # float16 archive
+
+def test_state_dict_round_trip_after_wrap(make_store, add_store_episode):
+    store = make_store()
+    for ep in range(3):
+        add_store_episode(store, ep, 4)
+    add_store_episode(store, 3, 2)
+    store.add(np.array([4, 0], dtype=np.float32), [0.0], 0.0, None, done=False)
+
+    restored = make_store()
+    restored.load_state_dict(store.state_dict())
+    assert list(restored.episode_ids()) == list(store.episode_ids())
+    assert restored.open
+    for ep_id in store.episode_ids():
+        assert np.array_equal(restored.episode(ep_id)[0], store.episode(ep_id)[0])
@@ -15,7 +15,7 @@ import copy
 
 from lib.logger import Logger
 from agent.sac import SACAgent
-from lib.replay_buffer import ReplayBuffer
+from lib.replay_buffer import ReplayBuffer, FrameReplayBuffer, TorchReplayBuffer, PendingRewards, BatchPrefetcher
 from lib.reward_model import RewardModel
 from collections import deque
 
@@ -126,6 +126,15 @@ class Workspace(object):
         else:
             raise NotImplementedError
         
+        # pixel_uint8: frames stay uint8 from the env to the replay buffer and the reward model, the networks scale them
+        self.obs_scale = 255.0 if cfg.pixel_uint8 and self.policy == 'CNN' else 1.0
+        # frame_replay: pixel frames are stored once in the replay buffer, the agent acts on the last frame_stack of them
+        self.frame_replay = cfg.frame_replay and self.policy == 'CNN'
+        self.frame_stack = cfg.frame_stack if self.frame_replay else 1
+        if self.frame_stack > 1:
+            cfg.agent.obs_dim = (*self.obs_space_shape[:2], self.obs_space_shape[2] * self.frame_stack)
+        self.obs_stack = utils.ObsStack(self.frame_stack)
+        
         #self.agent = hydra.utils.instantiate(cfg.agent, _recursive_=False, _convert_="all")
         self.agent = SACAgent(obs_space = self.obs_space,
             obs_dim = cfg.agent.obs_dim, 
@@ -149,15 +158,51 @@ class Workspace(object):
             policy = self.policy,
             mode= self.mode, 
             learnable_temperature = cfg.agent.learnable_temperature,
-            normalize_state_entropy = True)
-
-        self.replay_buffer = ReplayBuffer(
-            self.obs_space,
-            self.obs_space_shape,
-            action_space,
-            self.action_type,
-            int(cfg.replay_buffer_capacity), 
-            self.device)
+            normalize_state_entropy = True,
+            obs_scale = self.obs_scale)
+        self.agent.prepare_inference(cfg.inference_mode, cfg.inference_refresh, cfg.inference_tolerance)
+
+        if self.frame_replay:
+            self.replay_buffer = FrameReplayBuffer(
+                self.obs_space,
+                self.obs_space_shape,
+                action_space,
+                self.action_type,
+                int(cfg.replay_buffer_capacity), 
+                self.device,
+                frame_stack=self.frame_stack,
+                relabel_batch_size=cfg.relabel_batch_size,
+                obs_dtype=np.uint8 if self.obs_scale != 1 else np.float32,
+                storage_dir=cfg.replay_storage or None)
+        elif cfg.replay_torch_storage:
+            # the arrays live on the device as tensors, sampling is an index_select
+            self.replay_buffer = TorchReplayBuffer(
+                self.obs_space,
+                self.obs_space_shape,
+                action_space,
+                self.action_type,
+                int(cfg.replay_buffer_capacity), 
+                self.device,
+                relabel_batch_size=cfg.relabel_batch_size,
+                obs_dtype=np.uint8 if self.obs_scale != 1 else np.float32)
+        else:
+            self.replay_buffer = ReplayBuffer(
+                self.obs_space,
+                self.obs_space_shape,
+                action_space,
+                self.action_type,
+                int(cfg.replay_buffer_capacity), 
+                self.device,
+                relabel_batch_size=cfg.relabel_batch_size,
+                obs_dtype=np.uint8 if self.obs_scale != 1 else np.float32,
+                storage_dir=cfg.replay_storage or None)
+
+        # the agent's batches sampled ahead in a background thread (sampler has the replay buffer interface)
+        self.batch_prefetcher = None
+        self.sampler = self.replay_buffer
+        if cfg.batch_prefetch > 0:
+            self.batch_prefetcher = BatchPrefetcher(self.replay_buffer, cfg.agent.batch_size, depth=cfg.batch_prefetch)
+            self.sampler = self.batch_prefetcher
         
         # for logging
         self.total_feedback = 0
@@ -176,9 +221,21 @@ class Workspace(object):
             size_segment=cfg.segment,
             activation=cfg.activation,
             capacity=cfg.reward_model_capacity, 
+            traj_capacity=cfg.trajectory_capacity,
             lr=cfg.reward_lr,
             mb_size=cfg.reward_batch, 
             large_batch=cfg.large_batch, 
+            kcenter_dim=cfg.kcenter_projection_dim,
+            kcenter_embedding=cfg.kcenter_embedding,
+            embedding_dim=cfg.kcenter_embedding_dim,
+            num_candidates=cfg.query_candidates,
+            dedup=cfg.query_dedup,
+            dedup_quantum=cfg.query_dedup_quantum,
+            pref_archive=cfg.preference_archive,
+            inference_mode=cfg.inference_mode,
+            inference_tol=cfg.inference_tolerance,
+            obs_scale=self.obs_scale,
+            device=cfg.device,
             label_margin=cfg.label_margin, 
             teacher_beta=cfg.teacher_beta, 
             teacher_gamma=cfg.teacher_gamma, 
@@ -186,6 +243,12 @@ class Workspace(object):
             teacher_eps_skip=cfg.teacher_eps_skip, 
             teacher_eps_equal=cfg.teacher_eps_equal)
         
+        # predicted rewards of new transitions computed in batches instead of every step
+        self.pending_rewards = None
+        if cfg.reward_inference_interval > 0:
+            self.replay_buffer.set_predictor(self.reward_model)
+            self.pending_rewards = PendingRewards(self.replay_buffer, self.reward_model, cfg.reward_inference_interval)
+        
         print('INIT COMPLETE')
         
     @property
@@ -205,10 +268,12 @@ class Workspace(object):
         average_true_episode_reward = 0
         success_rate = 0
         
+        obs_stack = utils.ObsStack(self.frame_stack)
         for episode in range(self.cfg.num_eval_episodes):
             obs, info = self.eval_env.reset(seed = self.cfg.seed)
             if self.action_type == 'Discrete' and self.state_type == 'grid':
                 obs = obs['image']
+            stacked_obs = obs_stack.reset(obs)
             self.agent.reset()
             terminated = False
             truncated = False
@@ -219,7 +284,7 @@ class Workspace(object):
 
             while not (terminated or truncated):
                 with utils.eval_mode(self.agent):
-                    action = self.agent.act(obs, sample=False, determ=False) # set determ=True in experiments
+                    action = self.agent.act(stacked_obs, sample=False, determ=False) # set determ=True in experiments
                     #print(action)
                 obs, reward, terminated, truncated, info = self.eval_env.step(action)
                 
@@ -229,6 +294,7 @@ class Workspace(object):
                     episode_success = max(episode_success, terminated)
                 if self.action_type == 'Discrete' and self.state_type == 'grid':
                     obs = obs['image']
+                stacked_obs = obs_stack.step(obs)
                 
             average_episode_reward += episode_reward
             average_true_episode_reward += true_episode_reward
@@ -262,6 +328,8 @@ class Workspace(object):
         interact_count = 0
         while self.step != (self.cfg.num_seed_steps + self.cfg.num_unsup_steps):
             if terminated or truncated:
+                if self.pending_rewards is not None:
+                    episode_reward += self.pending_rewards.flush()
                 if self.step > 0:
                     episode_time = time.time() - start_time
                     self.logger.log('train/duration', episode_time, self.step)
@@ -284,6 +352,7 @@ class Workspace(object):
 
                 if self.action_type == 'Discrete' and self.state_type == 'grid':
                     obs = obs['image']
+                stacked_obs = self.obs_stack.reset(obs)
 
                 self.agent.reset()
                 terminated = False
@@ -303,14 +372,14 @@ class Workspace(object):
                 if self.action_type == 'Discrete':
                     action = self.env.action_space.sample()
                 else:
-                    action = self.agent.act(obs, sample=True, determ=False)
+                    action = self.agent.act(stacked_obs, sample=True, determ=False)
             else:
                 #with utils.eval_mode(self.agent):
-                action = self.agent.act(obs, sample=False, determ=False) # set determ=True in experiments
+                action = self.agent.act(stacked_obs, sample=False, determ=False) # set determ=True in experiments
 
             # unsupervised exploration
             if self.step > self.cfg.num_seed_steps:
-                self.agent.update_state_ent(self.replay_buffer, self.logger, self.step, gradient_update=1, K=self.cfg.topK)
+                self.agent.update_state_ent(self.sampler, self.logger, self.step, gradient_update=1, K=self.cfg.topK)
                 #print('OK')
                 
             
@@ -332,7 +401,10 @@ class Workspace(object):
 
             obs_flat = gym_utils.flatten(self.obs_space, obs)
 
-            reward_hat = self.reward_model.r_hat(np.concatenate([obs_flat, action], axis=-1))
+            if self.pending_rewards is None:
+                reward_hat = self.reward_model.r_hat(np.concatenate([obs_flat, action], axis=-1))
+            else:
+                reward_hat = 0.0    # placeholder, filled in when the pending rows are flushed
 
             # allow infinite bootstrap
             terminated = float(terminated)
@@ -345,6 +417,9 @@ class Workspace(object):
             # adding data to the reward training data
             self.reward_model.add_data(obs_flat, action, reward, terminated, truncated, env_snapshot)
             self.replay_buffer.add(obs, action, reward_hat, next_obs, terminated, truncated)
+            if self.pending_rewards is not None:
+                row = (self.replay_buffer.idx - 1) % self.replay_buffer.capacity
+                episode_reward += self.pending_rewards.add(row, obs_flat, action)
 
             # Save model checkpoint for State Explanation
             if self.cfg.xplain_state == True and self.step % self.cfg.checkpoint_frec == 0:
@@ -359,10 +434,16 @@ class Workspace(object):
                 )
             
             obs = next_obs
+            stacked_obs = self.obs_stack.step(obs)
             episode_step += 1
             self.step += 1
             interact_count += 1
             
+        # the snapshot must not keep placeholder rewards
+        if self.pending_rewards is not None:
+            self.pending_rewards.flush()
+        if self.batch_prefetcher is not None:
+            self.batch_prefetcher.close()
 
         # evaluate agent at the end
         self.logger.log('eval/episode', self.episode, self.step)
@@ -396,6 +477,8 @@ def main(cfg : DictConfig):
     else:
         print(f'Creating models at: {cfg.snapshot_dir}')
     workspace.save_snapshot()
+    # memory mapped replay files are removed, the snapshot has its own copy
+    workspace.replay_buffer.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
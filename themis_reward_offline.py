@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import numpy as np
+import torch
+import itertools
+import multiprocessing as mp
+from pathlib import Path
+import time
+
+from lib.reward_model import RewardModel
+from lib.label_journal import LabelJournal
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+def load_records(journals, segment):
+    # journal records of all files renumbered into consecutive rounds, with segments cut to the first segment steps
+    records, skipped = [], 0
+    for path in journals:
+        for record in LabelJournal.read(path):
+            if record['segs_1'] is None or record['segs_1'].shape[1] < segment:
+                skipped += len(record['labels'])
+                continue
+            record = dict(record, round=len(records) + 1,
+                          segs_1=record['segs_1'][:, :segment], segs_2=record['segs_2'][:, :segment])
+            records.append(record)
+    return records, skipped
+
+def train_config(args):
+    # one reward model configuration, run in its own process
+    cfg, params, out_dir = args
+    torch.set_num_threads(cfg.threads_per_config)
+    np.random.seed(cfg.seed)
+    torch.manual_seed(cfg.seed)
+    name = '_'.join(f'{k}{v}' for k, v in params.items())
+
+    records, skipped = load_records(cfg.journals, params['segment'])
+    num_labels = sum(len(record['labels']) for record in records)
+    if num_labels == 0:
+        return dict(params, name=name, labels=0, skipped=skipped)
+    width = records[0]['segs_1'].shape[-1]
+    ds = records[0].get('ds', cfg.state_dim)
+    obs_scale = records[0].get('obs_scale', cfg.obs_scale)
+
+    # the preference buffer gets every segment as an archived copy, no trajectory is stored
+    reward_model = RewardModel(
+        obs_space=None,
+        ds=ds,
+        da=width - ds,
+        action_type=cfg.action_type,
+        ensemble_size=params['ensemble_size'],
+        lr=params['reward_lr'],
+        size_segment=params['segment'],
+        activation=params['activation'],
+        capacity=num_labels,
+        traj_capacity=1,
+        dedup=False,
+        val_ratio=cfg.reward_val_ratio,
+        pref_archive=str(records[0]['segs_1'].dtype),
+        obs_scale=obs_scale,
+        seed=cfg.seed,
+        device=cfg.device)
+    reward_model.load_journal(records)
+
+    start_time = time.time()
+    soft = any((record['labels'] == -1).any() for record in records)
+    train_acc = reward_model.fit(max_epochs=cfg.reward_update, soft=soft, patience=cfg.reward_patience)
+    elapsed_time = time.time() - start_time
+
+    _, val_rows = reward_model.split_rows()
+    val_loss, val_acc = reward_model.evaluate(val_rows) if len(val_rows) > 0 else (float('nan'), float('nan'))
+    path = out_dir / f'reward_weights_{name}.pt'
+    reward_model.save_weights(path)
+    return dict(params, name=name, labels=num_labels, skipped=skipped, train_acc=float(np.mean(train_acc)),
+                val_loss=val_loss, val_acc=val_acc, time=elapsed_time, path=str(path))
+
+def score(result):
+    # validation accuracy when there is a validation split, train accuracy otherwise
+    if result['labels'] == 0:
+        return -1
+    return result['train_acc'] if np.isnan(result['val_acc']) else result['val_acc']
+
+def print_table(results, keys):
+    columns = keys + ['labels', 'train_acc', 'val_loss', 'val_acc', 'time']
+    rows = [[f'{r[k]:.4f}' if isinstance(r.get(k), float) else str(r.get(k, '-')) for k in columns] for r in results]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
+
+@hydra.main(version_base=None, config_path="config", config_name='reward_offline')
+def main(cfg : DictConfig):
+    work_dir = Path.cwd()
+    out_dir = work_dir / cfg.output_dir
+    out_dir.mkdir(exist_ok=True, parents=True)
+    cfg.journals = [str(Path(hydra.utils.get_original_cwd()) / p) for p in cfg.journals]
+
+    # every combination of the grid, one process each
+    keys = ['ensemble_size', 'reward_lr', 'activation', 'segment']
+    grid = [dict(zip(keys, values)) for values in itertools.product(*[list(cfg.grid[k]) for k in keys])]
+    print(f'Training {len(grid)} reward model configurations on {cfg.num_workers} processes')
+
+    with mp.get_context('spawn').Pool(cfg.num_workers) as pool:
+        results = pool.map(train_config, [(cfg, params, out_dir) for params in grid])
+
+    for r in results:
+        if r['skipped'] > 0:
+            print(f"{r['name']}: {r['skipped']} labels without archived segments of length {r['segment']} were skipped")
+    results.sort(key=score, reverse=True)
+    print_table(results, keys)
+    OmegaConf.save(OmegaConf.create({'results': results}), out_dir / 'results.yaml')
+
+if __name__ == '__main__':
+    main()
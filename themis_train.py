@@ -17,7 +17,11 @@ from lib.logger import Logger
 from agent.sac import SACAgent
 #from lib.replay_buffer import ReplayBuffer
 from lib.reward_model import RewardModel
-from lib.replay_buffer import ReplayBuffer
+from lib.reward_trainer import AsyncRewardTrainer
+from lib.query_pipeline import QueryPrefetcher
+from lib.reward_server import RewardServer
+from lib.label_journal import LabelJournal
+from lib.replay_buffer import ReplayBuffer, FrameReplayBuffer, TorchReplayBuffer, PendingRewards, BatchPrefetcher
 from collections import deque
 
 import logging
@@ -137,6 +141,15 @@ class Workspace(object):
         else:
             raise NotImplementedError
         
+        # pixel_uint8: frames stay uint8 from the env to the replay buffer and the reward model, the networks scale them
+        self.obs_scale = 255.0 if cfg.pixel_uint8 and self.policy == 'CNN' else 1.0
+        # frame_replay: pixel frames are stored once in the replay buffer, the agent acts on the last frame_stack of them
+        self.frame_replay = cfg.frame_replay and self.policy == 'CNN'
+        self.frame_stack = cfg.frame_stack if self.frame_replay else 1
+        if self.frame_stack > 1:
+            cfg.agent.obs_dim = (*self.obs_space_shape[:2], self.obs_space_shape[2] * self.frame_stack)
+        self.obs_stack = utils.ObsStack(self.frame_stack)
+        
         payload = torch.load(snapshot)
         keys_to_load = ['step', 'episode']
         self.step, self.episode = [payload[k] for k in keys_to_load]
@@ -164,20 +177,56 @@ class Workspace(object):
             policy = self.policy,
             mode= self.mode, 
             learnable_temperature = cfg.agent.learnable_temperature,
-            normalize_state_entropy = True)
+            normalize_state_entropy = True,
+            obs_scale = self.obs_scale)
         
         self.agent.load(snapshot_dir, self.global_frame)
+        self.agent.prepare_inference(cfg.inference_mode, cfg.inference_refresh, cfg.inference_tolerance)
         
-        self.replay_buffer = ReplayBuffer(
-            self.obs_space,
-            self.obs_space_shape,
-            action_space,
-            self.action_type,
-            int(cfg.replay_buffer_capacity), 
-            self.device)
+        if self.frame_replay:
+            self.replay_buffer = FrameReplayBuffer(
+                self.obs_space,
+                self.obs_space_shape,
+                action_space,
+                self.action_type,
+                int(cfg.replay_buffer_capacity), 
+                self.device,
+                frame_stack=self.frame_stack,
+                relabel_batch_size=cfg.relabel_batch_size,
+                obs_dtype=np.uint8 if self.obs_scale != 1 else np.float32,
+                storage_dir=cfg.replay_storage or None)
+        elif cfg.replay_torch_storage:
+            # the arrays live on the device as tensors, sampling is an index_select
+            self.replay_buffer = TorchReplayBuffer(
+                self.obs_space,
+                self.obs_space_shape,
+                action_space,
+                self.action_type,
+                int(cfg.replay_buffer_capacity), 
+                self.device,
+                relabel_batch_size=cfg.relabel_batch_size,
+                obs_dtype=np.uint8 if self.obs_scale != 1 else np.float32)
+        else:
+            self.replay_buffer = ReplayBuffer(
+                self.obs_space,
+                self.obs_space_shape,
+                action_space,
+                self.action_type,
+                int(cfg.replay_buffer_capacity), 
+                self.device,
+                relabel_batch_size=cfg.relabel_batch_size,
+                obs_dtype=np.uint8 if self.obs_scale != 1 else np.float32,
+                storage_dir=cfg.replay_storage or None)
         
         self.replay_buffer.load(snapshot_dir, self.global_frame)
 
+        # the agent's batches sampled ahead in a background thread (sampler has the replay buffer interface)
+        self.batch_prefetcher = None
+        self.sampler = self.replay_buffer
+        if cfg.batch_prefetch > 0:
+            self.batch_prefetcher = BatchPrefetcher(self.replay_buffer, cfg.agent.batch_size, depth=cfg.batch_prefetch)
+            self.sampler = self.batch_prefetcher
+
 
         ui_module= Xplain(self.agent, 
                           self.action_type, 
@@ -205,9 +254,22 @@ class Workspace(object):
                 env = self.sim_env,
                 activation=cfg.activation, 
                 capacity=cfg.reward_model_capacity,
+                traj_capacity=cfg.trajectory_capacity,
                 lr=cfg.reward_lr,
                 mb_size=cfg.reward_batch, 
                 large_batch=cfg.large_batch, 
+                kcenter_dim=cfg.kcenter_projection_dim,
+                kcenter_embedding=cfg.kcenter_embedding,
+                embedding_dim=cfg.kcenter_embedding_dim,
+                num_candidates=cfg.query_candidates,
+                dedup=cfg.query_dedup,
+                dedup_quantum=cfg.query_dedup_quantum,
+                val_ratio=cfg.reward_val_ratio,
+                pref_archive=cfg.preference_archive,
+                inference_mode=cfg.inference_mode,
+                inference_tol=cfg.inference_tolerance,
+                obs_scale=self.obs_scale,
+                device=cfg.device,
                 label_margin=cfg.label_margin,
                 reward_scale=cfg.reward_scale, 
                 reward_intercept=cfg.reward_intercept,
@@ -220,6 +282,56 @@ class Workspace(object):
                 ui_module=ui_module)
         
             self.reward_model.load(snapshot_dir, self.global_frame)
+            
+            # labels of this run are journaled in the run directory, on resume the labels of the
+            # interrupted run (collected after the snapshot) are replayed from it
+            self.label_journal = None
+            if cfg.label_journal:
+                journal_path = self.work_dir / cfg.label_journal
+                if cfg.label_journal_resume:
+                    num_labels = self.reward_model.load_journal(LabelJournal.read(journal_path))
+                    if num_labels > 0:
+                        print(f'Restored {num_labels} preference labels from {journal_path}')
+                        self.total_feedback += num_labels
+                        self.labeled_feedback += num_labels
+                elif journal_path.exists() and journal_path.stat().st_size > 0:
+                    raise FileExistsError(f'Label journal {journal_path} belongs to another run, '
+                                          'set label_journal_resume=True to resume it or choose another label_journal')
+                self.label_journal = LabelJournal(journal_path)
+                self.reward_model.journal = self.label_journal
+
+            # optional background training of the reward model
+            self.reward_trainer = AsyncRewardTrainer(self.reward_model) if cfg.reward_async else None
+            
+            if cfg.simulated_labels and (cfg.human_teacher or cfg.feed_type > 2):
+                raise ValueError('simulated_labels needs the scripted teacher and feed_type 0, 1 or 2')
+            
+            # next feedback rounds selected and rendered in the background while the agent trains
+            self.query_prefetcher = None
+            if cfg.query_prefetch > 0 and not cfg.simulated_labels:
+                self.query_prefetcher = QueryPrefetcher(self.reward_model, cfg.feed_type, depth=cfg.query_prefetch)
+            
+            if cfg.relabel_mode == 'lazy' or cfg.reward_inference_interval > 0:
+                # replay rewards are recomputed when sampled after the reward model changed (or still pending)
+                self.replay_buffer.set_predictor(self.reward_model)
+            
+            # r_hat served to other local processes (RewardClient), batched across clients
+            # this process predicts with its own reward model, without going through the socket
+            self.reward_server = None
+            if cfg.reward_server:
+                self.reward_server = RewardServer(self.reward_model, self.work_dir / cfg.reward_server)
+            
+            # predicted rewards of new transitions computed in batches instead of every step
+            self.pending_rewards = None
+            if cfg.reward_inference_interval > 0:
+                self.pending_rewards = PendingRewards(self.replay_buffer, self.reward_model, cfg.reward_inference_interval)
+            
+            # weights of a reward model trained offline (themis_reward_offline.py) replace the snapshot's
+            if cfg.reward_weights:
+                self.reward_model.load_weights(Path(cfg.reward_weights))
+                if self.reward_server is not None:
+                    self.reward_server.publish(self.reward_model)
+                self.relabel()
         
         print('INIT COMPLETE')
         print('Models Restored')
@@ -241,11 +353,13 @@ class Workspace(object):
         average_true_episode_reward = 0
         success_rate = 0
         
+        obs_stack = utils.ObsStack(self.frame_stack)
         for episode in range(self.cfg.num_eval_episodes):
             obs, info = self.eval_env.reset(seed = self.cfg.seed)
             # Add if minigrid has grid state
             # if self.action_type == 'Discrete' and  self.state_type == 'grid': 
             #     obs = obs['image']
+            stacked_obs = obs_stack.reset(obs)
             self.agent.reset()
             terminated = False
             truncated = False
@@ -256,7 +370,7 @@ class Workspace(object):
 
             while not (terminated or truncated):
                 with utils.eval_mode(self.agent):
-                    action = self.agent.act(obs, sample=False, determ=False)
+                    action = self.agent.act(stacked_obs, sample=False, determ=False)
 
                 obs, reward, terminated, truncated, info = self.eval_env.step(action)
                 
@@ -267,6 +381,7 @@ class Workspace(object):
                 # Add if minigrid has grid state
                 # if self.action_type == 'Discrete' and  self.state_type == 'grid': 
                 #     obs = obs['image']
+                stacked_obs = obs_stack.step(obs)
                 
             average_episode_reward += episode_reward
             average_true_episode_reward += true_episode_reward
@@ -286,12 +401,20 @@ class Workspace(object):
             self.logger.log('train/true_episode_success', success_rate, self.step)
         self.logger.dump(self.step)
     
-    def learn_reward(self, first_flag=False):    
+    def learn_reward(self, first_flag=False, background=False):    
         # get feedbacks
         labeled_queries, noisy_queries = 0, 0
-        if first_flag == True:
+        if self.cfg.simulated_labels:
+            # scripted teacher on the references, random sampling the first time
+            labeled_queries = self.reward_model.simulated_sampling(0 if first_flag else self.cfg.feed_type)
+        elif first_flag == True:
             # if it is first time to get feedback, need to use random sampling
             labeled_queries = self.reward_model.uniform_sampling(first_flag=True)
+        elif self.query_prefetcher is not None:
+            # clips of the prefetched round are ready, only the size of the round may have changed since
+            queries, clipname = self.query_prefetcher.get()
+            queries = tuple(x[:self.reward_model.mb_size] for x in queries)
+            labeled_queries = self.reward_model.label_queries(queries, clipname=clipname, rendered=True)
         else:
             if self.cfg.feed_type == 0:
                 labeled_queries = self.reward_model.uniform_sampling()
@@ -318,21 +441,43 @@ class Workspace(object):
         if self.labeled_feedback > 0:
             # update reward
             start_time = time.time()
-            for epoch in range(self.cfg.reward_update):
-                if self.cfg.label_margin > 0 or self.cfg.teacher_eps_equal > 0 or self.cfg.human_teacher == True:
-                    train_acc = self.reward_model.train_soft_reward()
-                else:
-                    train_acc = self.reward_model.train_reward()
-                total_acc = np.mean(train_acc)
-                
-                if total_acc > 0.97:
-                    break
+            soft = self.cfg.label_margin > 0 or self.cfg.teacher_eps_equal > 0 or self.cfg.human_teacher == True
+            fit_kwargs = dict(max_epochs=self.cfg.reward_update, soft=soft,
+                              patience=self.cfg.reward_patience,
+                              max_time=self.cfg.reward_max_time,
+                              replay_ratio=self.cfg.reward_replay_ratio)
+            if background:
+                # the agent keeps using the current reward until the worker publishes the new one
+                self.reward_trainer.start(**fit_kwargs)
+                print("Reward function is training in the background")
+                return labeled_queries
+            train_acc = self.reward_model.fit(**fit_kwargs)
+            total_acc = np.mean(train_acc)
             elapsed_time = time.time() - start_time        
             print("Reward function is updated!! ACC: " + str(total_acc))
             print("Training time :", elapsed_time)
             
         return labeled_queries
 
+    def reward_updated(self):
+        # the reward model has new weights: serve them, relabel with them and select the next queries with them
+        if self.reward_server is not None:
+            self.reward_server.publish(self.reward_model)
+        self.relabel()
+        self.prefetch_queries()
+
+    def prefetch_queries(self):
+        # start preparing the next rounds with the reward model and actor as they are now
+        if self.query_prefetcher is not None and self.total_feedback < self.cfg.max_feedback:
+            self.query_prefetcher.start()
+
+    def relabel(self):
+        # in lazy mode the version stamps of the replay buffer take care of it
+        if self.cfg.relabel_mode != 'lazy':
+            self.replay_buffer.relabel_with_predictor(self.reward_model)
+            if self.batch_prefetcher is not None:
+                self.batch_prefetcher.reset()
+
     def run(self):
         self.episode, episode_reward, terminated, truncated = 0, 0, True, False
         if self.log_success:
@@ -347,6 +492,8 @@ class Workspace(object):
         interact_count = 0
         while self.step < self.cfg.num_train_steps:
             if terminated or truncated:
+                if self.cfg.learn_reward == True and self.pending_rewards is not None:
+                    episode_reward += self.pending_rewards.flush()
                 if self.step > self.start_step:
                     episode_time = time.time() - start_time
                     self.logger.log('train/duration', episode_time, self.step)
@@ -376,6 +523,7 @@ class Workspace(object):
                 # Add if minigrid has grid state
                 # if self.action_type == 'Discrete' and  self.state_type == 'grid': 
                 #     obs = obs['image']
+                stacked_obs = self.obs_stack.reset(obs)
 
                 self.agent.reset()
                 terminated = False
@@ -396,11 +544,11 @@ class Workspace(object):
                     # Action is a vector of floats
                     action = self.env.action_space.sample()
                 else:
-                    action = self.agent.act(obs, sample=True, determ=False)
+                    action = self.agent.act(stacked_obs, sample=True, determ=False)
             else:
                 with utils.eval_mode(self.agent):
                     # Action is a vector of flat integer
-                    action = self.agent.act(obs, sample=False, determ=False) # Sample from the action distribution
+                    action = self.agent.act(stacked_obs, sample=False, determ=False) # Sample from the action distribution
                 #print(action)
 
             # run training update (until the end)
@@ -408,9 +556,17 @@ class Workspace(object):
                 # Check if reward model is used
                 if self.cfg.learn_reward == True:
                     
-                    # update reward function
-                    if self.total_feedback < self.cfg.max_feedback:
-                        if interact_count == self.cfg.num_interact:
+                    # publish the reward trained in the background and relabel with it
+                    if self.reward_trainer is not None:
+                        train_acc = self.reward_trainer.poll()
+                        if train_acc is not None:
+                            print("Reward function is updated!! ACC: " + str(np.mean(train_acc)))
+                            self.reward_updated()
+                    
+                    # update reward function, waits for the background training of the previous round
+                    reward_busy = self.reward_trainer is not None and self.reward_trainer.busy
+                    if self.total_feedback < self.cfg.max_feedback and not reward_busy:
+                        if interact_count >= self.cfg.num_interact:
                             # update schedule
                             if self.cfg.reward_schedule == 1:
                                 frac = (self.cfg.num_train_steps-self.step) / self.cfg.num_train_steps
@@ -432,11 +588,14 @@ class Workspace(object):
                                 self.reward_model.set_batch(self.cfg.max_feedback - self.total_feedback)
                                 
                             
-                            self.learn_reward()
-                            self.replay_buffer.relabel_with_predictor(self.reward_model)
+                            if self.reward_trainer is not None:
+                                self.learn_reward(background=True)
+                            else:
+                                self.learn_reward()
+                                self.reward_updated()
                             interact_count = 0
                         
-                self.agent.update(self.replay_buffer, self.logger, self.step, 1)
+                self.agent.update(self.sampler, self.logger, self.step, 1)
 
             #run training update (at the end of the unsupervised phase)
             elif self.step == (self.cfg.num_seed_steps + self.cfg.num_unsup_steps):
@@ -462,7 +621,7 @@ class Workspace(object):
                     self.learn_reward(first_flag=1)
                     
                     # relabel buffer
-                    self.replay_buffer.relabel_with_predictor(self.reward_model)
+                    self.reward_updated()
 
                     # reset interact_count
                     interact_count = 0
@@ -473,7 +632,7 @@ class Workspace(object):
                 
                 # update agent
                 self.agent.update_after_reset(
-                    self.replay_buffer, self.logger, self.step, 
+                    self.sampler, self.logger, self.step, 
                     gradient_update=self.cfg.gradient_update, 
                     policy_update=True)
             
@@ -500,7 +659,10 @@ class Workspace(object):
 
             # Check if reward model is used
             if self.cfg.learn_reward == True:
-                reward_hat = self.reward_model.r_hat(np.concatenate([obs_flat, action], axis=-1))
+                if self.pending_rewards is None:
+                    reward_hat = self.reward_model.r_hat(np.concatenate([obs_flat, action], axis=-1))
+                else:
+                    reward_hat = 0.0    # placeholder, filled in when the pending rows are flushed
 
             # allow infinite bootstrap
             terminated = float(terminated)
@@ -519,6 +681,11 @@ class Workspace(object):
                 # adding data to the reward training data
                 self.reward_model.add_data(obs, action, reward, terminated, truncated, env_snapshot)
                 self.replay_buffer.add(obs, action, reward_hat, next_obs, terminated, truncated)
+                if self.pending_rewards is not None:
+                    row = (self.replay_buffer.idx - 1) % self.replay_buffer.capacity
+                    episode_reward += self.pending_rewards.add(row, obs_flat, action)
+                if self.cfg.relabel_sweep > 0:
+                    self.replay_buffer.sweep(self.cfg.relabel_sweep)
             else:
                 self.replay_buffer.add(obs, action, reward, next_obs, terminated, truncated)
 
@@ -534,9 +701,20 @@ class Workspace(object):
                     os.path.join(self.checkpoints_dir, checkpoint_name),
                 )
             obs = next_obs
+            stacked_obs = self.obs_stack.step(obs)
             episode_step += 1
             self.step += 1
             interact_count += 1
+        
+        # the snapshot must not keep placeholder rewards
+        if self.cfg.learn_reward == True and self.pending_rewards is not None:
+            self.pending_rewards.flush()
+        if self.cfg.learn_reward == True and self.label_journal is not None:
+            self.label_journal.close()
+        if self.cfg.learn_reward == True and self.reward_server is not None:
+            self.reward_server.close()
+        if self.batch_prefetcher is not None:
+            self.batch_prefetcher.close()
 
     def save_snapshot(self):
         snapshot_dir = self.cfg.snapshot_dir
@@ -568,6 +746,8 @@ def main(cfg : DictConfig):
     if snapshot.exists():
         print(f'Overwriting models at: {work_dir}')
     workspace.save_snapshot()
+    # memory mapped replay files are removed, the snapshot has its own copy
+    workspace.replay_buffer.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file